@@ -1,4 +1,4 @@
-from typing import Optional, List, Any, Union
+from typing import Optional, List, Dict, Any, Union, Callable, Iterable
 import asyncio
 from concurrent.futures import ProcessPoolExecutor
 from rich.columns import Columns
@@ -11,6 +11,13 @@ import sys
 import os
 
 from .slurm import SlurmJob
+from .packing import PackedJob, select_packable
+from .pilot import PilotPool
+from .mapping import submit_map, MapFuture
+from .journal import SubmissionJournal
+from .poller import JobPoller, TERMINAL_STATES
+from ..lib.accounting import AccountingHistory
+from ..lib.dashboard import Dashboard, StateTable
 import catena.lib.env as env
 from ..lib.yaml_loader import Loader, safe_loader
 from ..models import JobManifest, CatenaConfig
@@ -30,6 +37,7 @@ class Jobs:
         self.executor = ProcessPoolExecutor(max_workers=4)
         self.loop = asyncio.get_event_loop()
         self.submitted = False
+        self.history = None
 
         self.dag = TaskDAG(self.jobs)
     
@@ -47,14 +55,46 @@ class Jobs:
     
     def __str__(self):
         console = Console()
-        jobs = [Panel(self.get_job_content(job), expand=True) for job in self.jobs]
-        console.print(Columns(jobs))
+        console.print(self.brief())
         return ''
 
-    def brief(self):
+    def brief(self, max_panels: Optional[int] = 50):
+        """
+        Panel per job, or a summary of job states when there are more than
+        `max_panels` jobs
+        """
+        if len(self.jobs) > max_panels:
+            return self.summary()
         jobs = [Panel(self.get_job_content(job), expand=True) for job in self.jobs]
         return Columns(jobs)
 
+    def summary(self):
+        """
+        Per state job counts, see `StateTable`
+        """
+        return StateTable(self.jobs).render()
+
+    def dashboard(self,
+                  refresh_per_second: Optional[float] = 4,
+                  recent: Optional[int] = 20,
+                  until_done: Optional[bool] = True):
+        """
+        Show a live dashboard of job states and recent transitions (see
+        `Dashboard`), watching all submitted jobs that have not finished
+
+        Args:
+            refresh_per_second: maximum number of redraws per second
+            recent: number of recent transitions shown
+            until_done: return once every job reached a final state
+        """
+        poller = JobPoller.instance()
+        for job in self.jobs:
+            if job.jobid is not None and getattr(job, 'job_state', None) not in TERMINAL_STATES:
+                poller.watch(job)
+
+        Dashboard(self.jobs, refresh_per_second=refresh_per_second,
+                  recent=recent).run(until_done=until_done)
+
     
     @property
     def job_map(self):
@@ -96,6 +136,149 @@ class Jobs:
     #    ""
     
 
+    def pack(self,
+             max_tasks: Optional[int] = 64,
+             max_runtime: Optional[float] = None,
+             runtimes: Optional[Dict[str, float]] = None,
+             workers: Optional[int] = None,
+             launcher: Optional[str] = 'srun',
+             **kwargs):
+        """
+        Pack short running jobs into shared allocations to cut down on
+        scheduler overhead. Jobs are selected using the manifest `pack` hint
+        or their historical runtime (see `select_packable`) and grouped into
+        `PackedJob` instances of at most `max_tasks` jobs each, which replace
+        the packed jobs in this collection.
+
+        Args:
+            max_tasks: maximum number of jobs packed into one allocation,
+                None packs all jobs of a cluster profile into one allocation
+            max_runtime: runtime threshold in seconds under which a job is
+                considered short running
+            runtimes: map of {job name: runtime in seconds} from previous runs
+            workers: number of tasks run concurrently in each allocation
+            launcher: (srun|local) how tasks are launched within the allocation
+            kwargs: sbatch options for the packed allocations
+        """
+        if self.submitted:
+            raise RuntimeError("jobs can not be packed after they have been submitted")
+
+        packable = select_packable(self.jobs, max_runtime=max_runtime, runtimes=runtimes)
+
+        # group jobs by cluster profile, jobs can only share an allocation on the same cluster
+        groups = {}
+        for job in packable:
+            groups.setdefault(job.profile_name, []).append(job)
+
+        packed = []
+        for profile, group in groups.items():
+            size = max_tasks or len(group)
+            for i in range(0, len(group), size):
+                chunk = group[i:i + size]
+                if len(chunk) < 2:
+                    continue
+
+                with PackedJob(name=f"catena-pack-{len(packed)}",
+                               profile=profile,
+                               tasks=chunk,
+                               workers=workers,
+                               launcher=launcher,
+                               **kwargs) as job:
+                    packed.append(job)
+
+        packed_tasks = {id(t) for p in packed for t in p.tasks}
+        self.jobs = [j for j in self.jobs if id(j) not in packed_tasks] + packed
+        self.dag = TaskDAG(self.jobs)
+        return packed
+
+    def pilot(self, profile: Optional[str] = None, **kwargs) -> PilotPool:
+        """
+        Execution mode in which jobs are not submitted individually, but are
+        enqueued as tasks for a pool of long lived pilot allocations (see
+        `PilotPool`). Pilots are scaled with the queue depth; call
+        `PilotPool.wait` to follow the tasks and `PilotPool.drain` to let
+        the pilots exit.
+
+        Args:
+            profile: cluster profile to submit pilots to, **defaults to the
+                profile of the first job**
+            kwargs: options passed to `PilotPool`
+        """
+        if any(job.dependencies is not None for job in self.jobs):
+            raise ValueError("jobs with dependencies can not be run on pilots")
+
+        if profile is None:
+            profile = self.jobs[0].profile_name
+
+        pool = PilotPool(profile=profile, **kwargs)
+        for job in self.jobs:
+            pool.put(job)
+
+        pool.scale()
+        self.submitted = True
+        return pool
+
+    def map(self,
+            func: Callable[..., Any],
+            iterable: Iterable[Any],
+            chunksize: Optional[int] = 1,
+            profile: Optional[str] = None,
+            **kwargs) -> List[MapFuture]:
+        """
+        Parallel map of a Python callable over an iterable. The function is
+        serialised once, the inputs are written in chunks to a store on a
+        shared filesystem, and a single job array with one task per chunk is
+        submitted and added to this collection.
+
+        Args:
+            func: function to apply to each item
+            iterable: inputs to apply the function to
+            chunksize: number of inputs processed by each array task
+            profile: cluster profile to submit to, **defaults to the profile
+                of the first job**
+            kwargs: options passed to `submit_map` (name, store, max_parallel)
+                and sbatch options for the job array
+
+        Returns:
+            one `MapFuture` per input, in input order, whose results are
+            deserialised lazily
+        """
+        if profile is None:
+            if not self.jobs:
+                raise ValueError("a cluster profile is required to map over an empty Jobs instance")
+            profile = self.jobs[0].profile_name
+
+        job, futures = submit_map(func, iterable, profile, chunksize=chunksize, **kwargs)
+        if job is not None:
+            self.append(job)
+        return futures
+
+    def ingest_accounting(self,
+                          history: Optional[Union[AccountingHistory, str]] = None,
+                          source: Optional[str] = 'sacct',
+                          batch_size: Optional[int] = 500) -> AccountingHistory:
+        """
+        Bulk-fetch the resource usage of the submitted jobs and append it to
+        the columnar accounting history, see `AccountingHistory`
+
+        Args:
+            history: history store or its directory, **defaults to the store
+                already attached to this collection, or .catena/history**
+            source: (sacct|slurmdb) where accounting records are fetched from
+            batch_size: number of jobs fetched per request
+        """
+        if history is None:
+            history = self.history or AccountingHistory()
+        elif not isinstance(history, AccountingHistory):
+            history = AccountingHistory(history)
+
+        self.history = history
+        for job in self.jobs:
+            if getattr(job, 'rightsize', None) is not None:
+                job.history = history
+        history.ingest(self.jobs, source=source, batch_size=batch_size)
+        return history
+
     async def submit(self, delay:Optional[int]=3):
         # TODO: make sure this works.
 
@@ -113,10 +296,11 @@ class Manifest:
 
     def __init__(self, manifest: str, _submit:Optional[bool]=True):
         
-        self.jobs = Jobs()
+        self.jobs = Jobs(jobs=[])
         self.manifest = manifest
         self.submitted = False
         self._submit = _submit
+        self.journal = None
 
         # add custom yaml constructor for manifest
         Loader.add_constructor('!include', Loader.include)
@@ -150,14 +334,18 @@ class Manifest:
         env.MAIN_MANIFEST = None
 
 
-    def open(self):
+    def open(self, resume: Optional[bool] = False):
         """
         Open manifest context
+
+        Args:
+            resume: resume the last run of this manifest from its submission
+                journal, only submitting the jobs that were not submitted yet
         """
         self.__enter__()
 
         if self._submit:
-            self.submit()
+            self.submit(resume=resume)
         
         return self
     
@@ -194,7 +382,8 @@ class Manifest:
         except Exception:
             pass
 
-        jobdefs = JobManifest(**data).expand_jobs()
+        manifest = JobManifest(**data)
+        jobdefs = manifest.expand_jobs()
         for jobdef in jobdefs:
             #TODO: Add cluster_profile to get backend and determine job type
             # to accomodate more than slurm in the future.
@@ -210,21 +399,97 @@ class Manifest:
                               command=jobdef.command,
                               env_extra=jobdef.env_extra, 
                               dependencies=jobdef.dependencies,
+                              pack=jobdef.pack,
+                              retry=jobdef.retry if jobdef.retry is not None else manifest.retry,
+                              rightsize=(jobdef.rightsize if jobdef.rightsize is not None
+                                         else manifest.rightsize),
+                              sidecar=jobdef.sidecar,
                               **jobdef.job.dict(exclude_none=True)) as job:
                     self.jobs.append(job)       
+
+        self.jobs.dag = TaskDAG(self.jobs.jobs)
+
+    @property
+    def journal_path(self):
+        """
+        Path of the submission journal of this manifest
+        """
+        return Path(env.CONTEXT_ROOT) / '.catena' / 'journal' / f"{Path(self.manifest).stem}.jsonl"
             
 
-    def submit(self):
-        """Submit job manifest to cluster"""
-        
-        # CREATE DAG HERE and order list using a topological sort
-        # on DAG before submitting jobs so that they are in right order
-        
-        self.jobs.submit()
+    def submit(self, resume: Optional[bool] = False):
+        """
+        Submit job manifest to cluster. Jobs are submitted level by level of
+        the DAG so that the jobids of their dependencies are known, and every
+        submission is recorded in the manifest's `SubmissionJournal`; the
+        intents of a level are flushed to disk before it is submitted.
+
+        Args:
+            resume: reconcile the journal of the last run against the cluster
+                and submit only the jobs that are missing
+        """
+        with SubmissionJournal(self.journal_path, resume=resume) as journal:
+            self.journal = journal
+            if resume:
+                journal.reconcile(self.jobs.jobs)
+            for job in self.jobs.jobs:
+                job.run_id = journal.run_id
+                if job.rightsize is not None:
+                    if self.jobs.history is None:
+                        self.jobs.history = AccountingHistory(
+                            Path(env.CONTEXT_ROOT) / '.catena' / 'history')
+                    job.history = self.jobs.history
+
+            pending = [job for job in self.jobs.dag.ordered_jobs() if job.jobid is None]
+            backends = {id(getattr(job, 'backend', None)) for job in pending}
+            if pending and len(backends) == 1 and getattr(pending[0], 'backend', None) is not None:
+                self._submit_remote(pending[0].backend, journal)
+
+            for level in self.jobs.dag.levels():
+                level = [job for job in level if job.jobid is None]
+                # intents are durable before any job of the level is submitted
+                for job in level:
+                    journal.intent(job)
+                journal.flush()
+
+                for job in level:
+                    try:
+                        job.submit()
+                    except Exception as error:
+                        journal.failed(job, error)
+                        raise
+                    journal.submitted(job)
+
+        self.jobs.submitted = True
         self.submitted = True
         return self.jobs
 
 
+    def _submit_remote(self, backend, journal: SubmissionJournal):
+        """
+        Submit all jobs through one SSH backend, staging every script in one
+        transfer and submitting each DAG level with one remote invocation
+        """
+        levels = [[job for job in level if job.jobid is None] for level in self.jobs.dag.levels()]
+        for job in (job for level in levels for job in level):
+            if job.rightsize is not None and job.history is not None and not job.attempts:
+                job.right_size()
+        backend.stage([job for level in levels for job in level])
+
+        for level in levels:
+            for job in level:
+                journal.intent(job)
+            journal.flush()
+            errors = backend.submit_level(level)
+            for job in level:
+                if job.name in errors:
+                    journal.failed(job, RuntimeError(errors[job.name]))
+                else:
+                    journal.submitted(job)
+            if errors:
+                raise RuntimeError(f"sbatch rejected {len(errors)} jobs: {', '.join(errors)}")
+
+
 class TaskDAG(nx.DiGraph):
 
     def __init__(self, jobs: Union[List[SlurmJob], List[Any]]):
@@ -240,6 +505,10 @@ class TaskDAG(nx.DiGraph):
             # so topo sort nodes, submit jobs in order
             
             self.add_node(job.name, job=job)
+            job.depmap.clear()
+            job.dependents.clear()
+
+        for job in self.jobs:
             if job.dependencies is not None: 
                 for dep_type in job.dependencies:
                     tmpstr = ''
@@ -247,16 +516,40 @@ class TaskDAG(nx.DiGraph):
                         depjob = self.get_job(dep)
                         edges.append([depjob, job, dep_type])
                         job.depmap[dep_type].append(depjob)
+                        depjob.dependents.append(job)
 
         # label edge[:-1] by dependency type[-1]
         self.edge_labels = {tuple(e[:-1]): e[-1] for e in edges}
         self.add_edges_from([e[:-1] for e in edges])
 
 
+    def ordered_jobs(self) -> List[Any]:
+        """
+        Return jobs in topological order, dependencies before their dependents
+        """
+        ordered = [n for n in nx.topological_sort(self) if not isinstance(n, str)]
+        seen = {id(j) for j in ordered}
+        return [j for j in self.jobs if id(j) not in seen] + ordered
+
+    def levels(self) -> List[List[Any]]:
+        """
+        Return jobs grouped by depth in the DAG, every job only depends on
+        jobs of earlier levels
+        """
+        graph = self.subgraph([n for n in self if not isinstance(n, str)])
+        levels = [list(level) for level in nx.topological_generations(graph)]
+        seen = {id(j) for level in levels for j in level}
+        independent = [j for j in self.jobs if id(j) not in seen]
+        if independent:
+            levels = [independent + (levels[0] if levels else [])] + levels[1:]
+        return levels
+
     def get_job(self, job_name:str):
         """
-        Return job object by job name
+        Return job object by job name. Jobs packed into a `PackedJob` resolve
+        to the allocation they were packed into.
         """
-        return next((j for j in self.jobs if j.name == job_name), None)
+        return next((j for j in self.jobs if j.name == job_name or
+                     job_name in getattr(j, 'task_names', ())), None)
 
 
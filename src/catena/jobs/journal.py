@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import uuid
+from pathlib import Path
+from collections import defaultdict
+from typing import Optional, Dict, List, Any
+from loguru import logger
+
+from .poller import cluster_key
+from ..lib.accounting import list_submissions
+
+
+class SubmissionJournal:
+    """
+    Append-only journal of job submissions for a manifest run. An `intent`
+    record is written before a job is submitted and a `submitted` record with
+    its jobid afterwards. Records are buffered and written with a single
+    `fsync` per batch, so journaling adds little to the cost of a submission.
+    Callers `flush` the intents of a batch of jobs (e.g. a DAG level) before
+    submitting any of them, so every submitted job has a durable intent.
+
+    Jobs that have an intent but no result in the journal (the submitting
+    process died between the two records, or before the batch was flushed),
+    and jobs without any record in a run that has started, are reconciled
+    against the accounting database of the cluster by name and submit time
+    when resuming.
+
+    Attributes:
+        path: journal file, one JSON record per line
+
+        run_id: id of the manifest run, **defaults to a new run, or the last
+            run in the journal when resuming**
+
+        batch_size: number of buffered records that triggers a flush
+
+        flush_interval: maximum seconds records stay buffered
+    """
+
+    def __init__(self,
+                 path: str,
+                 run_id: Optional[str] = None,
+                 resume: Optional[bool] = False,
+                 batch_size: Optional[int] = 64,
+                 flush_interval: Optional[float] = 1.0):
+
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.records = self.read(self.path) if resume else []
+        if run_id is None:
+            runs = [r['run'] for r in self.records if 'run' in r]
+            run_id = runs[-1] if (resume and runs) else uuid.uuid4().hex
+
+        self.run_id = run_id
+        self._buffer: List[str] = []
+        self._last_flush = time.time()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def read(path: str) -> List[dict]:
+        """
+        Read all records of a journal, ignoring a trailing partial record
+        left by a crash during a write
+        """
+        if not Path(path).is_file():
+            return []
+
+        records = []
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning(f"Ignoring corrupt journal record in {path}")
+        return records
+
+    def __append(self, record: dict):
+        record = {'run': self.run_id, 'time': time.time(), **record}
+        self.records.append(record)
+        self._buffer.append(json.dumps(record) + '\n')
+
+        if (len(self._buffer) >= self.batch_size or
+            time.time() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Write buffered records and fsync the journal
+        """
+        if not self._buffer:
+            return
+
+        if self._file is None:
+            self._file = open(self.path, 'ab+')
+            # terminate a partial record left by a crash before appending
+            if self._file.tell() > 0:
+                self._file.seek(-1, os.SEEK_END)
+                if self._file.read(1) != b'\n':
+                    self._file.write(b'\n')
+
+        self._file.write(''.join(self._buffer).encode())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._buffer = []
+        self._last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def intent(self, job):
+        self.__append({'op': 'intent', 'name': job.name})
+
+    def submitted(self, job):
+        self.__append({'op': 'submitted', 'name': job.name, 'jobid': job.jobid})
+
+    def failed(self, job, error: Exception):
+        self.__append({'op': 'failed', 'name': job.name, 'error': repr(error)})
+
+    def state(self) -> Dict[str, dict]:
+        """
+        Return the last record per job name of the current run
+        """
+        state = {}
+        for record in self.records:
+            if record.get('run') == self.run_id and 'name' in record:
+                state[record['name']] = record
+        return state
+
+    def reconcile(self, jobs: List[Any]) -> Dict[str, Any]:
+        """
+        Set the jobid of every job that has already been submitted in this run.
+        Jobs with an unresolved intent, or without any record, are looked up
+        in the accounting of the cluster by name, user and submit time (after
+        their intent, or after the start of the run). slurmctld alone forgets
+        finished jobs after MinJobAge, so resuming is refused with a
+        RuntimeError when the accounting can not be reached, rather than
+        risking a second submission.
+
+        Returns:
+            map of {job name: jobid} of jobs that do not need to be submitted
+        """
+        state = self.state()
+        resolved = {}
+        unresolved = defaultdict(list)
+        started = min((r['time'] for r in self.records if r.get('run') == self.run_id), default=None)
+
+        for job in jobs:
+            record = state.get(job.name)
+            if record is None:
+                # a run that never started has submitted nothing
+                if started is not None:
+                    unresolved[cluster_key(job)].append((job, started))
+                continue
+
+            if record['op'] == 'submitted':
+                resolved[job.name] = record['jobid']
+            elif record['op'] == 'intent':
+                unresolved[cluster_key(job)].append((job, record['time']))
+
+        for cluster_jobs in unresolved.values():
+            since = min(intent_time for _, intent_time in cluster_jobs) - 60
+            try:
+                records = list_submissions(cluster_jobs[0][0], since)
+            except Exception as error:
+                raise RuntimeError(f"Can not resume run {self.run_id}: the accounting of the cluster "
+                                   f"is unreachable to check {len(cluster_jobs)} possibly submitted "
+                                   f"jobs ({error!r})") from error
+
+            for job, intent_time in cluster_jobs:
+                # allow for clock skew between the submit host and slurmctld
+                matches = [r for r in records if r.get('name') == job.name and
+                           r.get('user_name', job.user) == job.user and
+                           (r.get('submit_time') or 0) >= intent_time - 60]
+                if matches:
+                    latest = max(matches, key=lambda r: r.get('submit_time') or 0)
+                    resolved[job.name] = latest['job_id']
+                    job.jobid = latest['job_id']
+                    self.submitted(job)
+
+        for job in jobs:
+            if job.name in resolved:
+                job.jobid = resolved[job.name]
+
+        self.flush()
+        logger.info(f"Journal run {self.run_id}: {len(resolved)} of {len(jobs)} jobs already submitted")
+        return resolved
@@ -0,0 +1,227 @@
+import os
+import time
+import uuid
+import itertools
+import threading
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Callable, Iterable, Tuple
+import dill
+from loguru import logger
+
+from .slurm import SlurmJob
+from .poller import list_jobs, TERMINAL_STATES
+from catena.lib import env
+from catena.lib.scripts import MapTask
+
+
+class MapTaskError(Exception):
+    """
+    Raised when the mapped function failed for an input, carries the
+    formatted remote traceback
+    """
+    pass
+
+
+class ChunkStore:
+    """
+    Store on a shared filesystem holding the serialised function, the chunked
+    inputs and the chunked results of a `Jobs.map` call
+
+    Attributes:
+        root: store directory, must be visible to the compute nodes
+    """
+
+    def __init__(self, root: str):
+
+        self.root = Path(root)
+        self.inputs = self.root / 'inputs'
+        self.results = self.root / 'results'
+        self.inputs.mkdir(parents=True, exist_ok=True)
+        self.results.mkdir(parents=True, exist_ok=True)
+
+        self._cache = {}
+
+    def write_function(self, func: Callable[..., Any]):
+        """
+        Serialise the function once, including the globals it references
+        """
+        with open(self.root / 'func.pkl', 'wb') as f:
+            dill.dump(func, f, recurse=True)
+
+    def write_chunks(self, iterable: Iterable[Any], chunksize: int) -> List[int]:
+        """
+        Write inputs in chunks of `chunksize`, returns the size of each chunk
+        """
+        sizes = []
+        items = iter(iterable)
+        while True:
+            chunk = list(itertools.islice(items, chunksize))
+            if not chunk:
+                break
+            with open(self.inputs / f"{len(sizes)}.pkl", 'wb') as f:
+                dill.dump(chunk, f)
+            sizes.append(len(chunk))
+        return sizes
+
+    def chunk_done(self, index: int) -> bool:
+        return index in self._cache or (self.results / f"{index}.pkl").is_file()
+
+    def load_chunk(self, index: int) -> List[Tuple[bool, Any]]:
+        """
+        Deserialise the results of a chunk, results are only read once
+        """
+        if index not in self._cache:
+            with open(self.results / f"{index}.pkl", 'rb') as f:
+                self._cache[index] = dill.load(f)
+        return self._cache[index]
+
+
+class ArrayState:
+    """
+    States of the tasks of a job array, shared by all futures of a `Jobs.map`
+    call and fetched with one `list_jobs` request at most every `interval` seconds
+
+    Attributes:
+        job: submitted job array
+
+        interval: minimum seconds between two requests
+    """
+
+    def __init__(self, job: SlurmJob, interval: Optional[float] = 30):
+
+        self.job = job
+        self.interval = interval
+        self.states: Dict[int, str] = {}
+        self._fetched = 0.0
+        self._lock = threading.Lock()
+
+    def task_state(self, index: int) -> Optional[str]:
+        """
+        Last known state of array task `index`, None while unknown
+        """
+        with self._lock:
+            if time.time() - self._fetched >= self.interval:
+                self._fetched = time.time()
+                try:
+                    records = list_jobs(self.job, [self.job.jobid])
+                except Exception as error:
+                    logger.error(f"Could not fetch the state of job array {self.job.jobid}: {error!r}")
+                    return self.states.get(index)
+
+                for record in records.values():
+                    if (str(record.get('array_job_id')) == str(self.job.jobid) and
+                        record.get('array_task_id') is not None):
+                        self.states[int(record['array_task_id'])] = record.get('job_state')
+            return self.states.get(index)
+
+
+class MapFuture:
+    """
+    Result of the mapped function for a single input. The result is only
+    deserialised when it is first requested.
+    """
+
+    def __init__(self, store: ChunkStore, chunk: int, offset: int,
+                 array: Optional[ArrayState] = None):
+
+        self.store = store
+        self.chunk = chunk
+        self.offset = offset
+        self.array = array
+
+    def __repr__(self):
+        state = 'finished' if self.done() else 'pending'
+        return f"<MapFuture chunk={self.chunk} offset={self.offset} {state}>"
+
+    def done(self) -> bool:
+        return self.store.chunk_done(self.chunk)
+
+    def result(self, timeout: Optional[float] = None, poll_time: Optional[float] = 2):
+        """
+        Wait for and return the result of the mapped function. Raises
+        `MapTaskError` when the array task of the input ended (OOM, TIMEOUT,
+        NODE_FAIL, ...) without writing its results.
+
+        Args:
+            timeout: seconds to wait before raising `TimeoutError`, **defaults
+                to waiting until the array task ended**
+            poll_time: seconds between checks of the store
+        """
+        start = time.time()
+        while not self.done():
+            if timeout is not None and time.time() - start >= timeout:
+                raise TimeoutError(f"result of chunk {self.chunk} not available after {timeout}s")
+
+            state = self.array.task_state(self.chunk) if self.array is not None else None
+            if state in TERMINAL_STATES:
+                # the result may take a moment to appear on the shared filesystem
+                time.sleep(poll_time)
+                if self.done():
+                    break
+                raise MapTaskError(f"array task {self.chunk} of job {self.array.job.jobid} "
+                                   f"ended in {state} without a result")
+            time.sleep(poll_time)
+
+        ok, value = self.store.load_chunk(self.chunk)[self.offset]
+        if not ok:
+            raise MapTaskError(value)
+        return value
+
+
+def submit_map(func: Callable[..., Any],
+               iterable: Iterable[Any],
+               profile: str,
+               chunksize: Optional[int] = 1,
+               name: Optional[str] = None,
+               store: Optional[str] = None,
+               max_parallel: Optional[int] = None,
+               **kwargs) -> Tuple[Optional[SlurmJob], List[MapFuture]]:
+    """
+    Apply `func` to every item of `iterable` on the cluster as a single job
+    array, with one array task per chunk of `chunksize` inputs.
+
+    Args:
+        func: function to apply, serialised with `dill`
+        iterable: inputs to apply the function to
+        profile: cluster profile to submit the job array to
+        chunksize: number of inputs processed by each array task, **defaults to 1**
+        name: job name, **defaults to catena-map-<func name>**
+        store: store directory on a shared filesystem, **defaults to
+            .catena/map/<name>-<uuid> in the context root**
+        max_parallel: maximum number of array tasks running at once
+        kwargs: sbatch options for the job array
+
+    Returns:
+        the submitted job array and one `MapFuture` per input, in input order,
+        or None and no futures when `iterable` is empty
+    """
+    if chunksize is None:
+        chunksize = 1
+    if not isinstance(chunksize, int) or chunksize < 1:
+        raise ValueError(f"chunksize must be a positive integer, got {chunksize!r}")
+
+    if name is None:
+        name = f"catena-map-{getattr(func, '__name__', 'func')}"
+
+    if store is None:
+        root = env.CONTEXT_ROOT if env.CONTEXT_ROOT else os.getcwd()
+        store = Path(root) / '.catena' / 'map' / f"{name}-{uuid.uuid4().hex[:8]}"
+
+    chunks = ChunkStore(store)
+    chunks.write_function(func)
+    sizes = chunks.write_chunks(iterable, chunksize)
+    if not sizes:
+        return None, []
+
+    array = f"0-{len(sizes) - 1}"
+    if max_parallel is not None:
+        array += f"%{max_parallel}"
+
+    script = MapTask(store=chunks.root).write(str(chunks.root / '_map_task.py'))
+    with SlurmJob(name=name, profile=profile, job_script=script,
+                  array=array, **kwargs) as job:
+        job.submit()
+
+    array = ArrayState(job)
+    futures = [MapFuture(chunks, i, j, array) for i, size in enumerate(sizes) for j in range(size)]
+    return job, futures
@@ -0,0 +1,206 @@
+import os
+import shlex
+from pathlib import Path
+from typing import Optional, Dict, List
+from loguru import logger
+
+from .slurm import SlurmJob
+from catena.lib import env
+from catena.lib.scripts import PackRunner
+
+
+def select_packable(jobs: List[SlurmJob],
+                    max_runtime: Optional[float] = None,
+                    runtimes: Optional[Dict[str, float]] = None) -> List[SlurmJob]:
+    """
+    Select the jobs that can be packed into a shared allocation. A job is
+    packable when it is marked with the `pack` hint, or when its historical
+    runtime is known and shorter than `max_runtime`. Jobs that depend on other
+    jobs are never packed, as the runner has no notion of ordering.
+
+    Args:
+        jobs: list of jobs to select from
+        max_runtime: runtime threshold in seconds under which a job is
+            considered short running
+        runtimes: map of {job name: runtime in seconds} from previous runs
+    """
+    runtimes = runtimes or {}
+    selected = []
+
+    for job in jobs:
+        if isinstance(job, PackedJob) or job.dependencies is not None:
+            continue
+
+        runtime = runtimes.get(job.name)
+        if job.pack or (max_runtime is not None and
+                        runtime is not None and runtime <= max_runtime):
+            selected.append(job)
+
+    return selected
+
+
+class PackedJob(SlurmJob):
+    """
+    A `PackedJob` bundles many short `SlurmJob` instances into a single SLURM
+    allocation. A runner script is generated that executes the rendered job
+    script of each packed task in parallel across the allocated cores, either
+    as `srun` job steps or as local background processes, `workers` at a time.
+
+    Each task writes its start time, end time and exit code into `status_dir`,
+    which is read back by `update_task_states` so that every logical job is
+    still reported individually in `SlurmJob._state`. Task output goes to the
+    task's own `standard_out`/`standard_error`, or to `status_dir`. The
+    allocation fails when any task fails.
+
+    Attributes:
+        tasks: list of `SlurmJob` instances to pack into this allocation
+
+        workers: number of tasks to execute concurrently, **defaults to the
+            number of tasks**
+
+        launcher: (srun|local) run each task as an `srun` job step or as a
+            local process on the batch host, **defaults to 'srun'**
+
+        status_dir: directory on a shared filesystem to write task scripts and
+            task status records to, **defaults to .catena/packs/<name> in the
+            context root**
+    """
+
+    def __init__(self,
+                 name: str,
+                 profile: str,
+                 tasks: List[SlurmJob],
+                 workers: Optional[int] = None,
+                 launcher: Optional[str] = 'srun',
+                 status_dir: Optional[str] = None,
+                 **kwargs
+                ):
+
+        if launcher not in ('srun', 'local'):
+            raise ValueError(f"unknown launcher '{launcher}', expected 'srun' or 'local'")
+
+        self.tasks: List[SlurmJob] = tasks
+        self.workers: int = workers or len(tasks)
+        self.launcher: str = launcher
+
+        if status_dir is None:
+            root = env.CONTEXT_ROOT if env.CONTEXT_ROOT else os.getcwd()
+            status_dir = Path(root) / '.catena' / 'packs' / name
+        self.status_dir = Path(status_dir)
+        self.status_dir.mkdir(parents=True, exist_ok=True)
+
+        # size the allocation for the requested concurrency
+        task_cpus = max([t.request.job.cpus_per_task or 1 for t in tasks] + [1])
+        if launcher == 'srun':
+            kwargs.setdefault('tasks', self.workers)
+            kwargs.setdefault('cpus_per_task', task_cpus)
+        else:
+            kwargs.setdefault('tasks', 1)
+            kwargs.setdefault('cpus_per_task', self.workers * task_cpus)
+
+        runner = PackRunner(tasks=[self.__write_task(t) for t in tasks],
+                            status_dir=shlex.quote(str(self.status_dir)),
+                            workers=self.workers,
+                            launcher=launcher,
+                            cpus_per_task=task_cpus)
+        runner_path = runner.write(str(self.status_dir / '_runner.sh'))
+
+        super().__init__(name=name, profile=profile,
+                         job_script=runner_path, **kwargs)
+
+    @property
+    def task_names(self) -> List[str]:
+        return [t.name for t in self.tasks]
+
+    def __write_task(self, task: SlurmJob) -> dict:
+        """
+        Write the rendered script of a packed task and the environment
+        variables that differ from the submitting environment. Returns the
+        shell quoted arguments of the task for the runner.
+        """
+        script_path = self.status_dir / f"{task.name}.sh"
+        with open(script_path, 'w') as f:
+            f.write(task.script)
+        os.chmod(script_path, 0o755)
+
+        local_env = dict(os.environ)
+        exports = {k: v for k, v in task.environment.items() if local_env.get(k) != v}
+        if exports:
+            with open(self.status_dir / f"{task.name}.env", 'w') as f:
+                for key, val in exports.items():
+                    f.write(f"{key}={shlex.quote(str(val))}\n")
+
+        # the output files of the task itself, %x and %u are known here and
+        # %j is expanded by the runner
+        options = task.request.job
+        standard_out = options.standard_out or str(self.status_dir / f"{task.name}.out")
+        standard_error = options.standard_error or ('' if options.standard_out else
+                                                    str(self.status_dir / f"{task.name}.err"))
+        paths = {field: path.replace('%x', task.name).replace('%u', task.user)
+                 for field, path in (('standard_out', standard_out), ('standard_error', standard_error))}
+
+        return {'name': shlex.quote(task.name),
+                'script_path': shlex.quote(str(script_path)),
+                **{field: shlex.quote(path) for field, path in paths.items()}}
+
+    def submit(self, job_monitor: Optional[bool] = False, delay: Optional[int] = 0):
+        """
+        Submit the packed allocation. Every packed task shares the jobid of
+        the allocation, so that dependent jobs are wired to it.
+        """
+        super().submit(job_monitor=job_monitor, delay=delay)
+        for task in self.tasks:
+            task.jobid = self.jobid
+        self.update_task_states()
+
+    def task_states(self) -> Dict[str, dict]:
+        """
+        Read back the status records written by the runner for each packed task
+        """
+        states = {}
+        for task in self.tasks:
+            record = {'jobid': self.jobid, 'state': 'PENDING', 'exit_code': None,
+                      'start_time': None, 'end_time': None, 'packed_into': self.name}
+
+            for field in ('start', 'end', 'exit'):
+                fpath = self.status_dir / f"{task.name}.{field}"
+                if not fpath.is_file():
+                    continue
+                try:
+                    value = int(fpath.read_text().strip())
+                except ValueError:
+                    continue
+
+                if field == 'exit':
+                    record['exit_code'] = value
+                else:
+                    record[f'{field}_time'] = value
+
+            if record['exit_code'] is not None:
+                record['state'] = 'COMPLETED' if record['exit_code'] == 0 else 'FAILED'
+            elif record['start_time'] is not None:
+                record['state'] = 'RUNNING'
+
+            states[task.name] = record
+
+        return states
+
+    def update_task_states(self) -> Dict[str, dict]:
+        """
+        Write the state of each packed task back to the shared job state
+        """
+        states = self.task_states()
+        for task in self.tasks:
+            task.job_state = states[task.name]['state']
+            self._state[task.name] = states[task.name]
+        return states
+
+    def monitor(self, poll_time=5):
+        result = super().monitor(poll_time=poll_time)
+        states = self.update_task_states()
+
+        failed = [name for name, rec in states.items() if rec['state'] == 'FAILED']
+        if failed:
+            logger.error(f"Packed job {self.jobid} has failed tasks: {', '.join(failed)}")
+
+        return result
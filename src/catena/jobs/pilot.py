@@ -0,0 +1,522 @@
+"""
+Pilot job worker pool. Long lived pilot allocations are submitted through the
+regular `SlurmJob` path and run catena workers that pull tasks from a queue
+directory on a shared filesystem, so that tasks are dispatched without going
+back through slurmctld.
+
+The queue directory is laid out as:
+
+    pending/    task records waiting to be claimed, spread over `SHARDS`
+                sub-directories so that no directory grows with the queue
+    claimed/    task records claimed by a worker (one sub-directory per worker)
+    done/       task result records (exit code, worker, timings)
+    scripts/    task scripts and environment files enqueued with `TaskQueue.put_script`
+    pilots/     pilot registration (.alive) and exit (.exit) markers
+    DRAIN       when present, workers exit as soon as they are idle
+
+Claiming a task is a `rename` from pending/ into claimed/, which is atomic on
+a single filesystem, so every task is executed by exactly one worker. Workers
+claim the first task of an unsorted directory scan starting at their own
+shard, so tasks are handed out in roughly, not strictly, submission order.
+"""
+import os
+import sys
+import json
+import math
+import time
+import shlex
+import socket
+import hashlib
+import argparse
+import subprocess
+from pathlib import Path
+from typing import Optional, List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+
+from .slurm import SlurmJob
+from .poller import list_jobs, TERMINAL_STATES
+from catena.lib import env
+from catena.lib.scripts import PilotScript
+
+
+# number of pending/ sub-directories tasks are spread over
+SHARDS = 16
+
+
+class TaskQueue:
+    """
+    Task queue backed by a directory on a shared filesystem
+
+    Attributes:
+        queue_dir: root directory of the queue, must be visible to the submit
+            host and all compute nodes running pilots
+    """
+
+    def __init__(self, queue_dir: str):
+
+        self.queue_dir = Path(queue_dir)
+        for sub in ('pending', 'claimed', 'done', 'scripts', 'pilots'):
+            (self.queue_dir / sub).mkdir(parents=True, exist_ok=True)
+        for shard in range(SHARDS):
+            (self.queue_dir / 'pending' / f"{shard:02x}").mkdir(exist_ok=True)
+
+        self._seq = 0
+        self._shard: Optional[int] = None
+
+    @property
+    def draining(self) -> bool:
+        return (self.queue_dir / 'DRAIN').exists()
+
+    def drain(self):
+        """
+        Ask all workers to exit once they are idle
+        """
+        (self.queue_dir / 'DRAIN').touch()
+
+    def resume(self):
+        """
+        Cancel a previous drain request
+        """
+        (self.queue_dir / 'DRAIN').unlink(missing_ok=True)
+
+    def __write_atomic(self, path: Path, record: dict):
+        tmp = path.with_name(f".{path.name}.tmp")
+        with open(tmp, 'w') as f:
+            json.dump(record, f)
+        os.rename(tmp, path)
+
+    def __shard(self, fname: str) -> Path:
+        return self.queue_dir / 'pending' / f"{int(fname.split('-')[-1].split('.')[0]) % SHARDS:02x}"
+
+    def put(self, name: str, command: List[str], cwd: Optional[str] = None,
+            env: Optional[str] = None) -> str:
+        """
+        Enqueue a command to be run by a pilot worker
+
+        Args:
+            name: unique task name, used to name the result record
+            command: command and arguments to execute
+            cwd: working directory to execute the command in
+            env: file of KEY=value lines exported to the command
+        """
+        self._seq += 1
+        record = {'name': name, 'command': list(command), 'cwd': cwd, 'env': env,
+                  'queued': time.time()}
+        # zero padded prefix keeps tasks sortable in submission order
+        fname = f"{time.time_ns():020d}-{self._seq:08d}.json"
+        self.__write_atomic(self.__shard(fname) / fname, record)
+        return fname
+
+    def put_env(self, environment: Dict[str, str]) -> str:
+        """
+        Write an environment file in the format of the packed job runner,
+        shared by all tasks with the same environment
+        """
+        content = ''.join(f"{key}={shlex.quote(str(val))}\n"
+                          for key, val in sorted(environment.items()))
+        path = self.queue_dir / 'scripts' / f"env-{hashlib.sha1(content.encode()).hexdigest()[:16]}.env"
+        if not path.is_file():
+            tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+            with open(tmp, 'w') as f:
+                f.write(content)
+            os.rename(tmp, path)
+        return str(path)
+
+    def put_script(self, name: str, script: str, cwd: Optional[str] = None,
+                   environment: Optional[Dict[str, str]] = None) -> str:
+        """
+        Write a rendered job script, and the environment it runs in, to
+        the queue and enqueue it
+        """
+        path = self.queue_dir / 'scripts' / name
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+        env_file = self.put_env(environment) if environment else None
+        return self.put(name, [str(path)], cwd=cwd, env=env_file)
+
+    def pending(self) -> List[str]:
+        return sorted(entry.name for shard in range(SHARDS)
+                      for entry in os.scandir(self.queue_dir / 'pending' / f"{shard:02x}")
+                      if entry.name.endswith('.json'))
+
+    def depth(self) -> int:
+        depth = 0
+        for shard in range(SHARDS):
+            with os.scandir(self.queue_dir / 'pending' / f"{shard:02x}") as entries:
+                depth += sum(1 for entry in entries if entry.name.endswith('.json'))
+        return depth
+
+    def claim(self, worker_id: str) -> Optional[dict]:
+        """
+        Claim a pending task for `worker_id`, returns None when the queue is
+        empty. Shards are scanned starting from the one that served the last
+        claim, and the first task of the scan is taken, so a claim reads
+        only the beginning of one directory while the queue is busy.
+        """
+        claimed = self.queue_dir / 'claimed' / worker_id
+        claimed.mkdir(exist_ok=True)
+
+        if self._shard is None:
+            # spread workers over the shards
+            self._shard = int(hashlib.sha1(worker_id.encode()).hexdigest(), 16) % SHARDS
+
+        for i in range(SHARDS):
+            shard = (self._shard + i) % SHARDS
+            directory = self.queue_dir / 'pending' / f"{shard:02x}"
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if not entry.name.endswith('.json'):
+                        continue
+                    target = claimed / entry.name
+                    try:
+                        os.rename(entry.path, target)
+                    except FileNotFoundError:
+                        # claimed by another worker first
+                        continue
+
+                    self._shard = shard
+                    with open(target, 'r') as f:
+                        record = json.load(f)
+                    record['_claim'] = str(target)
+                    return record
+
+        return None
+
+    def requeue(self, worker_id: str) -> int:
+        """
+        Move the tasks claimed by a worker that died back to pending/,
+        dropping claims of tasks that already have a result. Returns the
+        number of tasks requeued.
+        """
+        claimed = self.queue_dir / 'claimed' / worker_id
+        if not claimed.is_dir():
+            return 0
+
+        requeued = 0
+        for entry in list(os.scandir(claimed)):
+            if not entry.name.endswith('.json'):
+                continue
+            with open(entry.path, 'r') as f:
+                name = json.load(f)['name']
+            if (self.queue_dir / 'done' / f"{name}.json").is_file():
+                os.unlink(entry.path)
+                continue
+            os.rename(entry.path, self.__shard(entry.name) / entry.name)
+            requeued += 1
+        return requeued
+
+    def complete(self, record: dict, result: dict):
+        """
+        Write the result of a task and release its claim
+        """
+        self.__write_atomic(self.queue_dir / 'done' / f"{record['name']}.json",
+                            {**{k: v for k, v in record.items() if not k.startswith('_')},
+                             **result})
+        Path(record['_claim']).unlink(missing_ok=True)
+
+    def result(self, name: str) -> Optional[dict]:
+        path = self.queue_dir / 'done' / f"{name}.json"
+        if not path.is_file():
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def results(self) -> Dict[str, dict]:
+        results = {}
+        for path in (self.queue_dir / 'done').iterdir():
+            if path.suffix == '.json':
+                with open(path, 'r') as f:
+                    results[path.stem] = json.load(f)
+        return results
+
+    def register(self, worker_id: str):
+        (self.queue_dir / 'pilots' / f"{worker_id}.alive").touch()
+
+    def unregister(self, worker_id: str):
+        (self.queue_dir / 'pilots' / f"{worker_id}.exit").touch()
+        (self.queue_dir / 'pilots' / f"{worker_id}.alive").unlink(missing_ok=True)
+
+    def exited(self) -> List[str]:
+        return [p.stem for p in (self.queue_dir / 'pilots').iterdir()
+                if p.suffix == '.exit']
+
+
+class PilotWorker:
+    """
+    Worker executed inside a pilot allocation. Claims tasks from a `TaskQueue`
+    and runs up to `slots` of them concurrently, until the queue is drained or
+    no task has been available for `idle_timeout` seconds.
+    """
+
+    def __init__(self,
+                 queue_dir: str,
+                 slots: Optional[int] = 1,
+                 idle_timeout: Optional[float] = 60,
+                 poll_interval: Optional[float] = 0.1,
+                 worker_id: Optional[str] = None):
+
+        self.queue = TaskQueue(queue_dir)
+        self.slots = slots
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+
+        if worker_id is None:
+            worker_id = os.environ.get('SLURM_JOB_ID',
+                                       f"{socket.gethostname()}-{os.getpid()}")
+        self.worker_id = worker_id
+        self._environments: Dict[str, Dict[str, str]] = {}
+
+    def environment(self, record: dict) -> Optional[Dict[str, str]]:
+        """
+        Environment of a task: the worker's environment updated with the
+        task's environment file, which is read once per worker
+        """
+        path = record.get('env')
+        if not path:
+            return None
+        if path not in self._environments:
+            exports = {}
+            # parsed as a whole, quoted values may span lines (e.g. exported functions)
+            with open(path, 'r') as f:
+                for token in shlex.split(f.read()):
+                    key, _, val = token.partition('=')
+                    exports[key] = val
+            self._environments[path] = {**os.environ, **exports}
+        return self._environments[path]
+
+    def execute(self, record: dict):
+        start = time.time()
+        exit_code = 127
+        try:
+            proc = subprocess.run(record['command'], cwd=record.get('cwd'),
+                                  env=self.environment(record))
+            exit_code = proc.returncode
+        except Exception as err:
+            # any failure must still produce a result, or the task stays claimed forever
+            logger.error(f"Task {record['name']} could not be started: {err!r}")
+        finally:
+            self.queue.complete(record, {'exit_code': exit_code,
+                                         'worker': self.worker_id,
+                                         'host': socket.gethostname(),
+                                         'start_time': start,
+                                         'end_time': time.time()})
+
+    def run(self):
+        self.queue.register(self.worker_id)
+        running = set()
+        idle_since = time.time()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.slots) as pool:
+                while True:
+                    running = {f for f in running if not f.done()}
+
+                    if len(running) < self.slots and not self.queue.draining:
+                        record = self.queue.claim(self.worker_id)
+                        if record is not None:
+                            running.add(pool.submit(self.execute, record))
+                            idle_since = time.time()
+                            continue
+
+                    if not running:
+                        if (self.queue.draining or
+                            time.time() - idle_since >= self.idle_timeout):
+                            break
+
+                    time.sleep(self.poll_interval)
+        finally:
+            self.queue.unregister(self.worker_id)
+
+
+class PilotPool:
+    """
+    Pool of pilot allocations submitted through `SlurmJob`, scaled with the
+    depth of a `TaskQueue`.
+
+    Attributes:
+        profile: cluster profile to submit pilots to
+
+        queue_dir: queue directory on a shared filesystem, **defaults to
+            .catena/pilots in the context root**
+
+        min_pilots: minimum number of pilots kept alive while scaling
+
+        max_pilots: maximum number of pilots submitted at any time
+
+        tasks_per_pilot: queue depth handled per pilot when scaling up
+
+        slots: number of tasks each pilot runs concurrently
+
+        idle_timeout: seconds a pilot waits for new tasks before it exits
+
+        state_interval: seconds between checks of the pilot job states, used
+            to find pilots that SLURM killed before they could write their
+            exit marker (walltime, node failure, scancel)
+
+        kwargs: sbatch options for the pilot allocations
+    """
+
+    def __init__(self,
+                 profile: str,
+                 queue_dir: Optional[str] = None,
+                 min_pilots: Optional[int] = 0,
+                 max_pilots: Optional[int] = 8,
+                 tasks_per_pilot: Optional[int] = 100,
+                 slots: Optional[int] = 1,
+                 idle_timeout: Optional[float] = 60,
+                 poll_interval: Optional[float] = 0.1,
+                 python: Optional[str] = sys.executable,
+                 state_interval: Optional[float] = 30,
+                 **kwargs):
+
+        if queue_dir is None:
+            root = env.CONTEXT_ROOT if env.CONTEXT_ROOT else os.getcwd()
+            queue_dir = Path(root) / '.catena' / 'pilots'
+
+        self.profile = profile
+        self.queue = TaskQueue(queue_dir)
+        self.min_pilots = min_pilots
+        self.max_pilots = max_pilots
+        self.tasks_per_pilot = tasks_per_pilot
+        self.slots = slots
+        self.state_interval = state_interval
+        self.job_options = kwargs
+        self.pilots: List[SlurmJob] = []
+        self._last_reap = 0.0
+
+        kwargs.setdefault('cpus_per_task', slots)
+
+        self.pilot_script = PilotScript(queue_dir=str(self.queue.queue_dir),
+                                        python=python,
+                                        slots=slots,
+                                        idle_timeout=idle_timeout,
+                                        poll_interval=poll_interval
+                                        ).write(str(self.queue.queue_dir / '_pilot.sh'))
+
+    @property
+    def active(self) -> List[SlurmJob]:
+        """
+        Pilots that have been submitted and have not exited yet
+        """
+        exited = set(self.queue.exited())
+        return [p for p in self.pilots if str(p.jobid) not in exited]
+
+    def reap(self) -> List[SlurmJob]:
+        """
+        Find pilots whose job ended without an exit marker, write the marker
+        for them and requeue the tasks they had claimed. Returns the dead pilots.
+        """
+        self._last_reap = time.time()
+        active = self.active
+        if not active:
+            return []
+
+        try:
+            records = list_jobs(active[0], [p.jobid for p in active])
+        except Exception as error:
+            logger.error(f"Could not check the state of {len(active)} pilots: {error!r}")
+            return []
+
+        dead = []
+        for pilot in active:
+            state = (records.get(str(pilot.jobid)) or {}).get('job_state')
+            if state not in TERMINAL_STATES:
+                continue
+            requeued = self.queue.requeue(str(pilot.jobid))
+            self.queue.unregister(str(pilot.jobid))
+            logger.warning(f"Pilot {pilot.jobid} ended in {state}, requeued {requeued} claimed tasks")
+            dead.append(pilot)
+        return dead
+
+    def submit_pilot(self) -> SlurmJob:
+        with SlurmJob(name=f"catena-pilot-{len(self.pilots)}",
+                      profile=self.profile,
+                      job_script=self.pilot_script,
+                      **self.job_options) as pilot:
+            pilot.submit()
+            self.pilots.append(pilot)
+        logger.info(f"Submitted pilot {pilot.jobid}")
+        return pilot
+
+    def scale(self) -> int:
+        """
+        Submit pilots until there are enough to serve the current queue depth,
+        within [min_pilots, max_pilots]. Pilots scale down on their own when
+        they stay idle. Returns the number of pilots submitted.
+        """
+        if time.time() - self._last_reap >= self.state_interval:
+            self.reap()
+
+        if self.queue.draining:
+            return 0
+
+        wanted = math.ceil(self.queue.depth() / self.tasks_per_pilot)
+        wanted = max(self.min_pilots, min(self.max_pilots, wanted))
+
+        submitted = 0
+        for _ in range(wanted - len(self.active)):
+            self.submit_pilot()
+            submitted += 1
+        return submitted
+
+    def put(self, job: SlurmJob) -> str:
+        """
+        Enqueue the rendered script of a job along with the variables of its
+        environment that differ from the submitting environment, i.e. its
+        `env_extra` and the variables set by its `env_modules`, as for packed
+        jobs. Variables of the compute node (SLURM_*, HOSTNAME, TMPDIR, ...)
+        are left untouched.
+        """
+        local_env = dict(os.environ)
+        exports = {k: v for k, v in job.environment.items() if local_env.get(k) != v}
+        return self.queue.put_script(job.name, job.script, environment=exports)
+
+    def drain(self):
+        """
+        Stop handing out tasks, pilots exit once their running tasks finish
+        """
+        self.queue.drain()
+
+    def wait(self, names: Optional[List[str]] = None,
+             poll_time: Optional[float] = 1) -> Dict[str, dict]:
+        """
+        Scale pilots with the queue until all named tasks have a result
+
+        Args:
+            names: task names to wait for, **defaults to all enqueued tasks**
+            poll_time: seconds between checks of the queue
+        """
+        while True:
+            results = self.queue.results()
+            if names is None:
+                done = self.queue.depth() == 0 and not any(
+                    (self.queue.queue_dir / 'claimed').glob('*/*.json'))
+            else:
+                done = all(n in results for n in names)
+
+            if done:
+                return results
+
+            self.scale()
+            time.sleep(poll_time)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog='catena.jobs.pilot',
+                                     description='catena pilot job worker')
+    parser.add_argument('queue_dir')
+    parser.add_argument('--slots', type=int, default=1)
+    parser.add_argument('--idle-timeout', type=float, default=60)
+    parser.add_argument('--poll-interval', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    PilotWorker(args.queue_dir,
+                slots=args.slots,
+                idle_timeout=args.idle_timeout,
+                poll_interval=args.poll_interval).run()
+
+
+if __name__ == '__main__':
+    main()
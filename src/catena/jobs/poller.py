@@ -0,0 +1,360 @@
+import time
+import threading
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import Optional, Dict, List, Any, NamedTuple, Callable
+from loguru import logger
+
+from ..lib.metrics import request, POLL_CYCLE
+from ..lib.sidecar import SidecarWatcher
+
+
+TERMINAL_STATES = {'COMPLETED', 'CANCELLED', 'FAILED', 'TIMEOUT', 'NODE_FAIL',
+                   'PREEMPTED', 'OUT_OF_MEMORY', 'BOOT_FAIL', 'DEADLINE'}
+
+
+class JobResult(NamedTuple):
+    """
+    Final outcome of a submitted job
+
+    Attributes:
+        jobid: SLURM job id
+        state: final job state (e.g. COMPLETED, FAILED, TIMEOUT)
+        exit_code: exit code of the batch script
+        accounting: raw job record returned by slurmrestd
+    """
+    jobid: Any
+    state: str
+    exit_code: Optional[int]
+    accounting: Dict[str, Any]
+
+
+def cluster_key(job) -> tuple:
+    """
+    Key grouping the jobs that are polled with one `list_jobs` call
+    """
+    backend = getattr(job, 'backend', None)
+    if backend is not None:
+        return ('ssh', id(backend))
+    return (job.host, job.port, job.api_version)
+
+
+def list_jobs(job, jobids: Optional[List[Any]] = None, since: Optional[float] = None) -> Dict[str, dict]:
+    """
+    Fetch the records of all jobs known to slurmctld on the cluster of `job`
+    with a single `GET /jobs` request, keyed by jobid. Jobs in `jobids` that
+    are missing from the bulk response are requested one by one. Jobs of a
+    cluster only reachable over SSH are fetched with sacct by their backend
+    instead (see `RemoteSlurmBackend.records`).
+
+    Args:
+        job: any job of the cluster, used for its connection and credentials
+        jobids: jobids that should be present in the result
+        since: oldest submit time of interest, only used by sacct without `jobids`
+    """
+    backend = getattr(job, 'backend', None)
+    if backend is not None:
+        return backend.records(jobids, since=since)
+
+    job.token = job.generate_token()
+    base = f"{job.protocol}://{job.host}:{job.port}/slurm/v{job.api_version}"
+
+    response = request('GET', f"{base}/jobs", headers=job.request_header())
+    response.raise_for_status()
+    records = {str(r.get('job_id')): r for r in response.json().get('jobs', [])}
+
+    for missing in (j for j in (jobids or []) if str(j) not in records):
+        response = request('GET', f"{base}/job/{missing}", headers=job.request_header())
+        for r in response.json().get('jobs', []):
+            records[str(r.get('job_id'))] = r
+
+    return records
+
+
+class JobPoller:
+    """
+    Shared background poller resolving the futures of submitted jobs. A single
+    daemon thread polls slurmrestd for all watched jobs, with one `GET /jobs`
+    request per cluster per cycle rather than one request (or one thread)
+    per job. The thread exits when no job is left to watch and is restarted
+    on the next call to `watch`.
+
+    Jobs with a retry policy that end in a retryable state are resubmitted
+    once their backoff has elapsed, and their future is kept pending until the
+    final attempt ends.
+
+    State transitions observed in a poll cycle are published as a single batch
+    of events to the callbacks registered with `subscribe`.
+
+    Jobs that write a sidecar completion record are resolved from the record
+    as soon as it appears, and are only polled every `passive_every` cycles
+    to catch jobs killed before they could write it.
+
+    Attributes:
+        poll_time: seconds between poll cycles
+
+        passive_every: poll jobs with a sidecar record only every this many cycles
+
+        store: optional `JobStateStore` every observed state is written to,
+            in one transaction per poll cycle
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, poll_time: Optional[float] = 5, passive_every: Optional[int] = 12):
+
+        self.poll_time = poll_time
+        self.passive_every = passive_every
+        self._cycle = 0
+        self._passive = set()
+        self._sidecars: Optional[SidecarWatcher] = None
+        self._watched: Dict[str, tuple] = {}
+        self._retrying: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._subscribers: List[Callable[[List[dict]], None]] = []
+        self.store = None
+
+    @classmethod
+    def instance(cls) -> 'JobPoller':
+        """
+        Return the process wide poller
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __len__(self):
+        return len(self._watched)
+
+    def watch(self, job) -> Future:
+        """
+        Return a future resolving to the `JobResult` of a submitted job
+        """
+        if job.jobid is None:
+            raise RuntimeError(f"job {job.name} has not been submitted")
+
+        with self._lock:
+            key = str(job.jobid)
+            if key in self._watched:
+                return self._watched[key][1]
+
+            # left pending so callers may cancel() to stop watching a job
+            future = Future()
+            self._watched[key] = (job, future)
+
+            # array tasks write one record each, the array is resolved by polling
+            request = getattr(getattr(job, 'request', None), 'job', None)
+            if getattr(job, 'sidecar', None) is not None and getattr(request, 'array', None) is None:
+                if self._sidecars is None:
+                    self._sidecars = SidecarWatcher(self._on_sidecar)
+                self._passive.add(key)
+                self._sidecars.add(job.sidecar)
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name='catena-job-poller',
+                                                daemon=True)
+                self._thread.start()
+
+        return future
+
+    def subscribe(self, callback: Callable[[List[dict]], None]):
+        """
+        Register a callback receiving the list of state transitions of every
+        poll cycle, each a dict with jobid, name, run, state, previous and time.
+        Callbacks are called from the poller thread and must not block.
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[[List[dict]], None]):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def _publish(self, events: List[dict]):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(events)
+            except Exception as error:
+                logger.error(f"Job state subscriber {callback!r} failed: {error!r}")
+
+    def _on_sidecar(self, record: dict):
+        """
+        Resolve a watched job from its sidecar completion record
+        """
+        key = str(record.get('jobid'))
+        with self._lock:
+            entry = self._watched.get(key)
+            if entry is None or key in self._retrying:
+                return
+
+        job, future = entry
+        exit_code = record.get('exit_code')
+        if exit_code is None or exit_code >= 128:
+            # killed by a signal: terminated by SLURM (cancelled, timed out,
+            # preempted) or by the OOM killer (137), the precise state is only
+            # known to slurmctld
+            self._passive.discard(key)
+            return
+
+        state = 'COMPLETED' if exit_code == 0 else 'FAILED'
+        previous = getattr(job, 'job_state', None)
+        job.job_state = state
+        job._state[job.name] = {'jobid': job.jobid, 'state': state}
+        if self.store is not None:
+            self.store.record(job.jobid, job.name, state, run_id=getattr(job, 'run_id', None))
+            self.store.flush()
+
+        if job.can_retry(state):
+            due = time.time() + job.retry.delay(job.attempt)
+            with self._lock:
+                self._retrying.setdefault(key, (due, state))
+        else:
+            with self._lock:
+                self._watched.pop(key, None)
+                self._passive.discard(key)
+            if not future.done():
+                future.set_result(JobResult(jobid=job.jobid, state=state,
+                                            exit_code=exit_code, accounting=record))
+
+        if state != previous:
+            self._publish([{'jobid': job.jobid, 'name': job.name,
+                            'run': getattr(job, 'run_id', None), 'state': state,
+                            'previous': previous, 'time': record.get('end') or time.time()}])
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._watched:
+                    self._thread = None
+                    return
+            try:
+                self.poll()
+            except Exception:
+                # keep the thread alive, watched futures would never resolve otherwise
+                logger.exception("Job poll cycle failed")
+            time.sleep(self.poll_time)
+
+    def poll(self):
+        """
+        Run a single poll cycle over all watched jobs
+        """
+        with POLL_CYCLE.time():
+            self._poll()
+
+    def _poll(self):
+        self._resubmit_due()
+
+        with self._lock:
+            watched = dict(self._watched)
+            retrying = set(self._retrying)
+            passive = set(self._passive) if self._cycle % self.passive_every else set()
+        self._cycle += 1
+
+        clusters = defaultdict(list)
+        for key, (job, future) in watched.items():
+            if future.cancelled() or key in retrying or key in passive:
+                continue
+            clusters[cluster_key(job)].append(job)
+
+        resolved = [key for key, (_, future) in watched.items() if future.cancelled()]
+        events = []
+        for jobs in clusters.values():
+            try:
+                records = list_jobs(jobs[0], [j.jobid for j in jobs])
+            except Exception as error:
+                logger.error(f"Polling {len(jobs)} jobs on {jobs[0].host or 'the SSH backend'} failed: {error!r}")
+                continue
+
+            for job in jobs:
+                try:
+                    self._update(job, records.get(str(job.jobid)), watched, resolved, events)
+                except Exception as error:
+                    logger.error(f"Updating the state of job {job.jobid} failed: {error!r}")
+
+        with self._lock:
+            for key in resolved:
+                self._watched.pop(key, None)
+                self._passive.discard(key)
+
+        if self.store is not None:
+            self.store.flush()
+
+        if events:
+            self._publish(events)
+
+    def _update(self, job, record: Optional[dict], watched: Dict[str, tuple],
+                resolved: List[str], events: List[dict]):
+        """
+        Apply the polled record of a job: publish its transition, schedule
+        a retry or resolve its future when it reached a terminal state
+        """
+        if record is None:
+            return
+
+        previous = getattr(job, 'job_state', None)
+        job.job_state = record.get('job_state')
+        if job.job_state != previous:
+            events.append({'jobid': job.jobid, 'name': job.name,
+                           'run': getattr(job, 'run_id', None),
+                           'state': job.job_state, 'previous': previous,
+                           'time': time.time()})
+        job._state[job.name] = {'jobid': job.jobid, 'state': job.job_state}
+        if self.store is not None:
+            self.store.record(job.jobid, job.name, job.job_state,
+                              run_id=getattr(job, 'run_id', None))
+
+        key = str(job.jobid)
+        if job.job_state in TERMINAL_STATES and job.can_retry(job.job_state):
+            due = time.time() + job.retry.delay(job.attempt)
+            with self._lock:
+                # the sidecar watcher may have scheduled the retry already
+                if key in self._retrying:
+                    return
+                self._retrying[key] = (due, job.job_state)
+            logger.info(f"Job {job.jobid} ended in {job.job_state}, "
+                        f"resubmitting in {due - time.time():.0f}s")
+
+        elif job.job_state in TERMINAL_STATES and not watched[key][1].done():
+            watched[key][1].set_result(JobResult(jobid=job.jobid,
+                                                 state=job.job_state,
+                                                 exit_code=record.get('exit_code'),
+                                                 accounting=record))
+            resolved.append(key)
+
+    def _resubmit_due(self):
+        """
+        Resubmit jobs whose retry backoff has elapsed and watch their new jobid
+        """
+        now = time.time()
+        with self._lock:
+            due = [(key, state) for key, (when, state) in self._retrying.items() if when <= now]
+            entries = {}
+            for key, _ in due:
+                del self._retrying[key]
+                entries[key] = self._watched.pop(key, None)
+
+        for key, state in due:
+            if entries[key] is None:
+                # cancelled or resolved meanwhile
+                continue
+            job, future = entries[key]
+            try:
+                job.resubmit(state)
+            except Exception as error:
+                logger.error(f"Resubmitting job {key} failed: {error!r}")
+                future.set_result(JobResult(jobid=job.jobid, state=state,
+                                            exit_code=None, accounting={}))
+                continue
+
+            with self._lock:
+                self._watched[str(job.jobid)] = (job, future)
+                if key in self._passive:
+                    self._passive.discard(key)
+                    self._passive.add(str(job.jobid))
@@ -0,0 +1,387 @@
+import re
+import time
+import shlex
+import hashlib
+import tempfile
+import threading
+import posixpath
+from pathlib import Path
+from datetime import datetime
+from typing import Optional, Dict, List, Tuple, Any
+
+from loguru import logger
+
+from ..lib.client import RemoteClient
+
+
+# sbatch long options of the SlurmSubmit fields, fields missing here are
+# either handled separately or have no sbatch equivalent
+SBATCH_OPTIONS = {
+    'name': 'job-name',
+    'array': 'array',
+    'distribution': 'distribution',
+    'exclusive': 'exclusive',
+    'gres': 'gres',
+    'gres_flags': 'gres-flags',
+    'gpu_binding': 'gpu-bind',
+    'gpu_frequency': 'gpu-freq',
+    'gpus': 'gpus',
+    'gpus_per_node': 'gpus-per-node',
+    'gpus_per_socket': 'gpus-per-socket',
+    'gpus_per_task': 'gpus-per-task',
+    'licenses': 'licenses',
+    'mail_type': 'mail-type',
+    'mail_user': 'mail-user',
+    'memory_binding': 'mem-bind',
+    'memory_per_cpu': 'mem-per-cpu',
+    'memory_per_gpu': 'mem-per-gpu',
+    'memory_per_node': 'mem',
+    'cpus_per_task': 'cpus-per-task',
+    'minimum_cpus_per_node': 'mincpus',
+    'nice': 'nice',
+    'nodes': 'nodes',
+    'open_mode': 'open-mode',
+    'partition': 'partition',
+    'qos': 'qos',
+    'reservation': 'reservation',
+    'sockets_per_node': 'sockets-per-node',
+    'standard_error': 'error',
+    'standard_in': 'input',
+    'standard_out': 'output',
+    'tasks': 'ntasks',
+    'tasks_per_core': 'ntasks-per-core',
+    'tasks_per_node': 'ntasks-per-node',
+    'tasks_per_socket': 'ntasks-per-socket',
+    'threads_per_core': 'threads-per-core',
+    'time_limit': 'time',
+    'wckey': 'wckey',
+    'cores_per_socket': 'cores-per-socket',
+    'core_specifications': 'core-spec',
+    'delay_boot': 'delay-boot',
+}
+
+# options given as flags, mapped to the flag used for a true and a false value
+SBATCH_FLAGS = {
+    'hold': ('hold', None),
+    'requeue': ('requeue', 'no-requeue'),
+    'spread_job': ('spread-job', None),
+    'no_kill': ('no-kill', None),
+    'wait_all_nodes': ('wait-all-nodes=1', 'wait-all-nodes=0'),
+}
+
+# handled separately or meaningless on the remote host
+SKIPPED = {'environment', 'dependency', 'get_user_environment', 'minimum_nodes'}
+
+# submit at most this many jobs per helper invocation, keeping the command
+# line well under the argument size limit of the remote shell
+BATCH_SIZE = 500
+
+# sacct fields of the job records returned by `RemoteSlurmBackend.records`
+SACCT_RECORD = ('JobID', 'JobIDRaw', 'JobName', 'State', 'User', 'Submit', 'ExitCode')
+
+
+def _truthy(value: Any) -> bool:
+    return str(value).lower() in ('true', 'on', 'yes', '1')
+
+
+def _jobid(value: str) -> Any:
+    return int(value) if value.isdigit() else value
+
+
+def parse_records(output: str) -> Dict[str, dict]:
+    """
+    Parse `sacct -X -P` output in `SACCT_RECORD` into job records with the
+    keys of the slurmrestd job records used by the poller, keyed by jobid
+    """
+    records = {}
+    for line in output.splitlines():
+        fields = line.split('|')
+        if len(fields) != len(SACCT_RECORD):
+            continue
+        row = dict(zip(SACCT_RECORD, fields))
+        # pending tasks of an array (e.g. 12_[3-9]) share the jobid of its first task
+        if '[' in row['JobID'] and row['JobIDRaw'] in records:
+            continue
+        try:
+            submit = datetime.fromisoformat(row['Submit']).timestamp()
+        except ValueError:
+            submit = None
+        array_job, _, task = row['JobID'].partition('_')
+        code = row['ExitCode'].split(':')[0]
+        records[row['JobIDRaw']] = {
+            'job_id': _jobid(row['JobIDRaw']),
+            'name': row['JobName'],
+            # e.g. "CANCELLED by 1000"
+            'job_state': row['State'].split()[0] if row['State'] else row['State'],
+            'user_name': row['User'],
+            'submit_time': submit,
+            'exit_code': int(code) if code.isdigit() else None,
+            'array_job_id': _jobid(array_job) if task else None,
+            'array_task_id': int(task) if task.isdigit() else None,
+        }
+    return records
+
+
+def sbatch_directives(job) -> List[str]:
+    """
+    #SBATCH lines for the sbatch options set on a job
+    """
+    options = job.request.job.dict(exclude_unset=True, exclude_none=True)
+    directives = []
+    for field, value in options.items():
+        if field in SKIPPED:
+            continue
+        if field in SBATCH_FLAGS:
+            flag, negated = SBATCH_FLAGS[field]
+            flag = flag if _truthy(value) else negated
+            if flag is not None:
+                directives.append(f"--{flag}")
+        elif field in SBATCH_OPTIONS:
+            # zero means unset for the numeric options of the REST API
+            if value in (0, '0') and field not in ('nice',):
+                continue
+            directives.append(f"--{SBATCH_OPTIONS[field]}={value}")
+        else:
+            logger.warning(f"Ignoring option {field} without sbatch equivalent for job {job.name}")
+    return [f"#SBATCH {d}" for d in directives]
+
+
+def environment_lines(job) -> List[str]:
+    """
+    Module loads and exports of `env_extra` for the job script. Values
+    starting with ':' are appended to and values ending with ':' prepended
+    to the variable on the remote host, as for local jobs.
+    """
+    lines = []
+    if job.env_modules:
+        lines.append(f"module load {' '.join(shlex.quote(m) for m in job.env_modules)}")
+    for key, value in (job.env_extra or {}).items():
+        value = str(value)
+        if value.startswith(':'):
+            lines.append(f'export {key}="${{{key}}}"{shlex.quote(value)}')
+        elif value.endswith(':'):
+            lines.append(f'export {key}={shlex.quote(value)}"${{{key}}}"')
+        else:
+            lines.append(f"export {key}={shlex.quote(value)}")
+    return lines
+
+
+def render_script(job) -> str:
+    """
+    Batch script of a job for sbatch on the remote host, with its options as
+    #SBATCH directives after the shebang
+    """
+    lines = job.script.split('\n')
+    if lines and lines[0].startswith('#!'):
+        shebang, body = lines[0], lines[1:]
+    else:
+        shebang, body = '#!/bin/bash', lines
+    return '\n'.join([shebang, *sbatch_directives(job), *environment_lines(job), *body])
+
+
+class RemoteSlurmBackend:
+    """
+    Submit jobs to a SLURM cluster that is only reachable over SSH, through
+    `RemoteClient`. The scripts of all jobs are rendered with their sbatch
+    options and staged in one tar stream, then every level of the dependency
+    DAG is submitted by one remote helper invocation that runs
+    `sbatch --parsable` for each job of the level and prints all jobids at
+    once, so a submission costs one round trip per level instead of one per
+    job. Jobs of a level only depend on jobs of earlier levels, whose jobids
+    are known by the time the level is submitted.
+
+    Attributes:
+        client: connected `RemoteClient`, sharing pooled connections
+
+        remote_dir: remote directory scripts are staged in and jobs run from,
+            **defaults to the client's remote_path**
+
+        parallel: helper invocations run at once for levels larger than one batch
+    """
+
+    _backends: Dict[Tuple[Optional[str], ...], 'RemoteSlurmBackend'] = {}
+    _backends_lock = threading.Lock()
+
+    def __init__(self,
+                 client: RemoteClient,
+                 remote_dir: Optional[str] = None,
+                 parallel: Optional[int] = 4):
+
+        self.client = client
+        self.remote_dir = remote_dir or client.remote_path
+        self.parallel = parallel
+        self._staged: Dict[int, Tuple[str, str]] = {}
+
+    @classmethod
+    def for_profile(cls, profile) -> 'RemoteSlurmBackend':
+        """
+        Shared backend for a cluster profile with `ssh_host` set
+        """
+        key = (profile.ssh_host, profile.ssh_user, profile.ssh_keydir, profile.remote_workdir)
+        with cls._backends_lock:
+            if key not in cls._backends:
+                options = {'user': profile.ssh_user} if profile.ssh_user else {}
+                if profile.ssh_keydir:
+                    options['ssh_keydir'] = profile.ssh_keydir
+                client = RemoteClient(profile.ssh_host, remote_workdir=profile.remote_workdir, **options)
+                cls._backends[key] = cls(client)
+            return cls._backends[key]
+
+    @property
+    def script_dir(self) -> str:
+        return posixpath.join(self.remote_dir, '.catena', 'scripts')
+
+    def stage(self, jobs: List[Any]):
+        """
+        Render the scripts of `jobs` and upload the new or changed ones in
+        one tar stream
+        """
+        scripts = {}
+        for job in jobs:
+            script = render_script(job)
+            digest = hashlib.sha1(script.encode()).hexdigest()
+            if self._staged.get(id(job), (None,))[0] != digest:
+                scripts[id(job)] = (job, script, digest)
+        if not scripts:
+            return
+
+        with tempfile.TemporaryDirectory(prefix='catena-scripts-') as tmp:
+            for job, script, digest in scripts.values():
+                name = f"{re.sub(r'[^A-Za-z0-9_.-]', '_', job.name)}-{digest[:12]}.sh"
+                (Path(tmp) / name).write_text(script)
+                # relative to remote_dir, where the helper runs sbatch
+                self._staged[id(job)] = (digest, posixpath.join('.catena', 'scripts', name))
+            self.client.tar_upload(tmp, remote_dir=self.script_dir)
+
+    def _helper(self, jobs: List[Any]) -> str:
+        """
+        Shell program submitting `jobs` and printing name<TAB>jobid, or
+        name<TAB>ERROR<TAB>message, for each of them
+        """
+        lines = [
+            f"cd {shlex.quote(self.remote_dir)} || exit 1",
+            'sub() { name="$1"; shift; '
+            'if out=$(sbatch --parsable "$@" 2>&1); then printf "%s\\t%s\\n" "$name" "${out%%;*}"; '
+            'else printf "%s\\tERROR\\t%s\\n" "$name" "$(printf "%s" "$out" | tr "\\t\\n" "  ")"; fi; }',
+        ]
+        for job in jobs:
+            args = [shlex.quote(job.name)]
+            if job.depstr:
+                args.append(shlex.quote(f"--dependency={job.depstr}"))
+            args.append(shlex.quote(self._staged[id(job)][1]))
+            lines.append(f"sub {' '.join(args)}")
+        return f"bash -c {shlex.quote(chr(10).join(lines))}"
+
+    def submit_level(self, jobs: List[Any]) -> Dict[str, str]:
+        """
+        Submit jobs whose dependencies all have jobids, in one helper
+        invocation per `BATCH_SIZE` jobs, and set their `jobid`
+
+        Returns:
+            map of {job name: error message} of the jobs sbatch rejected
+        """
+        self.stage(jobs)
+        batches = [jobs[i:i + BATCH_SIZE] for i in range(0, len(jobs), BATCH_SIZE)]
+        results = self.client.run_commands([self._helper(batch) for batch in batches],
+                                           parallel=self.parallel)
+
+        errors = {}
+        for batch, result in zip(batches, results):
+            by_name = {job.name: job for job in batch}
+            if not result.ok:
+                for job in batch:
+                    errors[job.name] = result.stderr.strip() or f"exit status {result.exit_status}"
+                continue
+            for line in result.stdout.splitlines():
+                name, jobid, *error = line.split('\t')
+                job = by_name.get(name)
+                if job is None:
+                    continue
+                if jobid == 'ERROR':
+                    errors[name] = error[0] if error else ''
+                    continue
+                job.jobid = int(jobid) if jobid.isdigit() else jobid
+                job.response = {'job_id': job.jobid}
+
+        for name, error in errors.items():
+            logger.error(f"sbatch rejected job {name}: {error}")
+        logger.info(f"Submitted {len(jobs) - len(errors)}/{len(jobs)} jobs over SSH to {self.client.host}")
+        return errors
+
+    def submit(self, levels: List[List[Any]]) -> Dict[str, str]:
+        """
+        Stage all jobs at once and submit them level by level, stopping at
+        the first level with rejected jobs since their dependents can not be
+        submitted
+
+        Args:
+            levels: jobs grouped by DAG level, see `TaskDAG.levels`
+        """
+        self.stage([job for level in levels for job in level])
+        for level in levels:
+            errors = self.submit_level([job for job in level if job.jobid is None])
+            if errors:
+                return errors
+        return {}
+
+    def update_dependency(self, job):
+        """
+        Point the dependencies of a submitted job at the current jobids of
+        its upstream jobs with scontrol
+        """
+        result = self.client.run_commands(
+            [f"scontrol update JobId={job.jobid} Dependency={shlex.quote(job.depstr)}"])[0]
+        if not result.ok:
+            logger.error(f"Could not update dependencies of job {job.jobid}: {result.stderr.strip()}")
+
+    def records(self, jobids: Optional[List[Any]] = None,
+                since: Optional[float] = None) -> Dict[str, dict]:
+        """
+        Records of jobs from one sacct invocation, in the format of the
+        slurmrestd records returned by `list_jobs`, keyed by jobid
+
+        Args:
+            jobids: jobs to fetch, including all tasks of array jobs
+            since: without `jobids`, fetch the jobs of the user submitted
+                after this time, **defaults to the last day**
+        """
+        command = f"sacct -n -X -P -o {','.join(SACCT_RECORD)}"
+        if jobids is not None:
+            if not jobids:
+                return {}
+            command += f" -j {','.join(str(j) for j in jobids)}"
+        else:
+            since = time.time() - 86400 if since is None else since
+            command += f" -S {datetime.fromtimestamp(since):%Y-%m-%dT%H:%M:%S}"
+
+        result = self.client.run_commands([command])[0]
+        if not result.ok:
+            raise IOError(f"sacct failed on {self.client.host}: {result.stderr.strip()}")
+        return parse_records(result.stdout)
+
+    def states(self, jobs: List[Any]) -> Dict[Any, str]:
+        """
+        Current state of submitted jobs from one sacct invocation, also set
+        as their `job_state`
+        """
+        submitted = [job for job in jobs if job.jobid is not None]
+        records = self.records([job.jobid for job in submitted])
+
+        states = {}
+        for job in submitted:
+            record = records.get(str(job.jobid))
+            if record is not None:
+                job.job_state = record['job_state']
+                states[job.jobid] = job.job_state
+        return states
+
+    def accounting(self, jobids: List[Any], fields: Tuple[str, ...]) -> str:
+        """
+        Raw `sacct --parsable2 --noheader` output of `fields` for `jobids`,
+        including job steps
+        """
+        result = self.client.run_commands(
+            [f"sacct --parsable2 --noheader --format={','.join(fields)} -j {','.join(str(j) for j in jobids)}"])[0]
+        if not result.ok:
+            raise IOError(f"sacct failed on {self.client.host}: {result.stderr.strip()}")
+        return result.stdout
@@ -2,7 +2,6 @@ import os
 import sys
 import pwd
 from typing import Optional, Dict, List, Callable, Any, Union
-import requests
 import importlib.resources as pkg_resources
 from pathlib import Path
 from subprocess import PIPE
@@ -10,14 +9,19 @@ import time
 from loguru import logger
 import subprocess
 import json
+import hashlib
+import asyncio
+from concurrent.futures import Future
 from collections import defaultdict
 
 import catena.lib as lib
 from catena.models.job_manifest import DependencyType
 from ..models import (SlurmSubmit, SlurmCluster, 
-                      SlurmModel, CatenaConfig)
-from catena.lib import env, _read_code, ContextTree
+                      SlurmModel, CatenaConfig, RetryPolicy, RightSizing)
+from catena.lib import env, _read_code, ContextTree, metrics
 from catena.lib.scripts import JobScript
+from .poller import JobPoller, JobResult, TERMINAL_STATES
+from .remote import RemoteSlurmBackend
 
 # specify logger level formats
 logger.add('logs/log_{time:YYYY-MM-DD}.log',
@@ -41,7 +45,9 @@ class SlurmJob:
     required to launch a job through the SLURM REST API programmatically, in
     Python. This type of SLURM `Job` is *best suited* for orchestrating work
     through the SLURM scheduler ***locally***, meaning this class is best used
-    in a script run on an HPC cluster with SLURM as the scheduler.
+    in a script run on an HPC cluster with SLURM as the scheduler. When the
+    cluster profile defines an `ssh_host`, jobs are instead submitted with
+    sbatch over SSH through a `RemoteSlurmBackend`.
 
     *This class is meant to be extended by other job types*
 
@@ -87,6 +93,20 @@ class SlurmJob:
         pyflake: if the defined `job_script` is a .py script, it will be flaked 
             for un-used imports before stored internally.
 
+        pack: mark the job as short running so that it can be packed together
+            with other short jobs into a single allocation (see `Jobs.pack`)
+
+        retry: [RetryPolicy](../models/retry.md) for resubmitting the job when
+            it ends in a transient failure state, for example NODE_FAIL or PREEMPTED
+
+        rightsize: [RightSizing](../models/rightsizing.md) policy for rewriting the
+            time limit and memory request from the recorded usage of earlier runs
+            of the same job fingerprint, requires `history` to be set
+
+        sidecar: wrap the job script so that it writes a completion record to
+            this directory (or to .catena/sidecar in the context root when `True`),
+            which the job poller watches instead of polling slurmrestd
+
     """
 
     job_options: SlurmSubmit = SlurmSubmit
@@ -106,11 +126,16 @@ class SlurmJob:
                  command: Optional[str] = None, 
                  jwt_lifespan: Optional[int] = 7200,
                  pyflake: Optional[bool] = True,
+                 pack: Optional[bool] = False,
+                 retry: Optional[Union[RetryPolicy, Dict[str, Any]]] = None,
+                 rightsize: Optional[Union[RightSizing, Dict[str, Any]]] = None,
+                 sidecar: Optional[Union[bool, str]] = None,
                  **kwargs
                 ):
         
         
         self.name: str = name
+        self.profile_name: str = profile
         self.profile: Union[str, SlurmCluster] = profile
         self.user: Optional[str] =user
         self.pyflake: Optional[bool] = pyflake
@@ -118,6 +143,14 @@ class SlurmJob:
         self.command: Optional[str]  = command
         self.dependencies = dependencies
         self.depmap = defaultdict(list)
+        self.pack = bool(pack)
+        self.retry: Optional[RetryPolicy] = RetryPolicy(**retry) if isinstance(retry, dict) else retry
+        self.attempts: List[Any] = []
+        self.run_id: Optional[str] = None
+        self.dependents: List['SlurmJob'] = []
+        self.rightsize: Optional[RightSizing] = (RightSizing(**rightsize)
+                                                 if isinstance(rightsize, dict) else rightsize)
+        self.history = None
 
         # if context not set, set context root to callable path
         if not env.CONTEXT_ROOT:
@@ -129,12 +162,17 @@ class SlurmJob:
                     self.job_script = str(Path(env.CONTEXT_ROOT) / self.job_script)
 
 
+        if sidecar is True:
+            sidecar = Path(env.CONTEXT_ROOT or os.getcwd()) / '.catena' / 'sidecar'
+        self.sidecar: Optional[str] = str(sidecar) if sidecar else None
+
         # check if path exists and read in - in remote job overload this 
         # attribute and check if path is remote or local
         if isinstance(self.job_script, str):
             self.job_script_args: Optional[List[str]] = job_script_args
             with JobScript(self.job_script, 
-                    job_script_args=self.job_script_args, command=command) as code:
+                    job_script_args=self.job_script_args, command=command,
+                    sidecar=self.sidecar) as code:
                 self.script = code.script
                 self.code = code
 
@@ -146,7 +184,9 @@ class SlurmJob:
 
         
         self.__lifespan: Optional[int] = jwt_lifespan
-        self.token = self.generate_token()
+        self.backend: Optional[RemoteSlurmBackend] = (RemoteSlurmBackend.for_profile(self.profile)
+                                                      if self.profile.ssh_host else None)
+        self.token = self.generate_token() if self.backend is None else None
         
         
         # build request url
@@ -173,6 +213,7 @@ class SlurmJob:
                                             name=self.name, dependency=self.depstr, 
                                             **kwargs), script=self.script)
         self.jobid = None
+        self.submit_time: Optional[float] = None
         self.monitor_polls = 0
         self.job_monitor = {}
 
@@ -322,62 +363,194 @@ class SlurmJob:
         return depstr.strip(',')
                 
 
-    def submit(self, job_monitor: Optional[bool]=False, delay: Optional[int]=0):
+    def submit(self, job_monitor: Optional[bool]=False, delay: Optional[int]=0,
+               future: Optional[bool]=False) -> Optional[Future]:
         """
         Submit a simple local script
 
         Need to check for shebangs #! in script (needed)
         Need to load the right environment modules to run the script
         remote submit should have options to copy local data to remote cluster in working directory for job
+
+        When `future=True` a `concurrent.futures.Future` is returned that resolves
+        to the final `JobResult` of the job (see `SlurmJob.future`)
         """
-        response = requests.post(self.url, data=json.dumps(self.request.dict(exclude_unset=True)), headers=self.slurm_header)
-        self.response = json.loads(response.content)
-        self.jobid = self.response['job_id']
+        if self.rightsize is not None and self.history is not None and not self.attempts:
+            self.right_size()
+
+        # upstream jobids are only known once they have been submitted
+        if self.depmap:
+            self.request.job.dependency = self.depstr
+
+        with metrics.SUBMIT_LATENCY.time():
+            if self.backend is not None:
+                errors = self.backend.submit_level([self])
+                if errors:
+                    raise RuntimeError(f"sbatch rejected job {self.name}: {errors[self.name]}")
+            else:
+                response = metrics.request('POST', self.url, data=json.dumps(self.request.dict(exclude_unset=True)),
+                                           headers=self.slurm_header)
+                self.response = json.loads(response.content)
+                self.jobid = self.response['job_id']
+
+        self.submit_time = time.time()
 
         if delay > 0: 
             time.sleep(delay)
 
+        if future:
+            return self.future()
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Hash of the job script and its sbatch options, excluding the name,
+        environment, dependencies and the resource requests that are rewritten
+        by right-sizing, so that repeated runs of the same job share a history
+        """
+        options = self.request.job.dict(exclude_none=True, exclude={
+            'name', 'environment', 'dependency', 'time_limit',
+            'memory_per_node', 'memory_per_cpu', 'memory_per_gpu'})
+        content = json.dumps({'script': self.script, 'options': options},
+                             sort_keys=True, default=str)
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def right_size(self):
+        """
+        Rewrite the time limit and memory request of the job from the recorded
+        usage of its fingerprint in `history`, as defined by the `rightsize` policy
+        """
+        usage = self.history.usage(self.fingerprint, percentile=self.rightsize.percentile)
+        changes = self.rightsize.apply(self.request.job, usage)
+        for field, (old, new) in changes.items():
+            logger.info(f"Right-sized {field} of {self.name} from {old} to {new} "
+                        f"({usage['samples']} recorded runs)")
+        return changes
+
+    @property
+    def attempt(self) -> int:
+        """
+        Number of the current submission of this job, starting at 1
+        """
+        return len(self.attempts) + 1
+
+    def can_retry(self, state: str) -> bool:
+        """
+        Whether the retry policy allows resubmitting the job after it ended in `state`
+        """
+        return self.retry is not None and self.retry.should_retry(state, self.attempt)
+
+    def resubmit(self, state: str):
+        """
+        Resubmit the job after it ended in the retryable `state`, bumping its
+        resources as defined by the retry policy, and rewire the dependencies
+        of downstream jobs to the new jobid
+        """
+        self.retry.bump(self.request.job, state)
+        self.attempts.append({'jobid': self.jobid, 'state': state, 'time': time.time()})
+
+        previous = self.jobid
+        if self.backend is None:
+            self.token = self.generate_token()
+            self.slurm_header = self.request_header()
+        self.submit()
+        logger.warning(f"Job {previous} ended in {state}, resubmitted as {self.jobid} "
+                       f"(attempt {self.attempt}/{self.retry.max_attempts})")
+
+        for job in self.dependents:
+            job.rewire()
+
+    def rewire(self):
+        """
+        Point the dependencies of this job at the current jobids of its
+        upstream jobs, updating the job in SLURM if it is already submitted
+        """
+        self.request.job.dependency = self.depstr
+        if self.jobid is None or getattr(self, 'job_state', None) in TERMINAL_STATES:
+            return
+
+        if self.backend is not None:
+            self.backend.update_dependency(self)
+            return
+
+        url = f"{self.protocol}://{self.host}:{self.port}/slurm/v{self.api_version}/job/{self.jobid}"
+        response = metrics.request('POST', url, data=json.dumps({'dependency': self.depstr}),
+                                   headers=self.request_header())
+        if not response.ok:
+            logger.error(f"Could not update dependencies of job {self.jobid}: {response.text}")
+
+    def future(self) -> Future:
+        """
+        Return a future resolving to the final state, exit code and accounting
+        record of the submitted job. Futures of all jobs are resolved by one
+        shared background poller (`JobPoller`), so no thread is held per job.
+        """
+        return JobPoller.instance().watch(self)
+
+    async def result(self) -> JobResult:
+        """
+        Await the final `JobResult` of the submitted job from a running event
+        loop, e.g. `await asyncio.gather(*(job.result() for job in jobs))`
+        """
+        return await asyncio.wrap_future(self.future())
+
     def monitor(self, poll_time=5):
-        
-      
-        self.monitor_url =  f"{self.protocol}://{self.host}:{self.port}/slurm/v{self.api_version}/job/{self.jobid}"
-        response = requests.get(self.monitor_url, headers=self.request_header())
-        self.jwt_elapsed_time = time.time() - self.jwt_start_time
-        try: 
-            self.job_state = response['job_state']
+        """
+        Poll the state of the submitted job until it ends, resubmitting it as
+        long as its retry policy allows
+
+        Returns:
+            final state of the job and the number of polls
+        """
+        while True:
+            self.monitor_polls += 1
+            if self.backend is not None:
+                # no slurmrestd behind an SSH profile, the state comes from sacct
+                self.job_state = self.backend.states([self]).get(self.jobid)
+            else:
+                self.monitor_url =  f"{self.protocol}://{self.host}:{self.port}/slurm/v{self.api_version}/job/{self.jobid}"
+                response = metrics.request('GET', self.monitor_url, headers=self.request_header())
+                try:
+                    self.job_state = response.json()['jobs'][0]['job_state']
+                except (ValueError, KeyError, IndexError):
+                    self.job_state = None
+
+            if self.job_state is None:
+                if self.backend is not None:
+                    # sacct may lag behind a fresh submission
+                    logger.warning(f"Job {self.jobid} not yet known to sacct on {self.backend.client.host}")
+                    time.sleep(poll_time)
+                    continue
+
+                logger.error("Job state not found")
+
+                # generate new jwt token if expired
+                if self.jwt_token_expired:
+                    logger.error(f"JWT token has expired ({self.jwt_elapsed_time} >= {self.jwt_lifespan})")
+                    logger.info("Generating a new token")
+                    self.token = self.generate_token()
+                    continue
+
+                logger.error(f"Somethings not right here ... check if job {self.jobid} exists in SLURM DB")
+                exit(1)
+
             self._state[self.name] = {'jobid': self.jobid, 'state': self.job_state}
-            if self.job_state == "QUEUED":
-                logger.info(f"Job {self.jobid} is currently: {self.job_state}")
-                time.sleep(poll_time*2)
-                self.monitor()
-
-            if self.job_state == "RUNNING":
-                logger.info(f"Job {self.jobid} is currently: {self.job_state}")
-                time.sleep(poll_time)
-                self.monitor()
-            
-            if (self.job_state == "COMPLETED" or
-                self.job_state == "CANCELLED"):
+
+            if self.job_state in ("COMPLETED", "CANCELLED"):
                 logger.info(f"Job {self.jobid} has changed state to: {self.job_state}")
                 return self.job_state, self.monitor_polls
 
-            if (self.job_state == "TIMEOUT" or 
-                self.job_state == "FAILED"):
+            if self.job_state in TERMINAL_STATES and self.can_retry(self.job_state):
+                time.sleep(self.retry.delay(self.attempt))
+                self.resubmit(self.job_state)
+                continue
+
+            if self.job_state in TERMINAL_STATES:
                 logger.error(f"Job {self.jobid} has changed state to: {self.job_state}")
                 return self.job_state, self.monitor_polls
-        
-        except KeyError:
-            logger.error("Job state not found")
-
-            # generate new jwt token if expired
-            if self.jwt_token_expired:
-                logger.error(f"JWT token has expired ({self.jwt_elapsed_time} >= {self.jwt_lifespan})")
-                logger.info("Generating a new token")
 
-
-            else:
-                logger.error("Somethings not right here ... check if job {self.jobid} exists in SLURM DB")
-                exit(1)
+            logger.info(f"Job {self.jobid} is currently: {self.job_state}")
+            time.sleep(poll_time * 2 if self.job_state in ("PENDING", "QUEUED") else poll_time)
 
 
     def generate_token(self, encoding='utf-8'):
@@ -389,6 +562,7 @@ class SlurmJob:
             # generate jwt token        
             process = subprocess.Popen(['scontrol', 'token', f'lifespan={self.__lifespan}'], stdout=PIPE, stderr=PIPE)
             raw, err = process.communicate()
+            metrics.TOKEN_REFRESHES.inc()
         
             # start token expiry timer
             self._token_info.setdefault('jwt_start_time', time.time())
@@ -0,0 +1,445 @@
+import os
+import re
+import json
+import time
+import subprocess
+from subprocess import PIPE
+from datetime import datetime
+from pathlib import Path
+from collections import defaultdict
+from typing import Optional, Dict, List, Any, Iterable
+import numpy as np
+from loguru import logger
+
+from .metrics import request
+from catena.jobs.poller import list_jobs, TERMINAL_STATES
+
+
+# column name -> numpy dtype, string columns are dictionary encoded as int32
+COLUMNS = {
+    'jobid': 'int64',
+    'name': 'int32',
+    'fingerprint': 'int32',
+    'state': 'int32',
+    'exit_code': 'int16',
+    'elapsed': 'float32',
+    'cpu_time': 'float32',
+    'cpus': 'int32',
+    'req_mem': 'float32',
+    'max_rss': 'float32',
+    'time_limit': 'float32',
+    'queue_wait': 'float32',
+    'submit': 'float64',
+    'end': 'float64',
+}
+
+ENCODED = ('name', 'fingerprint', 'state')
+
+SACCT_FORMAT = ('JobIDRaw', 'JobName', 'State', 'ExitCode', 'ElapsedRaw', 'TotalCPU',
+                'AllocCPUS', 'ReqMem', 'MaxRSS', 'TimelimitRaw', 'Submit', 'Start', 'End')
+
+_UNITS = {'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 ** 2, 'P': 1024 ** 3}
+
+
+def _megabytes(value: str) -> float:
+    """
+    Convert sacct memory values (e.g. 1234K, 2G, 4000Mn, 2Gc) to megabytes
+    """
+    match = re.match(r'^(\d+(?:\.\d+)?)([KMGTP]?)', value or '')
+    if match is None:
+        return np.nan
+    number, unit = match.groups()
+    return float(number) * _UNITS[unit or 'M']
+
+
+def _seconds(value: str) -> float:
+    """
+    Convert sacct durations ([DD-[HH:]]MM:SS[.mmm]) to seconds
+    """
+    if not value:
+        return np.nan
+    days = 0
+    if '-' in value:
+        d, value = value.split('-', 1)
+        days = int(d)
+    parts = [float(p) for p in value.split(':')]
+    while len(parts) < 3:
+        parts.insert(0, 0.0)
+    hours, minutes, seconds = parts
+    return days * 86400 + hours * 3600 + minutes * 60 + seconds
+
+
+def _timestamp(value: str) -> float:
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _number(value: str, default=np.nan) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_sacct(output: str) -> List[dict]:
+    """
+    Parse `sacct --parsable2 --noheader` output in `SACCT_FORMAT` into one
+    record per job. MaxRSS is only reported for job steps, so the peak over
+    all steps of a job is used.
+    """
+    jobs = {}
+    steps = []
+    for line in output.splitlines():
+        fields = line.split('|')
+        if len(fields) != len(SACCT_FORMAT):
+            continue
+        row = dict(zip(SACCT_FORMAT, fields))
+        if '.' in row['JobIDRaw']:
+            steps.append(row)
+            continue
+
+        submit = _timestamp(row['Submit'])
+        start = _timestamp(row['Start'])
+        jobs[row['JobIDRaw']] = {
+            'jobid': int(row['JobIDRaw'].split('_')[0]),
+            'name': row['JobName'],
+            'state': row['State'].split(' ')[0],
+            'exit_code': int(_number(row['ExitCode'].split(':')[0], 0)),
+            'elapsed': _number(row['ElapsedRaw']),
+            'cpu_time': _seconds(row['TotalCPU']),
+            'cpus': int(_number(row['AllocCPUS'], 0)),
+            'req_mem': _megabytes(row['ReqMem']),
+            'max_rss': _megabytes(row['MaxRSS']),
+            'time_limit': _number(row['TimelimitRaw']) * 60,
+            'queue_wait': start - submit,
+            'submit': submit,
+            'end': _timestamp(row['End']),
+        }
+
+    for step in steps:
+        job = jobs.get(step['JobIDRaw'].split('.')[0])
+        rss = _megabytes(step['MaxRSS'])
+        if job is not None and not np.isnan(rss):
+            job['max_rss'] = np.nanmax([job['max_rss'], rss])
+
+    return list(jobs.values())
+
+
+def fetch_sacct(jobids: Iterable[Any], batch_size: Optional[int] = 500, backend=None) -> List[dict]:
+    """
+    Fetch accounting records for `jobids` with one `sacct` call per batch,
+    run on the remote host of `backend` (a `RemoteSlurmBackend`) when given
+    """
+    jobids = [str(j) for j in jobids]
+    records = []
+    for i in range(0, len(jobids), batch_size):
+        batch = jobids[i:i + batch_size]
+        if backend is not None:
+            try:
+                records.extend(parse_sacct(backend.accounting(batch, SACCT_FORMAT)))
+            except IOError as error:
+                logger.error(f"sacct failed for {len(batch)} jobs: {error}")
+            continue
+        process = subprocess.Popen(['sacct', '--parsable2', '--noheader',
+                                    f"--format={','.join(SACCT_FORMAT)}",
+                                    '-j', ','.join(batch)], stdout=PIPE, stderr=PIPE)
+        raw, err = process.communicate()
+        if process.returncode != 0:
+            logger.error(f"sacct failed for {len(batch)} jobs: {err.decode().strip()}")
+            continue
+        records.extend(parse_sacct(raw.decode('utf-8')))
+    return records
+
+
+def fetch_slurmdb(job, jobids: Iterable[Any], start_time: Optional[float] = None) -> List[dict]:
+    """
+    Fetch accounting records for `jobids` from the slurmdbd REST endpoints,
+    using the connection and credentials of `job`, with a single request
+    limited to the jobs of the user submitted after `start_time`
+    """
+    wanted = {str(j) for j in jobids}
+    job.token = job.generate_token()
+    url = f"{job.protocol}://{job.host}:{job.port}/slurmdb/v{job.api_version}/jobs"
+    params = {'users': job.user}
+    if start_time is not None:
+        params['start_time'] = int(start_time)
+    response = request('GET', url, params=params, headers=job.request_header())
+    response.raise_for_status()
+
+    records = []
+    for rec in response.json().get('jobs', []):
+        if str(rec.get('job_id')) not in wanted:
+            continue
+        times = rec.get('time', {})
+        rss = [t.get('count', 0) / 1024 ** 2
+               for step in rec.get('steps', [])
+               for t in step.get('tres', {}).get('requested', {}).get('max', [])
+               if t.get('type') == 'mem']
+        records.append({
+            'jobid': int(rec['job_id']),
+            'name': rec.get('name', ''),
+            'state': rec.get('state', {}).get('current', ''),
+            'exit_code': rec.get('exit_code', {}).get('return_code', 0),
+            'elapsed': times.get('elapsed', np.nan),
+            'cpu_time': times.get('total', {}).get('seconds', np.nan),
+            'cpus': rec.get('required', {}).get('CPUs', 0),
+            'req_mem': rec.get('required', {}).get('memory', np.nan),
+            'max_rss': max(rss) if rss else np.nan,
+            'time_limit': times.get('limit', np.nan) * 60,
+            'queue_wait': times.get('start', np.nan) - times.get('submission', np.nan),
+            'submit': times.get('submission', np.nan),
+            'end': times.get('end', np.nan),
+        })
+    return records
+
+
+def list_submissions(job, since: float) -> List[dict]:
+    """
+    Jobs submitted on the cluster of `job` after `since`, from the accounting
+    database, which unlike slurmctld keeps finished jobs. Records have the
+    job_id, name, user_name and submit_time keys of the slurmrestd job
+    records. Jobs of a cluster reached over SSH are listed with `sacct -S`,
+    others through the slurmdbd REST endpoints, completed with the jobs
+    slurmctld still holds in case slurmdbd lags behind a submission.
+    """
+    backend = getattr(job, 'backend', None)
+    if backend is not None:
+        return list(backend.records(since=since).values())
+
+    job.token = job.generate_token()
+    url = f"{job.protocol}://{job.host}:{job.port}/slurmdb/v{job.api_version}/jobs"
+    response = request('GET', url, params={'users': job.user, 'start_time': int(since)},
+                       headers=job.request_header())
+    response.raise_for_status()
+
+    records = {str(rec['job_id']): {'job_id': rec['job_id'],
+                                    'name': rec.get('name', ''),
+                                    'user_name': rec.get('user', job.user),
+                                    'submit_time': rec.get('time', {}).get('submission')}
+               for rec in response.json().get('jobs', [])}
+    for jobid, rec in list_jobs(job).items():
+        records.setdefault(jobid, rec)
+    return list(records.values())
+
+
+class AccountingHistory:
+    """
+    Append-only columnar store of job accounting records. Each column is a
+    raw binary file of fixed width values that is memory-mapped on read, so
+    analytics over millions of historical jobs are vectorised NumPy scans
+    that never build per job Python objects. String columns are dictionary
+    encoded. The row count in `meta.json` is updated after the columns are
+    written, so a crash during an append never exposes a partial row.
+
+    Attributes:
+        path: store directory, **defaults to .catena/history in the current
+            working directory**
+    """
+
+    def __init__(self, path: Optional[str] = None):
+
+        if path is None:
+            path = Path.cwd() / '.catena' / 'history'
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        self.meta = {'rows': 0, 'dictionaries': {c: [] for c in ENCODED}}
+        if (self.path / 'meta.json').is_file():
+            with open(self.path / 'meta.json', 'r') as f:
+                self.meta = json.load(f)
+        for c in ENCODED:
+            self.meta['dictionaries'].setdefault(c, [])
+
+        self._codes = {c: {v: i for i, v in enumerate(self.meta['dictionaries'][c])}
+                       for c in ENCODED}
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def __encode(self, column: str, value: str) -> int:
+        codes = self._codes[column]
+        if value not in codes:
+            codes[value] = len(codes)
+            self.meta['dictionaries'][column].append(value)
+        return codes[value]
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        Read-only memory map of a column
+        """
+        if len(self) == 0:
+            return np.empty(0, dtype=COLUMNS[name])
+        return np.memmap(self.path / f"{name}.bin", dtype=COLUMNS[name],
+                         mode='r', shape=(len(self),))
+
+    def decode(self, name: str, codes: np.ndarray) -> np.ndarray:
+        """
+        Decode dictionary encoded values of a string column
+        """
+        return np.asarray(self.meta['dictionaries'][name], dtype=object)[codes]
+
+    def code(self, name: str, value: str) -> int:
+        """
+        Dictionary code of `value` in a string column, -1 if unknown
+        """
+        return self._codes[name].get(value, -1)
+
+    def known(self, jobids: Iterable[Any]) -> np.ndarray:
+        """
+        Boolean mask of the `jobids` already in the store, from a vectorised
+        scan of the jobid column
+        """
+        jobids = np.asarray([int(j) for j in jobids], dtype=COLUMNS['jobid'])
+        if len(self) == 0:
+            return np.zeros(len(jobids), dtype=bool)
+        return np.isin(jobids, self.column('jobid'))
+
+    def append(self, records: List[dict]) -> int:
+        """
+        Append accounting records, skipping jobs already in the store.
+        Returns the number of rows added.
+        """
+        known = self.known(r['jobid'] for r in records)
+        records = [r for r, seen in zip(records, known) if not seen]
+        if not records:
+            return 0
+
+        rows = len(self)
+        for name, dtype in COLUMNS.items():
+            if name in ENCODED:
+                values = [self.__encode(name, r.get(name, '')) for r in records]
+            else:
+                values = [r.get(name, np.nan if 'float' in dtype else 0) for r in records]
+            data = np.asarray(values, dtype=np.float64 if 'float' in dtype else None)
+
+            fpath = self.path / f"{name}.bin"
+            itemsize = np.dtype(dtype).itemsize
+            with open(fpath, 'ab') as f:
+                size = f.tell()
+                if size < rows * itemsize:
+                    # column added after the store was created
+                    fill = self.__encode(name, '') if name in ENCODED else (
+                        np.nan if 'float' in dtype else 0)
+                    f.write(np.full(rows - size // itemsize, fill, dtype=dtype).tobytes())
+                # drop bytes of a previous interrupted append
+                f.truncate(rows * itemsize)
+                f.write(data.astype(dtype).tobytes())
+
+        self.meta['rows'] = rows + len(records)
+        tmp = self.path / '.meta.json.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path / 'meta.json')
+        return len(records)
+
+    def mask(self, **equals) -> np.ndarray:
+        """
+        Boolean row mask of records matching all `column=value` filters
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for name, value in equals.items():
+            if name in ENCODED:
+                value = self.code(name, value)
+            mask &= self.column(name) == value
+        return mask
+
+    def utilisation(self, **equals) -> Dict[str, float]:
+        """
+        Aggregate utilisation of the records matching `equals` (see `mask`):
+        CPU efficiency (CPU time over allocated core time), memory efficiency
+        (peak RSS over requested memory), time limit usage and queue wait
+        """
+        mask = self.mask(**equals)
+        if not mask.any():
+            return {}
+
+        elapsed = self.column('elapsed')[mask].astype(np.float64)
+        cpus = self.column('cpus')[mask].astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cpu_eff = self.column('cpu_time')[mask] / (elapsed * cpus)
+            mem_eff = self.column('max_rss')[mask] / self.column('req_mem')[mask]
+            time_eff = elapsed / self.column('time_limit')[mask]
+
+        return {
+            'jobs': int(mask.sum()),
+            'cpu_efficiency': float(np.nanmean(np.where(np.isfinite(cpu_eff), cpu_eff, np.nan))),
+            'memory_efficiency': float(np.nanmean(np.where(np.isfinite(mem_eff), mem_eff, np.nan))),
+            'time_limit_usage': float(np.nanmean(np.where(np.isfinite(time_eff), time_eff, np.nan))),
+            'queue_wait_median': float(np.nanmedian(self.column('queue_wait')[mask])),
+            'core_hours': float(np.nansum(elapsed * cpus) / 3600),
+        }
+
+    def usage(self, fingerprint: str, percentile: Optional[float] = 95) -> Dict[str, float]:
+        """
+        Percentiles of the runtime (seconds) and peak memory (megabytes) of
+        the completed runs of a job fingerprint, and the median allocated CPUs
+        """
+        mask = self.mask(fingerprint=fingerprint, state='COMPLETED')
+        samples = int(mask.sum())
+        if samples == 0:
+            return {'samples': 0}
+
+        elapsed = self.column('elapsed')[mask]
+        max_rss = self.column('max_rss')[mask]
+        return {
+            'samples': samples,
+            'elapsed': float(np.nanpercentile(elapsed, percentile)) if np.isfinite(elapsed).any() else None,
+            'max_rss': float(np.nanpercentile(max_rss, percentile)) if np.isfinite(max_rss).any() else None,
+            'cpus': float(np.median(self.column('cpus')[mask])),
+        }
+
+    def ingest(self, jobs: List[Any], source: Optional[str] = 'sacct',
+               batch_size: Optional[int] = 500) -> int:
+        """
+        Bulk-fetch and append accounting records of finished jobs. Records of
+        jobs that have not reached a terminal state are not stored, as the
+        store is append-only, and are fetched again by a later ingest. Jobs
+        submitted over SSH always use sacct on their remote host.
+
+        Args:
+            jobs: submitted jobs (e.g. `SlurmJob` instances)
+            source: (sacct|slurmdb) fetch records with `sacct --parsable2` or
+                from the slurmdbd REST endpoints
+            batch_size: number of jobs fetched per request
+        """
+        submitted = [j for j in jobs if j.jobid is not None]
+        known = self.known(j.jobid for j in submitted)
+        pending = [j for j, seen in zip(submitted, known) if not seen]
+        if not pending:
+            return 0
+
+        start = time.time()
+        records = []
+        local, remote = [], defaultdict(list)
+        for job in pending:
+            if getattr(job, 'backend', None) is not None:
+                remote[id(job.backend)].append(job)
+            else:
+                local.append(job)
+        for group in remote.values():
+            records.extend(fetch_sacct([j.jobid for j in group], batch_size=batch_size,
+                                       backend=group[0].backend))
+
+        if source == 'slurmdb':
+            for i in range(0, len(local), batch_size):
+                batch = local[i:i + batch_size]
+                # an hour of margin for clock skew between the submit host and slurmdbd
+                submit_times = [j.submit_time for j in batch if getattr(j, 'submit_time', None)]
+                start_time = min(submit_times) - 3600 if submit_times else None
+                records.extend(fetch_slurmdb(batch[0], [j.jobid for j in batch], start_time=start_time))
+        elif local:
+            records.extend(fetch_sacct([j.jobid for j in local], batch_size=batch_size))
+
+        records = [r for r in records if r['state'] in TERMINAL_STATES]
+
+        fingerprints = {int(j.jobid): getattr(j, 'fingerprint', '') for j in pending}
+        for record in records:
+            record['fingerprint'] = fingerprints.get(record['jobid'], '')
+
+        added = self.append(records)
+        logger.info(f"Ingested accounting of {added} jobs in {time.time() - start:.2f}s")
+        return added
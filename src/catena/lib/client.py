@@ -1,18 +1,29 @@
+import io
 import os
 import sys
 import pwd
+import shlex
+import posixpath
 from pathlib import Path
-from typing import Type, Optional
+from typing import Type, Optional, List, Dict, Callable, Union
 from setuptools.command.easy_install import chmod, current_umask
 from os import system
 from scp import SCPClient, SCPException
-from paramiko import SSHClient, AutoAddPolicy, RSAKey
+from paramiko import SSHClient, SFTPClient, AutoAddPolicy, RSAKey
 from paramiko.auth_handler import AuthenticationException, SSHException
 from loguru import logger
 
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP
 
+from .transfer import TransferEngine, TransferStats, tar_upload, tar_download
+from .sync import sync_directory, SyncResult
+from .pool import SSHPool, PooledConnection, PoolKey
+from .commands import CommandResult, CommandStream, run_command, run_commands
+from .resumable import ResumableTransfer
+from .remotefs import RemoteFileCache, RemoteStat
+from .envelope import encrypt_stream, decrypt_stream, is_envelope, CHUNK_SIZE
+
 # specify logger level formats
 logger.add(sys.stderr,
            format="{time} {level} {message}",
@@ -113,7 +124,7 @@ class RSAKeyPair:
                                export: Optional[bool] = True):
         mask = current_umask()
         key = RSA.generate(bits)
-        pubkey = key.publicKey()
+        pubkey = key.publickey()
 
         if self.__write_keys:
             with p.open(mode='wb') as priv:
@@ -139,44 +150,48 @@ class RSAKeyPair:
     
 
     def encrypt_to_file(self, secret, filepath:str):
-        encrypted = self.encrypt(secret)
-        
+        """
+        Write `secret` to an envelope file, see `encrypt_file`
+        """
         with open(filepath, 'wb') as f:
-            f.write(encrypted)
+            encrypt_stream(self.pubkey, io.BytesIO(secret.encode()), f)
     
 
     def decrypt_file(self, filepath, to_file=False):
         """
-        Decrypt file using GPG key and return as string or 
-        write to new decrypted file.
+        Decrypt file and return as string or stream it to a new
+        decrypted file. Files holding a single RSA-OAEP ciphertext,
+        as written before envelopes, are still read.
         """
 
         with open(filepath, 'rb') as f:
-            encrypted_data = f.read()
-        
-        decrypted_data = self.decrypt(encrypted_data)
-
-        if to_file:
-            _file = filepath + '.unlocked'
-            with open(_file, 'w') as f:
-                f.write(decrypted_data)
-        else:
-            return decrypted_data
+            if not is_envelope(f):
+                decrypted_data = self.decrypt(f.read())
+                if not to_file:
+                    return decrypted_data
+                with open(filepath + '.unlocked', 'w') as out:
+                    out.write(decrypted_data)
+                return
+
+            if to_file:
+                with open(filepath + '.unlocked', 'wb') as out:
+                    decrypt_stream(self.privkey, f, out)
+            else:
+                out = io.BytesIO()
+                decrypt_stream(self.privkey, f, out)
+                return out.getvalue().decode()
     
 
-    def encrypt_file(self, filepath, remove_insecure=True):
+    def encrypt_file(self, filepath, remove_insecure=True, chunk_size: Optional[int] = CHUNK_SIZE):
         """
-        Encrypt an existing file using GPG key ring
+        Encrypt an existing file of any size to `<filepath>.locked`. The
+        file is streamed in chunks through AES-GCM under a random data key
+        that is wrapped with the RSA public key, so memory use does not
+        grow with the file size.
         """
-
-        with open(filepath, 'r') as f:
-            data = f.read()
-        
-        encrypted_data = self.encrypt(data)
-
         _file = filepath + '.locked'
-        with open(_file, 'wb') as f:
-            f.write(encrypted_data)
+        with open(filepath, 'rb') as f, open(_file, 'wb') as out:
+            encrypt_stream(self.pubkey, f, out, chunk_size=chunk_size)
         
         if remove_insecure:
             Path(filepath).unlink()
@@ -187,7 +202,9 @@ class RemoteClient:
     """
     Remote host Client object to handle connections and actions.
     The Client object is specifically for interacting with a 
-    remote host via SSH and SCP using Paramiko
+    remote host via SSH and SCP using Paramiko. Connections are
+    taken from the process wide `SSHPool`, so clients for the same
+    host, user and key share authenticated transports.
     """
 
     keypair = RSAKeyPair
@@ -198,7 +215,8 @@ class RemoteClient:
                  ssh_keydir=None,
                  ssh_pubkey_filename='id_rsa.pub',
                  ssh_privkey_filename='id_rsa',
-                 remote_workdir=None):
+                 remote_workdir=None,
+                 pool: Optional[SSHPool] = None):
                  
         self.host = host
         self.user = user
@@ -222,8 +240,11 @@ class RemoteClient:
         self.remote_keys_accesible = False
         self.client = None
         self.scp = None
+        self.pool = pool or SSHPool.instance()
 
         self.__connected = False
+        self.__connection: Optional[PooledConnection] = None
+        self.__file_cache: Optional[RemoteFileCache] = None
     
 
     def __enter__(self):
@@ -240,6 +261,11 @@ class RemoteClient:
         return self.keypair.privkey
 
 
+    @property
+    def pool_key(self) -> PoolKey:
+        return (self.host, self.user, str(self.ssh_pubkey_filepath))
+
+
     @property
     def pubkey(self):
         return self.keypair.pubkey
@@ -257,18 +283,24 @@ class RemoteClient:
                 logger.error(error) 
 
 
+    def __open_client(self) -> SSHClient:
+        client = SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(AutoAddPolicy())
+        client.connect(self.host,
+                       username=self.user,
+                       key_filename=str(self.ssh_pubkey_filepath),
+                       look_for_keys=True,
+                       timeout=5000)
+        return client
+
+
     def __connect(self):
         """Open connection to remote host."""
         if not self.__connected:
             try:
-                self.client = SSHClient()
-                self.client.load_system_host_keys()
-                self.client.set_missing_host_key_policy(AutoAddPolicy())
-                self.client.connect(self.host,
-                                    username=self.user,
-                                    key_filename=str(self.ssh_pubkey_filepath),
-                                    look_for_keys=True,
-                                    timeout=5000)
+                self.__connection = self.pool.lease(self.pool_key, self.__open_client)
+                self.client = self.__connection.client
                 self.scp = SCPClient(self.client.get_transport())  # For later
             except AuthenticationException as error:
                 logger.info('Authentication failed: did you remember to create an SSH key?')
@@ -286,11 +318,18 @@ class RemoteClient:
         Disconnect from remote client
         """
 
-        self.client.close()
-        self.scp.close()
+        if self.scp is not None:
+            self.scp.close()
+        if self.__connection is not None:
+            # the connection stays open in the pool until it is idle
+            self.pool.release(self.__connection)
+        self.__connection = None
+        self.__connected = False
+        self.client = None
+        self.scp = None
 
 
-    def execute_command(self, commands:list) -> None:
+    def execute_command(self, commands:list) -> List[CommandResult]:
         """
         Execute multiple commands on remote client
 
@@ -299,50 +338,247 @@ class RemoteClient:
 
             >>> e.g. ['cd /var/www/ && ls','ps aux | grep node']
 
-        Commands will be executed in order they are listed
+        Commands will be executed in order they are listed, their output
+        is logged line by line as it arrives
         """
-        if self.client is None:
-            self.client = self.__connect()
+        results = []
+        with self.pool.transport(self.pool_key, self.__open_client) as transport:
+            for cmd in commands:
+                results.append(run_command(transport, cmd, capture=False,
+                                           on_stdout=lambda line: logger.info(f'INPUT: {cmd} | OUTPUT: {line}')))
+        return results
+
+
+    def run_commands(self,
+                     commands: List[str],
+                     parallel: Optional[int] = 8,
+                     on_stdout: Optional[Callable[[str, str], None]] = None,
+                     on_stderr: Optional[Callable[[str, str], None]] = None,
+                     capture: Optional[bool] = True,
+                     timeout: Optional[float] = None) -> List[CommandResult]:
+        """
+        Execute commands concurrently, each on its own channel of a pooled
+        connection, and return their results in order. Output lines are
+        passed to on_stdout/on_stderr as (command, line) while the commands
+        run; with capture=False output is not kept in memory.
+
+        >>> results = client.run_commands(['md5sum big.h5', 'du -sh data'])
+        >>> [r.exit_status for r in results]
+        """
+        def _transport():
+            return self.pool.transport(self.pool_key, self.__open_client)
+
+        return run_commands(_transport, commands, parallel=parallel, on_stdout=on_stdout,
+                            on_stderr=on_stderr, capture=capture, timeout=timeout)
+
+
+    def run(self, command: str, stdin: Optional[bytes] = None, timeout: Optional[float] = None) -> CommandResult:
+        """
+        Run one command on a pooled connection and capture its output
+        """
+        with self.pool.transport(self.pool_key, self.__open_client) as transport:
+            return run_command(transport, command, stdin=stdin, timeout=timeout)
+
 
+    @property
+    def file_cache(self) -> RemoteFileCache:
+        """
+        Cache of remote directory listings and checksums, see `RemoteFileCache`
+        """
+        if self.__file_cache is None:
+            self.__file_cache = RemoteFileCache(self)
+        return self.__file_cache
 
-        for cmd in commands:
-            stdin, stdout, stderr = self.client.exec_command(cmd)
-            stdout.channel.recv_exit_status()
-            response = stdout.readlines()
-            for line in response:
-                logger.info(f'INPUT: {cmd} | OUTPUT: {line}')
+
+    def stat(self, paths: List[str], checksum: Optional[bool] = False) -> Dict[str, RemoteStat]:
+        """
+        Stat results of many remote paths, with their sha256 digests when
+        `checksum` is set, from a single helper execution on the remote host.
+        Repeated lookups in the same directories are served from the cache.
+
+        >>> client.stat(['data/a.h5', 'data/b.h5'], checksum=True)['data/a.h5'].digest
+        """
+        return self.file_cache.stat(paths, checksum=checksum)
 
 
-    def bulk_dir_upload(self, dirs):
+    def exists(self, paths: List[str]) -> Dict[str, bool]:
+        return self.file_cache.exists(paths)
+
+
+    def stream_command(self, command: str, timeout: Optional[float] = None) -> CommandStream:
+        """
+        Async iterator over the (stream, line) output of a command, see `CommandStream`
+        """
+        def _transport():
+            return self.pool.transport(self.pool_key, self.__open_client)
+
+        return CommandStream(_transport, command, timeout=timeout)
+
+
+    @property
+    def remote_path(self) -> str:
+        return self.remote_workdir or '.'
+
+
+    def transfer_engine(self, channels: Optional[int] = 4, transports: Optional[int] = 1,
+                        chunk_size: Optional[int] = 32768) -> TransferEngine:
+        """
+        Transfer engine running `channels` concurrent SFTP sessions on pooled
+        connections. The sessions are spread over at least `transports` SSH
+        connections, which helps when one connection is limited by its
+        window size or by the cipher running on one core; more connections
+        are opened when all channel slots of the existing ones are in use.
+        """
+        def _open_sftp() -> SFTPClient:
+            return self.pool.open_sftp(self.pool_key, self.__open_client, connections=transports)
+
+        return TransferEngine(_open_sftp, channels=channels, chunk_size=chunk_size)
+
+
+    def bulk_dir_upload(self, dirs, channels: Optional[int] = 4, sync: Optional[bool] = False,
+                        raise_on_error: Optional[bool] = True):
         # a set of paths that are iterated over in a for loop and then __single_dir_upload is run
         if self.client is None:
             self.client = self.__connect()
-        uploads = [self.upload_directory(d) for d in dirs]
+        uploads = [self.upload_directory(d, channels=channels, sync=sync, raise_on_error=raise_on_error)
+                   for d in dirs]
         logger.info(f'Uploaded {len(uploads)} directories to {self.remote_path} on {self.host}')
     
 
-    def upload_directory(self, source_dir, recursive=True):
+    def upload_directory(self, source_dir, recursive=True, channels: Optional[int] = 4,
+                         sync: Optional[bool] = False, checksum: Optional[bool] = False,
+                         delete: Optional[bool] = False,
+                         raise_on_error: Optional[bool] = True) -> Union[TransferStats, SyncResult]:
         """
-        Upload a directory of files. To upload any subdirectories within
-        source_dir, leave recursive=True
+        Upload a directory of files into remote_path/<source_dir name>,
+        keeping the layout of the files. To upload any subdirectories
+        within source_dir, leave recursive=True
+
+        With sync=True only new or changed files are uploaded, comparing
+        sizes and mtimes (or sha256 digests with checksum=True) with a
+        manifest of the remote directory, and remote files missing locally
+        are removed with delete=True. Returns a `SyncResult` in that case.
+
+        A failed file does not stop the other transfers, IOError is raised
+        once they are done, unless raise_on_error=False, in which case the
+        failures are only reported in the returned statistics.
         """
-        for root, dirs, files in os.walk(source_dir, topdown=True):
+        source_dir = Path(source_dir)
+        target = posixpath.join(self.remote_path, source_dir.resolve().name)
+        if sync:
+            if self.client is None:
+                self.client = self.__connect()
+            result = sync_directory(self.client, self.transfer_engine(channels=channels),
+                                    str(source_dir), target, recursive=recursive,
+                                    checksum=checksum, delete=delete)
+            if raise_on_error and result.stats is not None:
+                result.stats.raise_for_errors()
+            return result
+
+        files = []
+        for root, dirs, names in os.walk(source_dir, topdown=True):
             logger.info(f'Descending into directory {root}') 
-            self.bulk_file_upload([f"{root}/{f}" for f in files])
+            relative = Path(root).relative_to(source_dir).as_posix()
+            files.extend((f"{root}/{f}", posixpath.normpath(posixpath.join(target, relative, f)))
+                         for f in names)
             if not recursive:
-                return [f"{root}/{f}" for f in files]
+                break
+        stats = self.transfer_engine(channels=channels).upload(files)
+        if raise_on_error:
+            stats.raise_for_errors()
+        return stats
 
 
-    def bulk_file_upload(self, files):
-        """Upload multiple files to a remote directory."""
-        if self.client is None:
-            self.client = self.__connect()
-        uploads = [self.upload_file(file) for file in files]
-        logger.info(f'Uploaded {len(uploads)} files to {self.remote_path} on {self.host}')
+    def tar_upload(self, source_dir, compress: Optional[bool] = False,
+                   recursive: Optional[bool] = True, remote_dir=None) -> TransferStats:
+        """
+        Upload a directory into remote_dir, by default remote_path/<source_dir name>,
+        as a single tar stream, which is much faster than per-file transfers
+        for trees of many small files. Set compress=True on slow links.
+        """
+        target = remote_dir or posixpath.join(self.remote_path, Path(source_dir).resolve().name)
+        with self.pool.transport(self.pool_key, self.__open_client) as transport:
+            return tar_upload(transport, str(source_dir), target,
+                              compress=compress, recursive=recursive)
+
+
+    def tar_download(self, remote_dir, local_dir='.', compress: Optional[bool] = False) -> TransferStats:
+        """
+        Download a remote directory into local_dir/<remote_dir name> as a single tar stream
+        """
+        target = Path(local_dir) / posixpath.basename(posixpath.normpath(remote_dir))
+        with self.pool.transport(self.pool_key, self.__open_client) as transport:
+            return tar_download(transport, remote_dir, str(target), compress=compress)
+
+
+    def bulk_file_upload(self, files, channels: Optional[int] = 4,
+                         raise_on_error: Optional[bool] = True) -> TransferStats:
+        """Upload multiple files to a remote directory concurrently, raising IOError if any failed."""
+        engine = self.transfer_engine(channels=channels)
+        stats = engine.upload((file, posixpath.join(self.remote_path, Path(file).name))
+                              for file in files)
+        logger.info(f'Uploaded {stats.files} files to {self.remote_path} on {self.host}')
+        if raise_on_error:
+            stats.raise_for_errors()
+        return stats
+
+
+    def bulk_file_download(self, files, local_dir='.', channels: Optional[int] = 4,
+                           raise_on_error: Optional[bool] = True) -> TransferStats:
+        """Download multiple files from the remote host concurrently, raising IOError if any failed."""
+        engine = self.transfer_engine(channels=channels)
+        stats = engine.download((file, str(Path(local_dir) / posixpath.basename(file)))
+                                for file in files)
+        if raise_on_error:
+            stats.raise_for_errors()
+        return stats
+
+
+    def remote_sha256(self, path: str) -> str:
+        """sha256 hex digest of a remote file, computed on the remote host."""
+        with self.pool.transport(self.pool_key, self.__open_client) as transport:
+            result = run_command(transport, f"sha256sum {shlex.quote(path)}")
+        if not result.ok:
+            raise IOError(f"sha256sum of {path} failed: {result.stderr.strip()}")
+        return result.stdout.split()[0]
+
+
+    def resumable_transfer(self, chunk_size: Optional[int] = 64 << 20, parallel: Optional[int] = 4,
+                           verify: Optional[bool] = True) -> ResumableTransfer:
+        """
+        Chunked, checkpointed transfer of large files over pooled SFTP sessions, see `ResumableTransfer`
+        """
+        def _open_sftp() -> SFTPClient:
+            return self.pool.open_sftp(self.pool_key, self.__open_client)
+
+        return ResumableTransfer(_open_sftp, self.remote_sha256, chunk_size=chunk_size,
+                                 parallel=parallel, verify=verify)
+
+
+    def upload_large_file(self, file, remote_file=None, parallel: Optional[int] = 4,
+                          verify: Optional[bool] = True) -> TransferStats:
+        """
+        Upload a large file in checkpointed chunks, `parallel` chunks at a
+        time. An interrupted upload continues where it stopped when called
+        again, and the result is verified by comparing sha256 checksums.
+        """
+        remote_file = remote_file or posixpath.join(self.remote_path, Path(file).name)
+        return self.resumable_transfer(parallel=parallel, verify=verify).upload(str(file), remote_file)
+
+
+    def download_large_file(self, remote_file, file=None, parallel: Optional[int] = 4,
+                            verify: Optional[bool] = True) -> TransferStats:
+        """
+        Download a large file in checkpointed chunks, see `upload_large_file`
+        """
+        file = file or posixpath.basename(remote_file)
+        return self.resumable_transfer(parallel=parallel, verify=verify).download(remote_file, str(file))
 
 
     def upload_file(self, file):
         """Upload a single file to a remote directory."""
+        if self.client is None:
+            self.client = self.__connect()
         try:
             self.scp.put(file,
                          recursive=True,
@@ -0,0 +1,242 @@
+import time
+import codecs
+import select
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Tuple, Callable, ContextManager, NamedTuple, AsyncIterator
+
+from paramiko import Transport
+from loguru import logger
+
+
+LineCallback = Callable[[str], None]
+
+
+class CommandResult(NamedTuple):
+    """
+    Outcome of a remote command
+
+    Attributes:
+        command: command line executed
+        exit_status: exit status, -1 when the command timed out or the channel closed without one
+        stdout: captured standard output, None when not captured
+        stderr: captured standard error, None when not captured
+        started: wall clock time the command started
+        seconds: duration of the command
+    """
+    command: str
+    exit_status: int
+    stdout: Optional[str]
+    stderr: Optional[str]
+    started: float
+    seconds: float
+
+    @property
+    def ok(self) -> bool:
+        return self.exit_status == 0
+
+
+class _LineBuffer:
+    """
+    Incrementally decode a byte stream and emit complete lines
+    """
+
+    def __init__(self, callback: Optional[LineCallback], capture: bool):
+        self.callback = callback
+        self.captured = [] if capture else None
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._partial = ''
+
+    def feed(self, data: bytes, final: bool = False):
+        text = self._decoder.decode(data, final=final)
+        if self.captured is not None:
+            self.captured.append(text)
+        if self.callback is None:
+            return
+        *lines, self._partial = (self._partial + text).split('\n')
+        if final and self._partial:
+            lines.append(self._partial)
+            self._partial = ''
+        for line in lines:
+            self.callback(line)
+
+    @property
+    def text(self) -> Optional[str]:
+        return None if self.captured is None else ''.join(self.captured)
+
+
+def run_command(transport: Transport,
+                command: str,
+                on_stdout: Optional[LineCallback] = None,
+                on_stderr: Optional[LineCallback] = None,
+                capture: Optional[bool] = True,
+                timeout: Optional[float] = None,
+                stdin: Optional[bytes] = None,
+                chunk_size: Optional[int] = 1 << 15) -> CommandResult:
+    """
+    Run `command` on its own exec channel, passing each line of its output
+    to `on_stdout` and `on_stderr` as soon as it arrives. Output is only kept
+    in memory with `capture`.
+
+    Args:
+        transport: connected SSH transport
+        command: command line
+        on_stdout: called with every line of standard output
+        on_stderr: called with every line of standard error
+        capture: keep the output in the result
+        timeout: seconds after which the channel is closed and -1 returned
+        stdin: data sent to the standard input of the command, which should
+            consume all of it before writing much output
+        chunk_size: maximum number of bytes received at once
+    """
+    stdout = _LineBuffer(on_stdout, capture)
+    stderr = _LineBuffer(on_stderr, capture)
+    started, start = time.time(), time.perf_counter()
+    deadline = None if timeout is None else start + timeout
+
+    channel = transport.open_session()
+    try:
+        channel.exec_command(command)
+        if stdin:
+            channel.sendall(stdin)
+        channel.shutdown_write()
+        while True:
+            received = False
+            if channel.recv_ready():
+                stdout.feed(channel.recv(chunk_size))
+                received = True
+            if channel.recv_stderr_ready():
+                stderr.feed(channel.recv_stderr(chunk_size))
+                received = True
+            if received:
+                continue
+            if channel.exit_status_ready() or channel.closed:
+                # drain output that raced with the exit status
+                if not (channel.recv_ready() or channel.recv_stderr_ready()):
+                    break
+                continue
+            if deadline is not None and time.perf_counter() > deadline:
+                logger.warning(f"Command timed out after {timeout}s: {command}")
+                break
+            select.select([channel], [], [], 0.1)
+
+        timed_out = not (channel.exit_status_ready() or channel.closed)
+        exit_status = -1 if timed_out else channel.recv_exit_status()
+    finally:
+        channel.close()
+
+    stdout.feed(b'', final=True)
+    stderr.feed(b'', final=True)
+    return CommandResult(command, exit_status, stdout.text, stderr.text,
+                         started, time.perf_counter() - start)
+
+
+def run_commands(transport: Callable[[], ContextManager[Transport]],
+                 commands: List[str],
+                 parallel: Optional[int] = 8,
+                 on_stdout: Optional[Callable[[str, str], None]] = None,
+                 on_stderr: Optional[Callable[[str, str], None]] = None,
+                 capture: Optional[bool] = True,
+                 timeout: Optional[float] = None) -> List[CommandResult]:
+    """
+    Run commands concurrently, each on its own channel, and return their
+    results in the order of `commands`
+
+    Args:
+        transport: callable returning a context manager that provides a
+            transport for the duration of one command, e.g. a pooled channel slot
+        commands: command lines
+        parallel: maximum number of commands running at once
+        on_stdout: called with (command, line) for every line of standard output
+        on_stderr: called with (command, line) for every line of standard error
+        capture: keep the output in the results
+        timeout: seconds after which a command is abandoned
+    """
+    def _run(command: str) -> CommandResult:
+        with transport() as t:
+            return run_command(t, command,
+                               on_stdout=(lambda line: on_stdout(command, line)) if on_stdout else None,
+                               on_stderr=(lambda line: on_stderr(command, line)) if on_stderr else None,
+                               capture=capture, timeout=timeout)
+
+    if not commands:
+        return []
+    with ThreadPoolExecutor(max_workers=min(parallel, len(commands)),
+                            thread_name_prefix='catena-command') as executor:
+        return list(executor.map(_run, commands))
+
+
+class CommandStream:
+    """
+    Async iterator over the output of a remote command as (stream, line)
+    tuples, where stream is 'stdout' or 'stderr'. The command runs in a
+    thread and lines are handed to the event loop as they arrive; `result`
+    holds the `CommandResult` once iteration finished.
+
+    Example:
+
+        stream = client.stream_command('make -j8')
+        async for stream_name, line in stream:
+            print(stream_name, line)
+        print(stream.result.exit_status)
+    """
+
+    _END = object()
+
+    def __init__(self,
+                 transport: Callable[[], ContextManager[Transport]],
+                 command: str,
+                 timeout: Optional[float] = None,
+                 maxsize: Optional[int] = 10000):
+
+        self.transport = transport
+        self.command = command
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.result: Optional[CommandResult] = None
+        self.error: Optional[BaseException] = None
+
+    async def __aiter__(self) -> AsyncIterator[Tuple[str, str]]:
+        loop = asyncio.get_running_loop()
+        # unbounded, as the end marker is queued without a slot; the slots
+        # block the command thread while the consumer falls behind
+        queue = asyncio.Queue()
+        slots = threading.BoundedSemaphore(self.maxsize)
+        stop = threading.Event()
+
+        def _put(item):
+            while not stop.is_set():
+                if slots.acquire(timeout=0.5):
+                    loop.call_soon_threadsafe(queue.put_nowait, item)
+                    return
+            # the consumer went away, abandon the command and free its channel
+            raise asyncio.CancelledError()
+
+        def _run():
+            try:
+                with self.transport() as t:
+                    self.result = run_command(t, self.command,
+                                              on_stdout=lambda line: _put(('stdout', line)),
+                                              on_stderr=lambda line: _put(('stderr', line)),
+                                              capture=False, timeout=self.timeout)
+            except BaseException as error:
+                self.error = error
+            finally:
+                if not stop.is_set():
+                    loop.call_soon_threadsafe(queue.put_nowait, self._END)
+
+        thread = threading.Thread(target=_run, name='catena-command-stream', daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = await queue.get()
+                if item is self._END:
+                    break
+                slots.release()
+                yield item
+        finally:
+            stop.set()
+
+        if self.error is not None:
+            raise self.error
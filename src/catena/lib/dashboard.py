@@ -0,0 +1,211 @@
+import time
+import fnmatch
+import threading
+from collections import deque, Counter
+from typing import Optional, Dict, List, Any, Deque
+
+from rich.console import Console, Group
+from rich.live import Live
+from rich.table import Table
+from rich.panel import Panel
+from rich.text import Text
+
+from catena.jobs.poller import JobPoller, TERMINAL_STATES
+
+
+STATE_STYLES = {
+    'UNSUBMITTED': 'dim',
+    'PENDING': 'yellow',
+    'RUNNING': 'cyan',
+    'COMPLETING': 'cyan',
+    'COMPLETED': 'green',
+    'FAILED': 'bold red',
+    'CANCELLED': 'magenta',
+    'TIMEOUT': 'red',
+    'OUT_OF_MEMORY': 'red',
+    'NODE_FAIL': 'red',
+    'PREEMPTED': 'red',
+    'BOOT_FAIL': 'red',
+    'DEADLINE': 'red',
+}
+
+
+class StateTable:
+    """
+    Compact table of the latest state of each job, keyed by job name. Per
+    state counts are maintained incrementally as transitions are applied, and
+    only the most recent transitions are kept, so rendering a summary never
+    iterates over all jobs. The cells of a row are formatted once, when its
+    count changes or its transition arrives, and reused by later renders.
+
+    Attributes:
+        recent: number of recent transitions kept
+    """
+
+    def __init__(self, jobs: Optional[List[Any]] = None, recent: Optional[int] = 20):
+
+        self._states: Dict[str, str] = {}
+        self.counts: Counter = Counter()
+        self.transitions: Deque[dict] = deque(maxlen=recent)
+        self.version = 0
+        self._lock = threading.Lock()
+        self._count_rows: Dict[str, tuple] = {}
+        self._recent_rows: Deque[tuple] = deque(maxlen=recent)
+        self._changed = set()
+
+        for job in (jobs or []):
+            state = getattr(job, 'job_state', None)
+            if state is None:
+                state = 'PENDING' if job.jobid is not None else 'UNSUBMITTED'
+            self._states[job.name] = state
+            self.counts[state] += 1
+        self._changed.update(self.counts)
+
+    def __len__(self):
+        return len(self._states)
+
+    def done(self) -> bool:
+        """
+        Whether every submitted job reached a final state. Jobs that were
+        never submitted (e.g. after a failed submission) are not waited for.
+        """
+        with self._lock:
+            submitted = [s for s in self.counts if s != 'UNSUBMITTED']
+            return bool(submitted) and all(s in TERMINAL_STATES for s in submitted)
+
+    @staticmethod
+    def _transition_row(event: dict) -> tuple:
+        transition = Text(event.get('previous') or '-', style=STATE_STYLES.get(event.get('previous'), ''))
+        transition.append(' → ')
+        transition.append(event['state'], style=STATE_STYLES.get(event['state'], ''))
+        return (time.strftime('%H:%M:%S', time.localtime(event.get('time', time.time()))),
+                str(event.get('jobid')), event['name'], transition)
+
+    def apply(self, events: List[dict]):
+        """
+        Apply state transition events as published by `JobPoller.subscribe`
+        """
+        with self._lock:
+            for event in events:
+                previous = self._states.get(event['name'])
+                if previous == event['state']:
+                    continue
+                if previous is not None:
+                    self.counts[previous] -= 1
+                    if not self.counts[previous]:
+                        del self.counts[previous]
+                else:
+                    # the total changed, so does the share of every state
+                    self._changed.update(self.counts)
+                self._states[event['name']] = event['state']
+                self.counts[event['state']] += 1
+                self._changed.update((previous, event['state']))
+                self.transitions.appendleft(event)
+                self._recent_rows.appendleft(self._transition_row(event))
+            self.version += 1
+
+    def state(self, name: str) -> Optional[str]:
+        return self._states.get(name)
+
+    def names(self, pattern: str = '*', state: Optional[str] = None) -> List[str]:
+        """
+        Names of jobs matching a glob pattern, optionally only those in `state`
+        """
+        with self._lock:
+            return [n for n, s in self._states.items()
+                    if (state is None or s == state) and fnmatch.fnmatchcase(n, pattern)]
+
+    def render(self, title: Optional[str] = 'catena jobs') -> Panel:
+        """
+        Summary of per state counts and the most recent transitions
+        """
+        with self._lock:
+            total = len(self._states)
+            for state in self._changed:
+                count = self.counts.get(state)
+                if not count:
+                    self._count_rows.pop(state, None)
+                    continue
+                self._count_rows[state] = (Text(state, style=STATE_STYLES.get(state, '')), str(count),
+                                           f"{100 * count / total:.1f}" if total else '-')
+            self._changed.clear()
+            counts = sorted(self._count_rows.items(), key=lambda kv: (kv[0] in TERMINAL_STATES, kv[0]))
+            transitions = list(self._recent_rows)
+
+        summary = Table(expand=True, box=None, show_edge=False)
+        summary.add_column('State')
+        summary.add_column('Jobs', justify='right')
+        summary.add_column('%', justify='right')
+        for _, row in counts:
+            summary.add_row(*row)
+
+        recent = Table(expand=True, box=None, show_edge=False)
+        recent.add_column('Time', no_wrap=True)
+        recent.add_column('Job ID', no_wrap=True)
+        recent.add_column('Name', overflow='ellipsis', no_wrap=True)
+        recent.add_column('Transition', no_wrap=True)
+        for row in transitions:
+            recent.add_row(*row)
+
+        return Panel(Group(summary, Text(''), recent), title=f"{title} ({total})", expand=True)
+
+
+class Dashboard:
+    """
+    Live terminal dashboard of job states based on `rich.live`. Transitions
+    are received from the shared `JobPoller` and applied to a `StateTable`,
+    and the display is redrawn at most `refresh_per_second` times per second,
+    only when the table changed. The cost of a redraw depends on the number of
+    states and recent transitions shown, not on the number of jobs.
+
+    Attributes:
+        jobs: jobs shown on the dashboard
+
+        refresh_per_second: maximum number of redraws per second, **defaults to 4**
+
+        recent: number of recent transitions shown, **defaults to 20**
+    """
+
+    def __init__(self,
+                 jobs: Optional[List[Any]] = None,
+                 refresh_per_second: Optional[float] = 4,
+                 recent: Optional[int] = 20,
+                 console: Optional[Console] = None):
+
+        self.table = StateTable(jobs, recent=recent)
+        self.refresh_per_second = refresh_per_second
+        self.console = console or Console()
+        self._names = {job.name for job in (jobs or [])}
+        self._stop = threading.Event()
+
+    def _on_events(self, events: List[dict]):
+        if self._names:
+            events = [e for e in events if e['name'] in self._names]
+        if events:
+            self.table.apply(events)
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self, until_done: Optional[bool] = True):
+        """
+        Show the dashboard until `stop` is called, or until every submitted
+        job reached a final state when `until_done` is set
+        """
+        poller = JobPoller.instance()
+        poller.subscribe(self._on_events)
+        interval = 1 / self.refresh_per_second
+        version = -1
+        try:
+            with Live(self.table.render(), console=self.console,
+                      auto_refresh=False, transient=False) as live:
+                while not self._stop.is_set():
+                    if self.table.version != version:
+                        version = self.table.version
+                        live.update(self.table.render(), refresh=True)
+
+                    if until_done and self.table.done():
+                        break
+                    self._stop.wait(interval)
+        finally:
+            poller.unsubscribe(self._on_events)
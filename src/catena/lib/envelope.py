@@ -0,0 +1,108 @@
+import struct
+from typing import BinaryIO, Optional, Iterator, Tuple
+
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Random import get_random_bytes
+
+
+MAGIC = b'CTNENV1\0'
+CHUNK_SIZE = 1 << 20
+KEY_SIZE = 32
+TAG_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+
+# magic, length of the wrapped data key, chunk size, nonce prefix
+_HEADER = struct.Struct(f'>8sHI{NONCE_PREFIX_SIZE}s')
+
+
+def is_envelope(f: BinaryIO) -> bool:
+    """
+    Whether the seekable file `f` starts with an envelope header, leaving its position unchanged
+    """
+    position = f.tell()
+    try:
+        return f.read(len(MAGIC)) == MAGIC
+    finally:
+        f.seek(position)
+
+
+def _chunks(f: BinaryIO, size: int) -> Iterator[Tuple[bytes, bool]]:
+    """
+    Read `f` in chunks of `size` bytes along with whether each is the last,
+    yielding one empty last chunk for an empty file
+    """
+    chunk = f.read(size)
+    while True:
+        following = f.read(size)
+        yield chunk, not following
+        if not following:
+            return
+        chunk = following
+
+
+def _nonce(prefix: bytes, index: int, last: bool) -> bytes:
+    if index >= 1 << 32:
+        raise ValueError('Too many chunks for one envelope, use a larger chunk size')
+    return prefix + struct.pack('>I?', index, last)
+
+
+def encrypt_stream(pubkey, source: BinaryIO, target: BinaryIO,
+                   chunk_size: Optional[int] = CHUNK_SIZE) -> int:
+    """
+    Encrypt `source` into `target` with a random AES-256-GCM data key that
+    is wrapped with RSA-OAEP for `pubkey` and stored in the header. The data
+    is sealed in chunks of `chunk_size` bytes, each with its own tag and a
+    nonce made of a random prefix, the chunk index and a flag marking the
+    last chunk, so reordered, dropped or truncated chunks fail to decrypt.
+    Memory use is bounded by two chunks regardless of the file size.
+
+    Returns:
+        number of plaintext bytes encrypted
+    """
+    key = get_random_bytes(KEY_SIZE)
+    prefix = get_random_bytes(NONCE_PREFIX_SIZE)
+    wrapped = PKCS1_OAEP.new(pubkey).encrypt(key)
+    header = _HEADER.pack(MAGIC, len(wrapped), chunk_size, prefix) + wrapped
+    target.write(header)
+
+    nbytes = 0
+    for index, (chunk, last) in enumerate(_chunks(source, chunk_size)):
+        cipher = AES.new(key, AES.MODE_GCM, nonce=_nonce(prefix, index, last))
+        cipher.update(header)
+        ciphertext, tag = cipher.encrypt_and_digest(chunk)
+        target.write(ciphertext)
+        target.write(tag)
+        nbytes += len(chunk)
+    return nbytes
+
+
+def decrypt_stream(privkey, source: BinaryIO, target: BinaryIO) -> int:
+    """
+    Decrypt an envelope written by `encrypt_stream` from `source` into
+    `target` chunk by chunk. Raises ValueError when the data was modified
+    or truncated, in which case `target` holds the chunks authenticated so far.
+
+    Returns:
+        number of plaintext bytes decrypted
+    """
+    fixed = source.read(_HEADER.size)
+    if len(fixed) < _HEADER.size:
+        raise ValueError('Not an envelope: header truncated')
+    magic, wrapped_size, chunk_size, prefix = _HEADER.unpack(fixed)
+    if magic != MAGIC:
+        raise ValueError('Not an envelope: bad magic')
+    wrapped = source.read(wrapped_size)
+    key = PKCS1_OAEP.new(privkey).decrypt(wrapped)
+    header = fixed + wrapped
+
+    nbytes = 0
+    for index, (chunk, last) in enumerate(_chunks(source, chunk_size + TAG_SIZE)):
+        if len(chunk) < TAG_SIZE:
+            raise ValueError('Envelope truncated')
+        cipher = AES.new(key, AES.MODE_GCM, nonce=_nonce(prefix, index, last))
+        cipher.update(header)
+        # raises ValueError on a tag mismatch
+        plaintext = cipher.decrypt_and_verify(chunk[:-TAG_SIZE], chunk[-TAG_SIZE:])
+        target.write(plaintext)
+        nbytes += len(plaintext)
+    return nbytes
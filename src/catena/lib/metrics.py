@@ -0,0 +1,279 @@
+"""
+Process wide metrics in the Prometheus text exposition format, served by
+the `Monitor` daemon on a local HTTP endpoint (`GET /metrics`). Metrics are
+plain thread-safe counters, gauges and histograms, so instrumenting the
+submit and poll paths costs a lock and an addition per observation.
+"""
+import time
+import asyncio
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Optional, Dict, List, Tuple, Callable, Iterable
+import requests
+from loguru import logger
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+class Metric:
+    """
+    Base class of a named metric with optional labels
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+
+    def samples(self) -> Iterable[Tuple[str, Labels, float]]:
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._values: Dict[Labels, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(_labels(labels), 0.0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, k, v) for k, v in self._values.items()]
+
+
+class Gauge(Metric):
+    """
+    Gauge set directly, or computed on every scrape by `callback`, which
+    returns a map of {label dict as tuple: value} or a single value
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str,
+                 callback: Optional[Callable[[], object]] = None):
+        super().__init__(name, documentation)
+        self._values: Dict[Labels, float] = {}
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[_labels(labels)] = value
+
+    def samples(self):
+        if self.callback is not None:
+            try:
+                values = self.callback()
+            except Exception as error:
+                logger.error(f"Metric {self.name} callback failed: {error!r}")
+                return []
+            if not isinstance(values, dict):
+                return [(self.name, (), float(values))]
+            return [(self.name, k, float(v)) for k, v in values.items()]
+
+        with self._lock:
+            return [(self.name, k, v) for k, v in self._values.items()]
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 buckets: Optional[Tuple[float, ...]] = LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: Dict[Labels, List[int]] = {}
+        self._sums: Dict[Labels, float] = defaultdict(float)
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[index] += 1
+            self._sums[key] += value
+
+    def time(self, **labels) -> '_Timer':
+        """
+        Context manager observing the duration of its block
+        """
+        return _Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, counts in self._counts.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                    samples.append((f'{self.name}_bucket', key + (('le', le),), cumulative))
+                samples.append((f'{self.name}_sum', key, self._sums[key]))
+                samples.append((f'{self.name}_count', key, cumulative))
+        return samples
+
+
+class _Timer:
+
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+
+    def expose(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(m.expose() for m in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+SUBMIT_LATENCY = REGISTRY.register(Histogram(
+    'catena_submit_latency_seconds', 'Time taken to submit a job to the cluster'))
+REQUESTS = REGISTRY.register(Counter(
+    'catena_slurmrestd_requests_total', 'Requests sent to slurmrestd'))
+REQUEST_ERRORS = REGISTRY.register(Counter(
+    'catena_slurmrestd_request_errors_total',
+    'Requests to slurmrestd that failed or returned an error status'))
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    'catena_slurmrestd_request_seconds', 'Latency of requests to slurmrestd'))
+POLL_CYCLE = REGISTRY.register(Histogram(
+    'catena_poll_cycle_seconds', 'Duration of a job poller cycle'))
+TOKEN_REFRESHES = REGISTRY.register(Counter(
+    'catena_token_refreshes_total', 'SLURM JWT tokens generated with scontrol token'))
+LOOP_LAG = REGISTRY.register(Gauge(
+    'catena_event_loop_lag_seconds', 'Delay of the monitor event loop in running a scheduled callback'))
+
+
+def request(method: str, url: str, endpoint: Optional[str] = None, **kwargs) -> requests.Response:
+    """
+    Send a request to slurmrestd with `requests.request`, counting it and its
+    failures and observing its latency
+
+    Args:
+        method: HTTP method
+        url: request url
+        endpoint: label identifying the endpoint, **defaults to the url path
+            without ids** (e.g. /slurm/v0.0.35/job)
+    """
+    if endpoint is None:
+        path = '/' + url.split('://', 1)[-1].split('/', 1)[-1].split('?', 1)[0]
+        endpoint = '/'.join(p for p in path.split('/') if not p.isdigit())
+
+    start = time.perf_counter()
+    try:
+        response = requests.request(method, url, **kwargs)
+    except requests.RequestException:
+        REQUEST_ERRORS.inc(method=method, endpoint=endpoint)
+        raise
+    finally:
+        REQUESTS.inc(method=method, endpoint=endpoint)
+        REQUEST_LATENCY.observe(time.perf_counter() - start, endpoint=endpoint)
+
+    if response.status_code >= 400:
+        REQUEST_ERRORS.inc(method=method, endpoint=endpoint)
+    return response
+
+
+async def measure_loop_lag(interval: Optional[float] = 1.0):
+    """
+    Periodically record how late the running event loop wakes up
+    """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.set(max(0.0, time.perf_counter() - start - interval))
+
+
+async def start_metrics_server(host: str, port: int,
+                               registry: Optional[Registry] = REGISTRY) -> asyncio.AbstractServer:
+    """
+    Serve `registry` in the Prometheus text format on http://host:port/metrics
+    """
+    async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            # skip the request headers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+
+            if len(request_line) >= 2 and request_line[0] == 'GET' and request_line[1].split('?')[0] in ('/', '/metrics'):
+                body = registry.expose().encode('utf-8')
+                status = '200 OK'
+                ctype = 'text/plain; version=0.0.4; charset=utf-8'
+            else:
+                body, status, ctype = b'not found\n', '404 Not Found', 'text/plain'
+
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(_handle, host, port, reuse_address=True)
@@ -29,7 +29,7 @@ import traceback
 from textwrap import wrap
 from types import TracebackType
 from typing import (IO, Dict, Any, Callable, Optional, Tuple, Generator,  # noqa
-                    List, Type, TypeVar, NamedTuple, get_type_hints,  # noqa
+                    List, Set, Type, TypeVar, NamedTuple, get_type_hints,  # noqa
                     cast, Sequence)  # noqa
 from contextlib import suppress
 from concurrent.futures import Future  # noqa
@@ -53,6 +53,11 @@ import signal
 import psutil
 import uuid
 import functools
+from collections import defaultdict
+import contextvars
+import fnmatch
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 from service import Service, _PIDFile
 
@@ -63,9 +68,15 @@ import selectors
 from docstring_parser import parse
 from pyfiglet import Figlet
 
+from catena.lib.state_store import JobStateStore
+from catena.lib import metrics
+from catena.lib.tail import FileFollower, output_paths
+from catena.jobs.poller import JobPoller, TERMINAL_STATES
+
 MONITOR_HOST = '127.0.0.1' # Empty string listen on all interfaces
 MONITOR_PORT = 50101
 CONSOLE_PORT = 50102
+METRICS_PORT = 50103
 
 
 Server = asyncio.AbstractServer  # noqa
@@ -192,11 +203,64 @@ def init_console_server(host: str,
     return console_future
 
 
+class _SessionWriter:
+    """
+    File-like writer of a command server connection. Writes are handed to the
+    event loop, so commands running in executor threads can write to it.
+    """
+
+    encoding = 'utf-8'
+
+    def __init__(self, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop):
+        self._writer = writer
+        self._loop = loop
+
+    def write(self, data: str) -> int:
+        if self._writer.is_closing():
+            return len(data)
+        try:
+            in_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            self._writer.write(data.encode(self.encoding))
+        else:
+            self._loop.call_soon_threadsafe(self._writer.write, data.encode(self.encoding))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def isatty(self) -> bool:
+        return False
+
+
+class _Session:
+    """
+    Per-connection state of a command server client
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 loop: asyncio.AbstractEventLoop):
+        self.reader = reader
+        self.writer = writer
+        self.sout = _SessionWriter(writer, loop)
+        self.peer = writer.get_extra_info('peername')
+        self.lastcmd = None  # type: Optional[str]
+
+
+# session of the client whose command is being executed
+_session = contextvars.ContextVar('job_monitor_session', default=None)
+
+
 class JobMonitor:
 
     """
     Job monitoring TCP socket server based adapted 
-    from aioconsole/aiomonitor
+    from aioconsole/aiomonitor. The command server runs on the monitor's event
+    loop and serves any number of concurrent clients, each with its own
+    session. Synchronous commands are executed in a thread pool so a slow
+    command never stalls the event loop or other clients.
     """
 
     _event_loop_thread_id = None  # type: int
@@ -220,8 +284,8 @@ class JobMonitor:
     help_template = '\n{cmd_name}: {cmd_short_help}\n{full_arglist}\n\n{cmd_long_help}\n'
     help_short_template = '{cmd_name}{cmd_arg_sep}{arg_list}: {cmd_short_help}'  # noqa
 
-    _sin = None  # type: IO[str]
-    _sout = None  # type: IO[str]
+    _default_sin = None  # type: IO[str]
+    _default_sout = None  # type: IO[str]
 
     def __init__(self,
                  loop: Optional[Type[asyncio.AbstractEventLoop]]=asyncio.get_event_loop(), *,
@@ -230,7 +294,8 @@ class JobMonitor:
                  port: int = MONITOR_PORT,
                  console_port: int = CONSOLE_PORT,
                  console_enabled: bool = True,
-                 locals: OptLocals = None) -> None:
+                 locals: OptLocals = None,
+                 max_workers: int = 16) -> None:
         self._loop = loop #or asyncio.get_event_loop()
         self.jobs = jobs
 
@@ -246,15 +311,15 @@ class JobMonitor:
 
         log.info('Starting aiomonitor at %s:%d', host, port)
 
-        self._ui_thread = threading.Thread(target=self._server, args=(),
-                                           daemon=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='job-monitor')
+        self._server = None  # type: Optional[Server]
+        self._sessions = set()  # type: Set[_Session]
         self._closing = threading.Event()
         self._closed = False
         self._started = False
         self._console_future = None  # type: Optional[Future[Any]]
 
-        self.lastcmd = None  # type: Optional[str]
-
     def __repr__(self) -> str:
         name = self.__class__.__name__
         return '<{name}: {host}:{port}>'.format(
@@ -266,9 +331,38 @@ class JobMonitor:
 
         self._started = True
         self._event_loop_thread_id = threading.get_ident()
-        self._ui_thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_server(), loop=self._loop)
         #exit()
 
+    @property
+    def _sout(self) -> IO[str]:
+        session = _session.get()
+        return session.sout if session is not None else self._default_sout
+
+    @_sout.setter
+    def _sout(self, sout: IO[str]) -> None:
+        self._default_sout = sout
+
+    @property
+    def _sin(self) -> IO[str]:
+        session = _session.get()
+        return session.reader if session is not None else self._default_sin
+
+    @_sin.setter
+    def _sin(self, sin: IO[str]) -> None:
+        self._default_sin = sin
+
+    @property
+    def lastcmd(self) -> Optional[str]:
+        session = _session.get()
+        return session.lastcmd if session is not None else None
+
+    @lastcmd.setter
+    def lastcmd(self, cmd: Optional[str]) -> None:
+        session = _session.get()
+        if session is not None:
+            session.lastcmd = cmd
+
     @property
     def closed(self) -> bool:
         return self._closed
@@ -321,67 +415,82 @@ class JobMonitor:
     def close(self) -> None:
         if not self._closed:
             self._closing.set()
-            self._ui_thread.join()
+            fut = asyncio.run_coroutine_threadsafe(self._close_server(), loop=self._loop)
+            if (self._loop.is_running() and
+                    threading.get_ident() != self._event_loop_thread_id):
+                fut.result(timeout=15)
+            self._executor.shutdown(wait=False)
             self._closed = True
 
-    def _server(self) -> None:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    async def _start_server(self) -> None:
+        self._server = await asyncio.start_server(
+            self._handle_client, self._host, self._port, reuse_address=True)
+
+    async def _close_server(self) -> None:
+        if self._server is not None:
+            self._server.close()
+        for session in list(self._sessions):
+            session.writer.close()
+        if self._server is not None:
+            await self._server.wait_closed()
+
+    async def _handle_client(self, reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter) -> None:
+        # each connection is served in its own task, and so its own context
+        session = _Session(reader, writer, self._loop)
+        _session.set(session)
+        self._sessions.add(session)
+        log.info('Monitor client connected from %s', session.peer)
         try:
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        except AttributeError:
+            await self._interactive_loop(session)
+        except (ConnectionError, asyncio.IncompleteReadError):
             pass
-
-        # set the timeout to prevent the server loop from
-        # blocking indefinitaly on sock.accept()
-        sock.settimeout(0.5)
-        sock.bind((self._host, self._port))
-        sock.listen(1)
-        with sock:
-            while not self._closing.is_set():
-                try:
-                    client, addr = sock.accept()
-                    with client:
-                        sout = client.makefile('w', encoding='utf-8')
-                        sin = client.makefile('r', encoding='utf-8')
-                        self._interactive_loop(sin, sout)
-                except (socket.timeout, OSError):
-                    continue
-
-    def _interactive_loop(self, sin: IO[str], sout: IO[str]) -> None:
-        """Main interactive loop of the monitor"""
-        self._sin = sin
-        self._sout = sout
+        finally:
+            self._sessions.discard(session)
+            writer.close()
+            with suppress(Exception):
+                await writer.wait_closed()
+            log.info('Monitor client %s disconnected', session.peer)
+
+    async def _interactive_loop(self, session: _Session) -> None:
+        """Main interactive loop of a monitor client"""
         tasknum = len(all_tasks(loop=self._loop))
         s = '' if tasknum == 1 else 's'
         self._sout.write(self.intro.format(tasknum=tasknum, s=s))
-        try:
-            while not self._closing.is_set():
-                self._sout.write(self.prompt)
-                self._sout.flush()
+        while not self._closing.is_set():
+            self._sout.write(self.prompt)
+            await session.writer.drain()
+            try:
+                user_input = await session.reader.readline()
+                if not user_input:
+                    break
+                user_input = user_input.decode('utf-8', errors='replace').strip()
+            except (ConnectionError, asyncio.IncompleteReadError):
+                raise
+            except Exception as e:
+                msg = 'Could not read from user input due to:\n{}\n'
+                log.exception(msg)
+                self._sout.write(msg.format(repr(e)))
+            else:
                 try:
-                    user_input = sin.readline()
-                    if not user_input:
-                        break
-                    user_input = user_input.strip()
+                    # the executor thread runs in a copy of this session's context
+                    result = await self._loop.run_in_executor(
+                        self._executor, contextvars.copy_context().run,
+                        self._command_dispatch, user_input)
+                    if asyncio.iscoroutine(result):
+                        await result
+                except (ConnectionError, asyncio.CancelledError):
+                    raise
                 except Exception as e:
-                    msg = 'Could not read from user input due to:\n{}\n'
+                    msg = 'Unexpected Exception during command execution:\n{}\n'  # noqa
                     log.exception(msg)
                     self._sout.write(msg.format(repr(e)))
-                    self._sout.flush()
-                else:
-                    try:
-                        self._command_dispatch(user_input)
-                    except Exception as e:
-                        msg = 'Unexpected Exception during command execution:\n{}\n'  # noqa
-                        log.exception(msg)
-                        self._sout.write(msg.format(repr(e)))
-                        self._sout.flush()
-        finally:
-            self._sin = None  # type: ignore
-            self._sout = None  # type: ignore
 
-    def _command_dispatch(self, user_input: str) -> None:
+    def _command_dispatch(self, user_input: str) -> Any:
+        """
+        Execute a command line, coroutine commands are returned unawaited
+        to be run on the event loop
+        """
         if not user_input:
             return self.emptyline()
 
@@ -416,6 +525,7 @@ class JobMonitor:
             caught_ex = None
         finally:
             self.postcmd(comm, args, result, caught_ex)
+        return result
 
     def _filter_cmds(self, *,
                      startswith: str = '',
@@ -486,9 +596,9 @@ class JobMonitor:
             raise MultipleCommandException(allcmds)
         return getattr(self, allcmds[0].method_name)  # type: ignore
 
-    def emptyline(self) -> None:
+    def emptyline(self) -> Any:
         if self.lastcmd is not None:
-            self._command_dispatch(self.lastcmd)
+            return self._command_dispatch(self.lastcmd)
 
     def default(self, comm: str, *args: str) -> None:
         self._sout.write('No such command: {}\n'.format(comm))
@@ -605,7 +715,7 @@ class JobMonitor:
         self._sout.write(f'{self._grn}Use Ctrl-C to suspend monitor{self._cesc}\n')
         self._sout.flush()
 
-    def do_console(self) -> None:
+    async def do_console(self) -> None:
         """Switch to async Python REPL"""
         if not self._console_enabled:
             self._sout.write(f'{self._yel}Python console disabled for this sessiong{self._cesc}\n')
@@ -614,17 +724,28 @@ class JobMonitor:
 
         h, p = self._host, self._console_port
         log.info('Starting console at %s:%d', h, p)
-        fut = init_console_server(
-            self._host, self._console_port, self._locals, self._loop, streams=[self._sin, self._sout])
-        self._sout.write("FUTURE")
-        server = fut.result(timeout=3)
+        session = _session.get()
+        server = await asyncio.wrap_future(init_console_server(
+            self._host, self._console_port, self._locals, self._loop))
+
+        async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+
+        creader, cwriter = await asyncio.open_connection(h, p)
+        tasks = [asyncio.ensure_future(_pipe(creader, session.writer)),
+                 asyncio.ensure_future(_pipe(session.reader, cwriter))]
         try:
-            console_proxy(
-                self._sin, self._sout, self._host, self._console_port)
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
         finally:
-            coro = close_server(server)
-            close_fut = asyncio.run_coroutine_threadsafe(coro, loop=self._loop)
-            close_fut.result(timeout=15)
+            for task in tasks:
+                task.cancel()
+            cwriter.close()
+            await close_server(server)
 
     @alt_names('-m')
     def do_jobs(self, jobid: Optional[str] = None):
@@ -639,6 +760,118 @@ class JobMonitor:
         else:
             console.print("[bold orange]no jobs to show[/bold orange]")
     
+    @alt_names('sub')
+    async def do_subscribe(self, name: str = '*', state: str = '*', run: str = '*') -> None:
+        """Stream job state transitions as newline-delimited JSON
+
+        Only transitions are sent, one JSON object per line with the keys
+        jobid, name, run, state, previous and time. Send any line to end the
+        subscription. Events are dropped for clients that cannot keep up, and
+        the number of dropped events is reported in a "dropped" record.
+
+        Parameters
+        ----------
+        name : str
+            Glob pattern of job names, defaults to all jobs
+        state : str
+            Comma separated list of states, defaults to all states
+        run : str
+            Id of the manifest run, defaults to all runs
+        """
+        session = _session.get()
+        states = None if state == '*' else set(state.upper().split(','))
+        queue = asyncio.Queue(maxsize=10000)  # type: asyncio.Queue
+        dropped = 0
+
+        def _matches(event: dict) -> bool:
+            return ((states is None or event['state'] in states) and
+                    (run == '*' or event['run'] == run) and
+                    (name == '*' or fnmatch.fnmatchcase(event['name'], name)))
+
+        def _enqueue(events: List[dict]) -> None:
+            nonlocal dropped
+            for event in events:
+                try:
+                    queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    dropped += 1
+
+        def _on_events(events: List[dict]) -> None:
+            # filtered in the poller thread, handed to the loop once per cycle
+            events = [e for e in events if _matches(e)]
+            if events:
+                self._loop.call_soon_threadsafe(_enqueue, events)
+
+        poller = JobPoller.instance()
+        poller.subscribe(_on_events)
+        stop = asyncio.ensure_future(session.reader.readline())
+        try:
+            while True:
+                get = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait({get, stop}, return_when=asyncio.FIRST_COMPLETED)
+                if stop in done:
+                    get.cancel()
+                    break
+
+                events = [get.result()]
+                while not queue.empty():
+                    events.append(queue.get_nowait())
+                lines = [json.dumps(e, default=str) for e in events]
+                if dropped:
+                    lines.append(json.dumps({'dropped': dropped}))
+                    dropped = 0
+                session.writer.write(('\n'.join(lines) + '\n').encode('utf-8'))
+                await session.writer.drain()
+        finally:
+            poller.unsubscribe(_on_events)
+            stop.cancel()
+
+    @alt_names('t')
+    async def do_tail(self, *names: str) -> None:
+        """Follow the output files of jobs
+
+        Lines appended to the standard output and error files of all matching
+        jobs are streamed as they are written, prefixed with the job name and
+        stream. Send any line to stop following.
+
+        Parameters
+        ----------
+        names : str
+            Glob patterns of job names, defaults to all submitted jobs
+        """
+        session = _session.get()
+        patterns = names or ('*',)
+        files = {}
+        for job in (self.jobs or []):
+            if job.jobid is None or not any(fnmatch.fnmatchcase(job.name, p) for p in patterns):
+                continue
+            for stream, path in output_paths(job).items():
+                files.setdefault(path, f'{job.name}:{stream}')
+
+        if not files:
+            self._sout.write(f'{self._yel}No submitted jobs match {" ".join(patterns)}{self._cesc}\n')
+            return
+
+        self._sout.write(f'{self._grn}Following {len(files)} files, send a line to stop{self._cesc}\n')
+        follower = FileFollower(files)
+        stop = asyncio.ensure_future(session.reader.readline())
+        lines = follower.follow()
+        try:
+            while True:
+                batch = asyncio.ensure_future(lines.__anext__())
+                done, _ = await asyncio.wait({batch, stop}, return_when=asyncio.FIRST_COMPLETED)
+                if stop in done:
+                    batch.cancel()
+                    with suppress(asyncio.CancelledError):
+                        await batch
+                    break
+                text = ''.join(f'[{label}] {line}\n' for label, line in batch.result())
+                session.writer.write(text.encode('utf-8'))
+                await session.writer.drain()
+        finally:
+            stop.cancel()
+            await lines.aclose()
+
     @alt_names('-k')
     def do_kill(self):
         """kill monitoring process
@@ -696,7 +929,9 @@ class Monitor:
                  stdin=None, 
                  stdout=None,
                  stderr=None,
-                 signal_map=None): 
+                 signal_map=None,
+                 state_store: Optional[str] = None,
+                 metrics_port: Optional[int] = METRICS_PORT): 
 
         self.jobs = jobs
         self.working_directory = working_directory
@@ -734,9 +969,17 @@ class Monitor:
         self.detach_process = detach
 
 
+        # persistent job state, shared with the job poller
+        self.store = JobStateStore(state_store)
+
+        # local metrics endpoint, disabled when metrics_port is None
+        self.metrics_port = metrics_port
+        self.register_metrics()
+
         self.locals = locals()
         self.locals.setdefault('pidfile', self.pidfile)
         self.locals['jobs'] = self.jobs
+        self.locals['store'] = self.store
         self.locals.setdefault('context', self)
 
         self._is_open = False
@@ -927,12 +1170,64 @@ class Monitor:
         self.start()
 
 
+    def register_metrics(self):
+        """
+        Register the gauges of the monitored jobs and internal queues, which
+        are computed when the metrics endpoint is scraped
+        """
+        def _jobs_by_state():
+            counts = defaultdict(int)
+            for job in (self.jobs or []):
+                state = getattr(job, 'job_state', None)
+                if state is None:
+                    state = 'SUBMITTED' if job.jobid is not None else 'UNSUBMITTED'
+                counts[(('state', state),)] += 1
+            return counts
+
+        def _queue_depths():
+            poller = JobPoller.instance()
+            return {(('queue', 'poller_watched'),): len(poller),
+                    (('queue', 'poller_retrying'),): len(poller._retrying),
+                    (('queue', 'state_store_pending'),): len(self.store._pending)}
+
+        metrics.REGISTRY.register(metrics.Gauge(
+            'catena_jobs', 'Monitored jobs by state', callback=_jobs_by_state))
+        metrics.REGISTRY.register(metrics.Gauge(
+            'catena_queue_depth', 'Items waiting in internal queues', callback=_queue_depths))
+
+    def restore(self):
+        """
+        Restore the jobid and state of jobs from the state store, and resume
+        polling the jobs that have not finished
+        """
+        latest = {}
+        for record in sorted(self.store.active().values(), key=lambda r: r['updated']):
+            latest[record['name']] = record
+
+        poller = JobPoller.instance()
+        poller.store = self.store
+
+        for job in (self.jobs or []):
+            record = latest.get(job.name)
+            if record is not None and job.jobid is None:
+                job.jobid = record['jobid']
+                job.job_state = record['state']
+                job._state[job.name] = {'jobid': job.jobid, 'state': job.job_state}
+
+            if job.jobid is not None and getattr(job, 'job_state', None) not in TERMINAL_STATES:
+                poller.watch(job)
+
     def run(self):
         """You should override this method when you subclass Daemon.
         
         It will be called after the process has been daemonized by 
         start() or restart()."""
         
+        self.restore()
+
         loop = asyncio.get_event_loop()
+        if self.metrics_port is not None:
+            loop.run_until_complete(metrics.start_metrics_server(MONITOR_HOST, self.metrics_port))
+            asyncio.ensure_future(metrics.measure_loop_lag(), loop=loop)
         self.monitor.start_monitor(loop=loop, jobs=self.jobs, locals=self.locals,
                         stdin=self.stdin, stdout=self.stdout)
\ No newline at end of file
@@ -0,0 +1,262 @@
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+from typing import Optional, Dict, List, Tuple, Callable, Iterator
+
+from paramiko import SSHClient, SFTPClient, Transport
+from loguru import logger
+
+
+PoolKey = Tuple[str, str, str]
+
+
+class PooledConnection:
+    """
+    Authenticated SSH connection shared through the `SSHPool`
+
+    Attributes:
+        client: connected client
+        active: number of channel slots in use
+        leases: number of holders of the client itself (e.g. a `RemoteClient`)
+        last_used: monotonic time the connection was last acquired or released
+    """
+
+    def __init__(self, client: SSHClient):
+        self.client = client
+        self.active = 0
+        self.leases = 0
+        self.last_used = time.monotonic()
+
+    @property
+    def transport(self) -> Transport:
+        return self.client.get_transport()
+
+    @property
+    def alive(self) -> bool:
+        transport = self.transport
+        return transport is not None and transport.is_active()
+
+    @property
+    def idle(self) -> bool:
+        return self.active == 0 and self.leases == 0
+
+    def close(self):
+        try:
+            self.client.close()
+        except Exception as error:
+            logger.debug(f"Closing pooled connection failed: {error!r}")
+
+
+class _PooledSFTPClient(SFTPClient):
+    """
+    SFTP session releasing its channel slot in the pool when closed
+    """
+
+    _release: Optional[Callable[[], None]] = None
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            release, self._release = self._release, None
+            if release is not None:
+                release()
+
+
+class SSHPool:
+    """
+    Process wide pool of SSH connections keyed by (host, user, key file),
+    so concurrent staging, command execution and remote submission share a
+    few authenticated transports instead of connecting for every client.
+    Each connection serves at most `max_channels` concurrent channels,
+    below the MaxSessions limit of sshd, and further connections are opened
+    up to `max_connections` per key before callers wait for a free slot.
+    Connections send keepalives and are closed once they have been unused
+    for `idle_timeout` seconds.
+
+    Attributes:
+        max_channels: concurrent channels per connection, **defaults to 8**
+
+        max_connections: connections per key, **defaults to 4**
+
+        keepalive: seconds between keepalive packets, **defaults to 30**
+
+        idle_timeout: seconds after which an unused connection is closed, **defaults to 300**
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self,
+                 max_channels: Optional[int] = 8,
+                 max_connections: Optional[int] = 4,
+                 keepalive: Optional[int] = 30,
+                 idle_timeout: Optional[float] = 300):
+
+        self.max_channels = max_channels
+        self.max_connections = max_connections
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self._connections: Dict[PoolKey, List[PooledConnection]] = {}
+        self._connecting: Dict[PoolKey, int] = {}
+        self._cond = threading.Condition()
+        self._reaper: Optional[threading.Thread] = None
+        self._closed = threading.Event()
+
+    @classmethod
+    def instance(cls) -> 'SSHPool':
+        """
+        Return the process wide pool
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                atexit.register(cls._instance.close)
+            return cls._instance
+
+    def _start_reaper(self):
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap, name='catena-ssh-pool', daemon=True)
+            self._reaper.start()
+
+    def _reap(self):
+        while not self._closed.wait(max(1.0, self.idle_timeout / 4)):
+            self.evict_idle()
+
+    def evict_idle(self, max_idle: Optional[float] = None):
+        """
+        Close connections unused for `max_idle` seconds (default `idle_timeout`) and dead ones
+        """
+        max_idle = self.idle_timeout if max_idle is None else max_idle
+        now = time.monotonic()
+        evicted = []
+        with self._cond:
+            for key, connections in self._connections.items():
+                for connection in list(connections):
+                    if not connection.alive or (connection.idle and now - connection.last_used >= max_idle):
+                        connections.remove(connection)
+                        evicted.append((key, connection))
+            self._cond.notify_all()
+        for key, connection in evicted:
+            logger.debug(f"Closing idle SSH connection to {key[1]}@{key[0]}")
+            connection.close()
+
+    def _acquire(self, key: PoolKey, connect: Callable[[], SSHClient],
+                 slot: bool, connections: int) -> PooledConnection:
+        """
+        A live connection for `key` with a free channel slot when `slot` is
+        set, opening a new one with `connect` while fewer than `connections`
+        (capped at `max_connections`) exist or all existing ones are busy
+        """
+        wanted = min(max(connections, 1), self.max_connections)
+        with self._cond:
+            while True:
+                pool = self._connections.setdefault(key, [])
+                for connection in [c for c in pool if not c.alive]:
+                    pool.remove(connection)
+                    connection.close()
+
+                opened = len(pool) + self._connecting.get(key, 0)
+                free = [c for c in pool if not slot or c.active < self.max_channels]
+                if free and opened >= wanted:
+                    connection = min(free, key=lambda c: c.active)
+                    break
+                # a connection being opened will have free slots, wait for it
+                connecting = self._connecting.get(key, 0)
+                if opened < self.max_connections and not (connecting and opened >= wanted):
+                    connection = None
+                    self._connecting[key] = self._connecting.get(key, 0) + 1
+                    break
+                self._cond.wait()
+
+            if connection is not None:
+                self._reserve(connection, slot)
+                return connection
+
+        # connect without holding the lock, other keys are not blocked
+        try:
+            client = connect()
+            client.get_transport().set_keepalive(self.keepalive)
+        except Exception:
+            with self._cond:
+                self._connecting[key] -= 1
+                self._cond.notify_all()
+            raise
+        logger.debug(f"Opened pooled SSH connection to {key[1]}@{key[0]}")
+
+        connection = PooledConnection(client)
+        with self._cond:
+            self._connecting[key] -= 1
+            self._connections.setdefault(key, []).append(connection)
+            self._reserve(connection, slot)
+            self._start_reaper()
+            self._cond.notify_all()
+        return connection
+
+    def _reserve(self, connection: PooledConnection, slot: bool):
+        if slot:
+            connection.active += 1
+        else:
+            connection.leases += 1
+        connection.last_used = time.monotonic()
+
+    def _release(self, connection: PooledConnection, slot: bool):
+        with self._cond:
+            if slot:
+                connection.active -= 1
+            else:
+                connection.leases -= 1
+            connection.last_used = time.monotonic()
+            self._cond.notify_all()
+
+    def lease(self, key: PoolKey, connect: Callable[[], SSHClient]) -> PooledConnection:
+        """
+        Hold a shared connection for `key` until `release` is called, without
+        using a channel slot. The connection is not evicted while leased.
+        """
+        return self._acquire(key, connect, slot=False, connections=1)
+
+    def release(self, connection: PooledConnection):
+        """
+        Return a connection obtained with `lease`
+        """
+        self._release(connection, slot=False)
+
+    @contextmanager
+    def transport(self, key: PoolKey, connect: Callable[[], SSHClient],
+                  connections: Optional[int] = 1) -> Iterator[Transport]:
+        """
+        Transport with one channel slot reserved for the duration of the block
+        """
+        connection = self._acquire(key, connect, slot=True, connections=connections)
+        try:
+            yield connection.transport
+        finally:
+            self._release(connection, slot=True)
+
+    def open_sftp(self, key: PoolKey, connect: Callable[[], SSHClient],
+                  connections: Optional[int] = 1) -> SFTPClient:
+        """
+        SFTP session on a pooled connection, holding a channel slot until it is closed
+        """
+        connection = self._acquire(key, connect, slot=True, connections=connections)
+        try:
+            sftp = _PooledSFTPClient.from_transport(connection.transport)
+        except Exception:
+            self._release(connection, slot=True)
+            raise
+        sftp._release = lambda: self._release(connection, slot=True)
+        return sftp
+
+    def close(self):
+        """
+        Close all connections
+        """
+        self._closed.set()
+        with self._cond:
+            connections = [c for pool in self._connections.values() for c in pool]
+            self._connections.clear()
+            self._cond.notify_all()
+        for connection in connections:
+            connection.close()
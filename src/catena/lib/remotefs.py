@@ -0,0 +1,206 @@
+import time
+import shlex
+import posixpath
+import threading
+from typing import Optional, Dict, List, Tuple, Iterable, NamedTuple
+
+from loguru import logger
+
+
+_HASH_MARKER = '\0--catena-sha256--\0'
+
+# Lists the directories read NUL separated from stdin as a 'D<TAB>dir' record
+# followed by one 'E<TAB>size<TAB>mtime<TAB>type<TAB>name' record per entry,
+# following symbolic links, then hashes the files listed after an empty
+# record, `parallel` sha256sum processes at a time. Stdin is read in full
+# before any output is written.
+_HELPER = r"""
+f=$(mktemp) || exit 1
+trap 'rm -f "$f" "$f.h"' EXIT
+cat > "$f"
+: > "$f.h"
+mode=list
+while IFS= read -r -d '' p; do
+    if [ -z "$p" ]; then mode=hash; continue; fi
+    if [ "$mode" = list ]; then
+        if [ -d "$p" ]; then
+            printf 'D\t%s\0' "$p"
+            find -L "$p" -mindepth 1 -maxdepth 1 -printf 'E\t%s\t%T@\t%y\t%f\0' 2>/dev/null
+        fi
+    else
+        printf '%s\0' "$p" >> "$f.h"
+    fi
+done < "$f"
+printf '\0--catena-sha256--\0'
+xargs -0 -r -P {parallel} -n 16 sha256sum -- < "$f.h" 2>/dev/null
+exit 0
+"""
+
+_TYPES = {'f': 'file', 'd': 'dir', 'l': 'link'}
+
+
+class RemoteStat(NamedTuple):
+    """
+    Attributes:
+        path: remote path as requested
+        exists: whether the path exists, symbolic links are followed
+        type: file, dir, link (dangling), other or None when missing
+        size: size in bytes
+        mtime: modification time in seconds
+        digest: sha256 hex digest of a file, when requested
+    """
+    path: str
+    exists: bool
+    type: Optional[str] = None
+    size: Optional[int] = None
+    mtime: Optional[float] = None
+    digest: Optional[str] = None
+
+
+class _Listing(NamedTuple):
+    time: float
+    exists: bool
+    entries: Dict[str, Tuple[int, float, str]]
+
+
+class RemoteFileCache:
+    """
+    Answer existence, stat and checksum queries about many remote paths
+    with one remote helper execution. The helper lists the parent directory
+    of every requested path, so the listings are cached for `ttl` seconds and
+    answer later queries about any path in those directories without a
+    round trip. Checksums are computed by parallel `sha256sum` processes on
+    the remote host and cached for as long as size and mtime do not change.
+
+    Attributes:
+        client: `RemoteClient` used to run the helper
+
+        ttl: seconds a directory listing is trusted, **defaults to 30**
+
+        parallel: sha256sum processes run at once on the remote host, **defaults to 8**
+    """
+
+    def __init__(self, client, ttl: Optional[float] = 30.0, parallel: Optional[int] = 8):
+
+        self.client = client
+        self.ttl = ttl
+        self.parallel = parallel
+        self._listings: Dict[str, _Listing] = {}
+        self._digests: Dict[str, Tuple[int, float, str]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _split(path: str) -> Tuple[str, str]:
+        path = posixpath.normpath(path)
+        parent, name = posixpath.split(path)
+        return parent or '.', name
+
+    def invalidate(self, path: Optional[str] = None):
+        """
+        Drop the cached listing of the directory containing `path`, or all listings
+        """
+        with self._lock:
+            if path is None:
+                self._listings.clear()
+            else:
+                self._listings.pop(self._split(path)[0], None)
+                self._listings.pop(posixpath.normpath(path), None)
+
+    def _fresh(self, directory: str) -> bool:
+        listing = self._listings.get(directory)
+        return listing is not None and time.monotonic() - listing.time < self.ttl
+
+    def _lookup(self, path: str) -> RemoteStat:
+        normalized = posixpath.normpath(path)
+        parent, name = self._split(normalized)
+        if not name or normalized in ('.', '/'):
+            listing = self._listings[normalized]
+            return RemoteStat(path, listing.exists, 'dir' if listing.exists else None)
+
+        listing = self._listings[parent]
+        entry = listing.entries.get(name)
+        if entry is None:
+            return RemoteStat(path, False)
+        size, mtime, kind = entry
+        digest = None
+        cached = self._digests.get(normalized)
+        if cached is not None and cached[:2] == (size, mtime):
+            digest = cached[2]
+        return RemoteStat(path, kind != 'link', kind, size, mtime, digest)
+
+    def _run(self, directories: List[str], hashes: List[str]):
+        payload = ''.join(f"{d}\0" for d in directories)
+        if hashes:
+            payload += '\0' + ''.join(f"{h}\0" for h in hashes)
+
+        helper = _HELPER.replace('{parallel}', str(int(self.parallel)))
+        result = self.client.run(f"bash -c {shlex.quote(helper)}", stdin=payload.encode())
+        if not result.ok:
+            raise IOError(f"Querying remote paths failed on {self.client.host}: {result.stderr.strip()}")
+
+        listing_out, _, hash_out = result.stdout.partition(_HASH_MARKER)
+        now = time.monotonic()
+        listings = {d: _Listing(now, False, {}) for d in directories}
+        current = None
+        for record in listing_out.split('\0'):
+            if not record:
+                continue
+            fields = record.split('\t')
+            if fields[0] == 'D':
+                current = '\t'.join(fields[1:])
+                listings[current] = _Listing(now, True, {})
+            elif fields[0] == 'E' and current is not None:
+                size, mtime, kind, name = fields[1], fields[2], fields[3], '\t'.join(fields[4:])
+                listings[current].entries[name] = (int(size), float(mtime), _TYPES.get(kind, 'other'))
+
+        digests = {}
+        for line in hash_out.splitlines():
+            # escaped names (backslash or newline) are reported without digest
+            if line.startswith('\\') or '  ' not in line:
+                continue
+            digest, path = line.split('  ', 1)
+            digests[posixpath.normpath(path)] = digest
+
+        with self._lock:
+            self._listings.update(listings)
+            for path, digest in digests.items():
+                parent, name = self._split(path)
+                entry = self._listings.get(parent, _Listing(now, False, {})).entries.get(name)
+                if entry is not None:
+                    self._digests[path] = (entry[0], entry[1], digest)
+
+    def stat(self, paths: Iterable[str], checksum: Optional[bool] = False) -> Dict[str, RemoteStat]:
+        """
+        Stat results of remote paths, with sha256 digests of the files when
+        `checksum` is set, fetched in one helper execution that lists the
+        directories not cached and hashes the paths without a cached digest
+        """
+        paths = list(paths)
+        directories, hashes = set(), []
+        with self._lock:
+            for path in paths:
+                normalized = posixpath.normpath(path)
+                parent, name = self._split(normalized)
+                root = not name or normalized in ('.', '/')
+                directory = normalized if root else parent
+                if not self._fresh(directory):
+                    directories.add(directory)
+                    if checksum and not root:
+                        # hashing a directory or missing path fails quietly
+                        hashes.append(normalized)
+                elif checksum and not root:
+                    known = self._lookup(path)
+                    if known.type == 'file' and known.digest is None:
+                        hashes.append(normalized)
+
+        if directories or hashes:
+            self._run(sorted(directories), hashes)
+
+        with self._lock:
+            results = {path: self._lookup(path) for path in paths}
+        logger.debug(f"Stat of {len(paths)} remote paths, {len(directories)} directories listed, "
+                     f"{len(hashes)} hashed")
+        return results
+
+    def exists(self, paths: Iterable[str]) -> Dict[str, bool]:
+        return {path: st.exists for path, st in self.stat(paths).items()}
@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Set, Callable
+
+from paramiko import SFTPClient
+from loguru import logger
+
+from .transfer import TransferResult, TransferStats
+
+
+PART_SUFFIX = '.part'
+CHECKPOINT_SUFFIX = '.catena-checkpoint'
+
+
+def sha256_file(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Checkpoint:
+    """
+    Persisted progress of a chunked transfer: the chunks already written,
+    along with the size and mtime of the source so a checkpoint of a file
+    that changed since is discarded. Saved atomically after every chunk.
+
+    Attributes:
+        path: local checkpoint file
+        source: identity of the source as (size, mtime)
+        chunk_size: size of a chunk in bytes
+        done: indexes of the chunks written
+    """
+
+    def __init__(self, path: Path, size: int, mtime: int, chunk_size: int):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.chunk_size = chunk_size
+        self.done: Set[int] = set()
+        self._lock = threading.Lock()
+
+        try:
+            with open(path, 'r') as f:
+                saved = json.load(f)
+            if (saved['size'], saved['mtime'], saved['chunk_size']) == (size, mtime, chunk_size):
+                self.done = set(saved['done'])
+            else:
+                logger.info(f"Source changed since checkpoint {path} was written, starting over")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as error:
+            logger.warning(f"Ignoring unreadable checkpoint {path}: {error}")
+
+    @property
+    def chunks(self) -> int:
+        return max(1, -(-self.size // self.chunk_size))
+
+    @property
+    def offset(self) -> int:
+        """
+        Number of leading bytes transferred without gap
+        """
+        index = 0
+        while index in self.done:
+            index += 1
+        return min(self.size, index * self.chunk_size)
+
+    def pending(self) -> List[int]:
+        return [i for i in range(self.chunks) if i not in self.done]
+
+    @property
+    def remaining(self) -> int:
+        """
+        Number of bytes in the pending chunks
+        """
+        return sum(min(self.chunk_size, self.size - i * self.chunk_size) for i in self.pending())
+
+    def complete(self, index: int):
+        with self._lock:
+            self.done.add(index)
+            tmp = self.path.with_name(self.path.name + '.tmp')
+            with open(tmp, 'w') as f:
+                json.dump({'size': self.size, 'mtime': self.mtime, 'chunk_size': self.chunk_size,
+                           'done': sorted(self.done)}, f)
+            os.replace(tmp, self.path)
+
+    def remove(self):
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class ResumableTransfer:
+    """
+    Chunked transfer of single large files that survives dropped connections.
+    The file is written to `<target>.part` in chunks of `chunk_size` bytes,
+    up to `parallel` chunks at once on separate SFTP sessions, and each
+    finished chunk is recorded in a local checkpoint file next to the local
+    side of the transfer. Running the same transfer again sends only the
+    chunks missing from the checkpoint. Once complete, the sha256 of both
+    sides is computed in a streaming pass (remotely with `sha256sum`) and
+    compared before the part file is renamed into place.
+
+    Attributes:
+        sftp_factory: callable returning a new `SFTPClient`
+
+        remote_sha256: callable returning the sha256 hex digest of a remote file
+
+        chunk_size: bytes per chunk and checkpoint, **defaults to 64 MiB**
+
+        parallel: chunks transferred at once, **defaults to 1**
+
+        verify: compare checksums after the transfer, **defaults to True**
+    """
+
+    def __init__(self,
+                 sftp_factory: Callable[[], SFTPClient],
+                 remote_sha256: Callable[[str], str],
+                 chunk_size: Optional[int] = 64 << 20,
+                 parallel: Optional[int] = 1,
+                 verify: Optional[bool] = True):
+
+        self.sftp_factory = sftp_factory
+        self.remote_sha256 = remote_sha256
+        self.chunk_size = chunk_size
+        self.parallel = parallel
+        self.verify = verify
+
+    def _run_chunks(self, checkpoint: Checkpoint, copy: Callable[[SFTPClient, int, int], None]):
+        """
+        Copy the pending chunks, each worker on its own SFTP session
+        """
+        pending = checkpoint.pending()
+        if checkpoint.done:
+            logger.info(f"Resuming from checkpoint, {len(pending)}/{checkpoint.chunks} chunks "
+                        f"left after offset {checkpoint.offset}")
+        if not pending:
+            return
+
+        local = threading.local()
+        sessions = []
+        sessions_lock = threading.Lock()
+
+        def _copy(index: int):
+            if not hasattr(local, 'sftp'):
+                local.sftp = self.sftp_factory()
+                with sessions_lock:
+                    sessions.append(local.sftp)
+            offset = index * self.chunk_size
+            copy(local.sftp, offset, min(self.chunk_size, checkpoint.size - offset))
+            checkpoint.complete(index)
+
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.parallel, len(pending)),
+                                    thread_name_prefix='catena-chunk') as executor:
+                # raise the first failure, completed chunks stay checkpointed
+                list(executor.map(_copy, pending))
+        finally:
+            for sftp in sessions:
+                sftp.close()
+
+    def _verify(self, checkpoint: Checkpoint, local_path: str, remote_path: str):
+        """
+        Compare the checksums of both sides, discarding the checkpoint on a
+        mismatch so the next attempt transfers the whole file again
+        """
+        if not self.verify:
+            return
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            remote = executor.submit(self.remote_sha256, remote_path)
+            local = sha256_file(local_path)
+            remote = remote.result()
+        if local != remote:
+            checkpoint.remove()
+            raise IOError(f"Checksum mismatch between {local_path} ({local}) and {remote_path} ({remote})")
+        logger.info(f"Verified sha256 {local} of {local_path}")
+
+    def upload(self, source: str, target: str) -> TransferStats:
+        """
+        Upload the local file `source` to the remote path `target`
+        """
+        st = os.stat(source)
+        checkpoint = Checkpoint(Path(source + CHECKPOINT_SUFFIX), st.st_size, int(st.st_mtime), self.chunk_size)
+        part = target + PART_SUFFIX
+        start = time.perf_counter()
+
+        sftp = self.sftp_factory()
+        try:
+            if checkpoint.done:
+                try:
+                    sftp.stat(part)
+                except FileNotFoundError:
+                    logger.info(f"Part file {part} is gone, starting over")
+                    checkpoint.done.clear()
+            if not checkpoint.done:
+                sftp.open(part, 'wb').close()
+            nbytes = checkpoint.remaining
+
+            def _copy(session: SFTPClient, offset: int, length: int):
+                with open(source, 'rb') as local, session.open(part, 'r+b') as remote:
+                    local.seek(offset)
+                    remote.seek(offset)
+                    remote.set_pipelined(True)
+                    remaining = length
+                    while remaining > 0:
+                        data = local.read(min(remaining, 1 << 18))
+                        if not data:
+                            break
+                        remote.write(data)
+                        remaining -= len(data)
+
+            self._run_chunks(checkpoint, _copy)
+            self._verify(checkpoint, source, part)
+            sftp.posix_rename(part, target)
+            sftp.utime(target, (st.st_atime, st.st_mtime))
+        finally:
+            sftp.close()
+        checkpoint.remove()
+
+        seconds = time.perf_counter() - start
+        stats = TransferStats([TransferResult(source, target, nbytes, seconds)], seconds)
+        logger.info(f"Uploaded {source} to {target}: {stats}")
+        return stats
+
+    def download(self, source: str, target: str) -> TransferStats:
+        """
+        Download the remote file `source` to the local path `target`
+        """
+        sftp = self.sftp_factory()
+        try:
+            st = sftp.stat(source)
+            checkpoint = Checkpoint(Path(target + CHECKPOINT_SUFFIX), st.st_size, int(st.st_mtime), self.chunk_size)
+            part = target + PART_SUFFIX
+            start = time.perf_counter()
+
+            if checkpoint.done and not os.path.exists(part):
+                logger.info(f"Part file {part} is gone, starting over")
+                checkpoint.done.clear()
+            if not checkpoint.done:
+                os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+                with open(part, 'wb') as f:
+                    f.truncate(st.st_size)
+            nbytes = checkpoint.remaining
+
+            def _copy(session: SFTPClient, offset: int, length: int):
+                with session.open(source, 'rb') as remote, open(part, 'r+b') as local:
+                    local.seek(offset)
+                    # readv keeps the read requests of all blocks in flight at once
+                    blocks = [(o, min(1 << 22, offset + length - o)) for o in range(offset, offset + length, 1 << 22)]
+                    for block in remote.readv(blocks):
+                        local.write(block)
+
+            self._run_chunks(checkpoint, _copy)
+        finally:
+            sftp.close()
+
+        self._verify(checkpoint, part, source)
+        os.replace(part, target)
+        os.utime(target, (st.st_atime, st.st_mtime))
+        checkpoint.remove()
+
+        seconds = time.perf_counter() - start
+        stats = TransferStats([TransferResult(source, target, nbytes, seconds)], seconds)
+        logger.info(f"Downloaded {source} to {target}: {stats}")
+        return stats
@@ -11,6 +11,7 @@ from typing import Optional, List
 from charset_normalizer import from_path
 import contextlib
 import os
+import shlex
 
 from ..models import lang_extensions 
 from . import env
@@ -171,12 +172,16 @@ class VirtualScript(object):
         
         with open(f"{target}", 'w') as out:
             out.write(script)
-        chmod(target, cls.permissions - mask)        
+        chmod(target, self.permissions - mask)        
 
 
 class JobScript(VirtualScript):
     """
     Generic script of any language
+
+    When `sidecar` is set to a directory, the script is wrapped in a bash
+    script that writes a completion record (start and end time, exit code,
+    host and peak RSS) to `<sidecar>/<jobid>.json` when it ends
     """
     id: str = 'generic_script'
     permissions = 0o755
@@ -185,7 +190,8 @@ class JobScript(VirtualScript):
                  path: str,
                  pyflake: Optional[bool] = True,
                  job_script_args: Optional[List[str]] = None,
-                 command: Optional[str] = None
+                 command: Optional[str] = None,
+                 sidecar: Optional[str] = None
                  ):
 
         # checke if path exists here and if abs path etc.
@@ -194,6 +200,7 @@ class JobScript(VirtualScript):
         self.pyflake = pyflake
         self.job_script_args = job_script_args
         self.__cmd = command
+        self.sidecar = sidecar
 
 
         # determine job_script file type (charset)
@@ -346,4 +353,129 @@ class JobScript(VirtualScript):
                             content=content,
                             script_args=self.job_script_args,
                             command=self.command,
-                            run_as_exe=self.run_as_exe)
\ No newline at end of file
+                            run_as_exe=self.run_as_exe,
+                            sidecar=shlex.quote(str(self.sidecar)) if self.sidecar else None)
+
+
+class PackRunner(VirtualScript):
+    """
+    Runner script for a packed allocation of short jobs
+    """
+    id: str = 'pack_runner'
+    permissions = 0o755
+
+    def __init__(self,
+                 tasks: List[dict],
+                 status_dir: str,
+                 workers: Optional[int] = 1,
+                 launcher: Optional[str] = 'srun',
+                 cpus_per_task: Optional[int] = 1
+                 ):
+
+        self.tasks = tasks
+        self.status_dir = status_dir
+        self.workers = workers
+        self.launcher = launcher
+        self.cpus_per_task = cpus_per_task
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    @property
+    def script(self):
+        return self.render(tasks=self.tasks,
+                           status_dir=self.status_dir,
+                           workers=self.workers,
+                           launcher=self.launcher,
+                           cpus_per_task=self.cpus_per_task)
+
+    def write(self, target):
+        """
+        Write runner script to file
+        """
+        super().write(target, tasks=self.tasks,
+                      status_dir=self.status_dir,
+                      workers=self.workers,
+                      launcher=self.launcher,
+                      cpus_per_task=self.cpus_per_task)
+        return target
+
+
+
+class PilotScript(VirtualScript):
+    """
+    Batch script for a pilot job running a catena worker
+    """
+    id: str = 'pilot_worker'
+    permissions = 0o755
+
+    def __init__(self,
+                 queue_dir: str,
+                 python: Optional[str] = 'python3',
+                 slots: Optional[int] = 1,
+                 idle_timeout: Optional[float] = 60,
+                 poll_interval: Optional[float] = 0.1
+                 ):
+
+        self.queue_dir = queue_dir
+        self.python = python
+        self.slots = slots
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    @property
+    def options(self):
+        return dict(queue_dir=self.queue_dir,
+                    python=self.python,
+                    slots=self.slots,
+                    idle_timeout=self.idle_timeout,
+                    poll_interval=self.poll_interval)
+
+    @property
+    def script(self):
+        return self.render(**self.options)
+
+    def write(self, target):
+        """
+        Write pilot script to file
+        """
+        super().write(target, **self.options)
+        return target
+
+
+
+class MapTask(VirtualScript):
+    """
+    Array task script applying a serialised function to a chunk of inputs
+    """
+    id: str = 'map_task'
+    permissions = 0o755
+
+    def __init__(self, store: str):
+        self.store = store
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    @property
+    def script(self):
+        return self.render(store=repr(str(self.store)))
+
+    def write(self, target):
+        """
+        Write array task script to file
+        """
+        super().write(target, store=repr(str(self.store)))
+        return target
@@ -0,0 +1,118 @@
+import os
+import time
+import json
+import select
+import threading
+from pathlib import Path
+from typing import Optional, Set, Callable
+
+from loguru import logger
+
+from .tail import Inotify
+
+
+class SidecarWatcher:
+    """
+    Watch sidecar directories for the completion records written by jobs
+    whose script was wrapped with `sidecar` (see `JobScript`), calling
+    `callback` once with each new record. New records are picked up through
+    inotify as soon as they are renamed into place, and every directory is
+    also scanned each `poll_interval` seconds, which is the only mechanism
+    without inotify and catches records written from other hosts on network
+    filesystems.
+
+    Attributes:
+        callback: called from the watcher thread with each record dict
+
+        poll_interval: seconds between directory scans
+    """
+
+    def __init__(self,
+                 callback: Callable[[dict], None],
+                 poll_interval: Optional[float] = 5.0):
+
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self._dirs: Set[Path] = set()
+        self._seen: Set[Path] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        try:
+            self._inotify: Optional[Inotify] = Inotify()
+        except (OSError, AttributeError) as error:
+            logger.info(f"inotify unavailable, scanning sidecar directories: {error}")
+            self._inotify = None
+
+    def add(self, directory: str):
+        """
+        Watch a sidecar directory, starting the watcher thread if needed
+        """
+        directory = Path(directory)
+        with self._lock:
+            if directory in self._dirs:
+                return
+            directory.mkdir(parents=True, exist_ok=True)
+            if self._inotify is not None:
+                self._inotify.watch(directory)
+            self._dirs.add(directory)
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='catena-sidecar-watcher',
+                                                daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _process(self, path: Path):
+        if path in self._seen or path.suffix != '.json':
+            return
+        try:
+            with open(path, 'r') as f:
+                record = json.load(f)
+        except (OSError, json.JSONDecodeError) as error:
+            logger.warning(f"Could not read sidecar record {path}: {error}")
+            return
+
+        self._seen.add(path)
+        try:
+            self.callback(record)
+        except Exception as error:
+            logger.error(f"Sidecar callback failed for {path}: {error!r}")
+
+    def scan(self):
+        """
+        Process all records not seen yet
+        """
+        with self._lock:
+            dirs = list(self._dirs)
+        for directory in dirs:
+            try:
+                entries = [Path(e.path) for e in os.scandir(directory) if e.name.endswith('.json')]
+            except OSError:
+                continue
+            for path in entries:
+                self._process(path)
+
+    def _run(self):
+        self.scan()
+        next_scan = time.monotonic() + self.poll_interval
+        while not self._stop.is_set():
+            if self._inotify is None:
+                self._stop.wait(self.poll_interval)
+                self.scan()
+                continue
+
+            # scan on its own deadline, a steady stream of events from busy
+            # directories must not defer the records inotify can not see
+            timeout = max(0.0, next_scan - time.monotonic())
+            readable, _, _ = select.select([self._inotify.fd], [], [], timeout)
+            if readable:
+                for path in self._inotify.read():
+                    self._process(path)
+            if time.monotonic() >= next_scan:
+                self.scan()
+                next_scan = time.monotonic() + self.poll_interval
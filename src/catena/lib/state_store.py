@@ -0,0 +1,205 @@
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional, Dict, List, Any, Tuple
+
+from catena.jobs.poller import TERMINAL_STATES
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    jobid TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    run_id TEXT,
+    state TEXT,
+    submitted REAL,
+    updated REAL,
+    final INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS transitions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    jobid TEXT NOT NULL,
+    state TEXT NOT NULL,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE INDEX IF NOT EXISTS jobs_active ON jobs (jobid) WHERE final = 0;
+CREATE INDEX IF NOT EXISTS jobs_run ON jobs (run_id, state);
+CREATE INDEX IF NOT EXISTS jobs_name ON jobs (name);
+CREATE INDEX IF NOT EXISTS transitions_job ON transitions (jobid, time);
+"""
+
+
+class JobStateStore:
+    """
+    Persistent job state store backed by an embedded SQLite database in WAL
+    mode. State updates are buffered by `record` and written in a single
+    transaction by `flush`, and only actual state changes are added to the
+    transitions table. Jobs that have not reached a final state are flagged,
+    and only their latest state is loaded when the store is opened, through a
+    partial index holding just those rows, so a restarted monitor resumes
+    without re-querying the cluster for history, however many finished jobs
+    the store holds.
+
+    Attributes:
+        path: database file, **defaults to .catena/state.db in the current
+            working directory**
+
+        batch_size: number of buffered updates that triggers a flush
+    """
+
+    def __init__(self,
+                 path: Optional[str] = None,
+                 batch_size: Optional[int] = 500):
+
+        if path is None:
+            path = Path.cwd() / '.catena' / 'state.db'
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self.__migrate()
+        self._conn.executescript(SCHEMA)
+
+        self._pending: List[Tuple[str, str, Optional[str], str, float]] = []
+        self._latest: Dict[str, dict] = {}
+        self.__load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._latest)
+
+    def __migrate(self):
+        """
+        Add the final flag to stores created without it
+        """
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(jobs)')]
+        if columns and 'final' not in columns:
+            with self._conn:
+                self._conn.execute('ALTER TABLE jobs ADD COLUMN final INTEGER NOT NULL DEFAULT 0')
+                self._conn.execute(
+                    f'UPDATE jobs SET final = 1 WHERE state IN ({", ".join("?" * len(TERMINAL_STATES))})',
+                    tuple(TERMINAL_STATES))
+
+    def __load(self):
+        rows = self._conn.execute(
+            'SELECT jobid, name, run_id, state, submitted, updated FROM jobs WHERE final = 0')
+        for jobid, name, run_id, state, submitted, updated in rows:
+            self._latest[jobid] = {'jobid': jobid, 'name': name, 'run_id': run_id,
+                                   'state': state, 'submitted': submitted,
+                                   'updated': updated}
+
+    def record(self, jobid: Any, name: str, state: str,
+               run_id: Optional[str] = None, timestamp: Optional[float] = None):
+        """
+        Buffer the state of a job, unchanged states are dropped
+        """
+        jobid = str(jobid)
+        timestamp = timestamp or time.time()
+
+        with self._lock:
+            latest = self._latest.get(jobid)
+            if latest is not None and latest['state'] == state:
+                return
+
+            if latest is not None:
+                run_id = run_id or latest['run_id']
+
+            self._latest[jobid] = {'jobid': jobid, 'name': name, 'run_id': run_id,
+                                   'state': state,
+                                   'submitted': latest['submitted'] if latest else timestamp,
+                                   'updated': timestamp}
+            self._pending.append((jobid, name, run_id, state, timestamp))
+            flush = len(self._pending) >= self.batch_size
+
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all buffered updates in a single transaction
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if not pending:
+                return
+
+            with self._conn:
+                self._conn.executemany(
+                    'INSERT INTO jobs (jobid, name, run_id, state, submitted, updated, final) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT(jobid) DO UPDATE SET state=excluded.state, '
+                    'updated=excluded.updated, final=excluded.final, '
+                    'run_id=COALESCE(excluded.run_id, jobs.run_id)',
+                    [(j, n, r, s, t, t, int(s in TERMINAL_STATES)) for j, n, r, s, t in pending])
+                self._conn.executemany(
+                    'INSERT INTO transitions (jobid, state, time) VALUES (?, ?, ?)',
+                    [(j, s, t) for j, _, _, s, t in pending])
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def latest(self, name: Optional[str] = None) -> Dict[str, dict]:
+        """
+        Latest known state of the jobs tracked since the store was opened,
+        keyed by jobid, optionally only for jobs called `name`
+        """
+        with self._lock:
+            if name is None:
+                return dict(self._latest)
+            return {k: v for k, v in self._latest.items() if v['name'] == name}
+
+    def active(self) -> Dict[str, dict]:
+        """
+        Tracked jobs that have not reached a final state
+        """
+        return {k: v for k, v in self.latest().items() if v['state'] not in TERMINAL_STATES}
+
+    def by_state(self, state: str, run_id: Optional[str] = None) -> List[dict]:
+        """
+        Jobs currently in `state`, optionally restricted to a manifest run
+        """
+        self.flush()
+        query = 'SELECT jobid, name, run_id, state, submitted, updated FROM jobs WHERE state = ?'
+        params = [state]
+        if run_id is not None:
+            query += ' AND run_id = ?'
+            params.append(run_id)
+
+        keys = ('jobid', 'name', 'run_id', 'state', 'submitted', 'updated')
+        with self._lock:
+            return [dict(zip(keys, row)) for row in self._conn.execute(query, params)]
+
+    def counts(self, run_id: Optional[str] = None) -> Dict[str, int]:
+        """
+        Number of jobs per state, optionally restricted to a manifest run
+        """
+        self.flush()
+        with self._lock:
+            if run_id is None:
+                rows = self._conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state')
+            else:
+                rows = self._conn.execute(
+                    'SELECT state, COUNT(*) FROM jobs WHERE run_id = ? GROUP BY state', (run_id,))
+            return dict(rows.fetchall())
+
+    def transitions(self, jobid: Any) -> List[Tuple[str, float]]:
+        """
+        State transitions of a job in chronological order
+        """
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT state, time FROM transitions WHERE jobid = ? ORDER BY time', (str(jobid),))
+            return rows.fetchall()
@@ -0,0 +1,179 @@
+import os
+import shlex
+import hashlib
+import posixpath
+from pathlib import Path
+from typing import Optional, Dict, List, Tuple, NamedTuple
+
+from paramiko import SSHClient
+from loguru import logger
+
+from .transfer import TransferEngine, TransferStats
+
+
+_HASH_MARKER = '--catena-sha256--'
+
+
+class ManifestEntry(NamedTuple):
+    """
+    Attributes:
+        size: file size in bytes
+        mtime: modification time in whole seconds
+        digest: sha256 hex digest of the content, None when not computed
+    """
+    size: int
+    mtime: int
+    digest: Optional[str] = None
+
+
+Manifest = Dict[str, ManifestEntry]
+
+
+class SyncResult(NamedTuple):
+    """
+    Attributes:
+        transferred: relative paths uploaded because they were new or changed
+        unchanged: number of files already up to date on the remote host
+        deleted: relative paths removed from the remote host
+        stats: statistics of the upload
+    """
+    transferred: List[str]
+    unchanged: int
+    deleted: List[str]
+    stats: Optional[TransferStats]
+
+
+def _sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def local_manifest(root: str, recursive: Optional[bool] = True,
+                   checksum: Optional[bool] = False) -> Manifest:
+    """
+    Manifest of the files under `root`, keyed by their posix path relative to root
+    """
+    manifest = {}
+    for directory, dirs, files in os.walk(root, topdown=True):
+        relative = Path(directory).relative_to(root).as_posix()
+        for name in files:
+            path = os.path.join(directory, name)
+            st = os.stat(path)
+            manifest[posixpath.normpath(posixpath.join(relative, name))] = ManifestEntry(
+                st.st_size, int(st.st_mtime), _sha256(path) if checksum else None)
+        if not recursive:
+            break
+    return manifest
+
+
+def remote_manifest(client: SSHClient, root: str, recursive: Optional[bool] = True,
+                    checksum: Optional[bool] = False) -> Manifest:
+    """
+    Manifest of the files under the remote directory `root`, listed by a
+    single `find` (and `sha256sum` with `checksum`) execution. A missing
+    directory gives an empty manifest.
+    """
+    depth = '' if recursive else ' -maxdepth 1'
+    command = f"cd {shlex.quote(root)} 2>/dev/null || exit 0; find .{depth} -type f -printf '%P\\t%s\\t%T@\\n'"
+    if checksum:
+        command += f"; echo {_HASH_MARKER}; find .{depth} -type f -exec sha256sum {{}} +"
+
+    stdin, stdout, stderr = client.exec_command(command)
+    stdin.close()
+    output = stdout.read().decode('utf-8', errors='surrogateescape')
+    if stdout.channel.recv_exit_status() != 0:
+        raise IOError(f"Listing {root} failed: {stderr.read().decode(errors='replace').strip()}")
+
+    listing, _, hashes = output.partition(f"{_HASH_MARKER}\n")
+    manifest = {}
+    for line in listing.splitlines():
+        path, size, mtime = line.rsplit('\t', 2)
+        manifest[path] = ManifestEntry(int(size), int(float(mtime)))
+
+    for line in hashes.splitlines():
+        # escaped names (backslash or newline) are left without digest and resent
+        if line.startswith('\\'):
+            continue
+        digest, path = line.split('  ', 1)
+        path = posixpath.normpath(path)
+        if path in manifest:
+            manifest[path] = manifest[path]._replace(digest=digest)
+    return manifest
+
+
+def diff_manifests(local: Manifest, remote: Manifest,
+                   checksum: Optional[bool] = False) -> Tuple[List[str], List[str]]:
+    """
+    Paths to transfer because they are missing or differ on the remote side,
+    and remote paths without a local counterpart. Files differ when their
+    size differs, and then when their digest differs with `checksum`, or
+    their mtime without it.
+    """
+    changed = []
+    for path, entry in local.items():
+        other = remote.get(path)
+        if (other is None or other.size != entry.size
+                or (other.digest != entry.digest if checksum else other.mtime != entry.mtime)):
+            changed.append(path)
+    stale = [path for path in remote if path not in local]
+    return changed, stale
+
+
+def delete_remote(client: SSHClient, root: str, paths: List[str]):
+    """
+    Remove files relative to the remote directory `root` in one execution
+    """
+    if not paths:
+        return
+    stdin, stdout, stderr = client.exec_command(f"cd {shlex.quote(root)} && xargs -0 rm -f --")
+    stdin.write('\0'.join(paths).encode('utf-8', errors='surrogateescape'))
+    stdin.channel.shutdown_write()
+    if stdout.channel.recv_exit_status() != 0:
+        raise IOError(f"Deleting stale files in {root} failed: {stderr.read().decode(errors='replace').strip()}")
+
+
+def sync_directory(client: SSHClient,
+                   engine: TransferEngine,
+                   source_dir: str,
+                   target_dir: str,
+                   recursive: Optional[bool] = True,
+                   checksum: Optional[bool] = False,
+                   delete: Optional[bool] = False) -> SyncResult:
+    """
+    Upload only the new or changed files of `source_dir` to `target_dir`,
+    comparing a local manifest with the remote one fetched in a single
+    command. Uploaded files keep their local mtime, so without `checksum`
+    an unchanged tree is recognised from sizes and mtimes alone.
+
+    Args:
+        client: connected client used for the remote commands
+        engine: transfer engine used for the uploads
+        source_dir: local directory
+        target_dir: remote directory
+        recursive: include subdirectories
+        checksum: compare sha256 digests instead of mtimes
+        delete: remove remote files missing from source_dir
+    """
+    local = local_manifest(source_dir, recursive=recursive, checksum=checksum)
+    remote = remote_manifest(client, target_dir, recursive=recursive, checksum=checksum)
+    changed, stale = diff_manifests(local, remote, checksum=checksum)
+    unchanged = len(local) - len(changed)
+    logger.info(f"Sync {source_dir} -> {target_dir}: {len(changed)} changed, "
+                f"{unchanged} unchanged, {len(stale)} stale")
+
+    stats = None
+    if changed:
+        stats = engine.upload((os.path.join(source_dir, *path.split('/')), posixpath.join(target_dir, path))
+                              for path in changed)
+        failed = {posixpath.relpath(r.target, target_dir) for r in stats.failed}
+        changed = [path for path in changed if path not in failed]
+
+    deleted = []
+    if delete and stale:
+        delete_remote(client, target_dir, stale)
+        deleted = stale
+
+    return SyncResult(changed, unchanged, deleted, stats)
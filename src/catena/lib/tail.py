@@ -0,0 +1,274 @@
+import os
+import re
+import struct
+import ctypes
+import ctypes.util
+import asyncio
+from pathlib import Path
+from typing import Optional, Dict, List, Tuple, AsyncIterator
+
+from loguru import logger
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_EVENT = struct.Struct('iIII')
+_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+
+def array_indices(spec: str) -> List[int]:
+    """
+    Task ids of a job array specification, e.g. '0-15%4', '1,3,5-9' or '0-20:5'
+    """
+    indices = []
+    for part in spec.split('%')[0].split(','):
+        part, _, step = part.partition(':')
+        first, _, last = part.partition('-')
+        indices.extend(range(int(first), int(last or first) + 1, int(step or 1)))
+    return indices
+
+
+def working_directory(job) -> str:
+    """
+    Directory a job runs in, which relative output paths are resolved against
+    """
+    options = job.request.job
+    workdir = getattr(options, 'current_working_directory', None)
+    if workdir:
+        return workdir
+    backend = getattr(job, 'backend', None)
+    if backend is not None:
+        return backend.remote_dir
+    # the directory the job was created in, exported with its environment
+    return (options.environment or {}).get('PWD') or os.getcwd()
+
+
+def output_paths(job, record: Optional[dict] = None) -> Dict[str, Path]:
+    """
+    Resolve the standard output and error files of a submitted job, replacing
+    the sbatch filename patterns %j, %A, %a, %x, %u and %% and resolving
+    relative paths against the job's working directory. Without an explicit
+    path SLURM writes both streams to slurm-%j.out (slurm-%A_%a.out for arrays).
+
+    The files of a single array task are resolved from its job `record` (see
+    `list_jobs`); for a job array without a record, the files of every task of
+    the array are returned, keyed by stream and task id (e.g. 'out.3').
+    """
+    options = job.request.job
+    workdir = Path(working_directory(job))
+
+    tasks: List[Tuple[str, Optional[int], str]] = [('', None, str(job.jobid))]
+    if record is not None and record.get('array_task_id') is not None:
+        tasks = [('', int(record['array_task_id']), str(record.get('job_id', job.jobid)))]
+    elif options.array:
+        tasks = [(f".{i}", i, str(job.jobid)) for i in array_indices(options.array)]
+
+    default = 'slurm-%A_%a.out' if tasks[0][1] is not None else 'slurm-%j.out'
+    paths = {}
+    for suffix, task_id, jobid in tasks:
+        replacements = {'j': jobid, 'A': str(job.jobid),
+                        'a': str(task_id if task_id is not None else 0),
+                        'x': job.name, 'u': job.user, '%': '%'}
+
+        def _resolve(pattern: str) -> Path:
+            return workdir / re.sub(r'%(\d*)([jAaxu%])',
+                                    lambda m: replacements[m.group(2)].zfill(int(m.group(1) or 0)),
+                                    pattern)
+
+        paths[f"out{suffix}"] = _resolve(options.standard_out or default)
+        if options.standard_error:
+            paths[f"err{suffix}"] = _resolve(options.standard_error)
+    return paths
+
+
+class Inotify:
+    """
+    Minimal inotify binding through libc, watching directories so files that
+    do not exist yet are picked up when they are created
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._dirs: Dict[int, Path] = {}
+
+    def watch(self, directory: Path):
+        wd = self._add_watch(self.fd, str(directory).encode(), _WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {directory}')
+        self._dirs[wd] = directory
+
+    def read(self) -> List[Path]:
+        """
+        Paths changed since the last read
+        """
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            if wd in self._dirs and name:
+                paths.append(self._dirs[wd] / name)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileFollower:
+    """
+    Follow any number of growing files, reading only the bytes appended since
+    the last read from the tracked offset of each file. Changes are detected
+    with inotify where available; files are also checked with `stat` every
+    `poll_interval` seconds, which is the only mechanism without inotify and
+    catches writes on network filesystems that do not raise inotify events.
+
+    Attributes:
+        files: map of {path: label} of the files to follow
+
+        poll_interval: seconds between stat checks of all files
+
+        lines: number of existing trailing lines emitted when following starts
+
+        chunk_size: maximum number of bytes read from a file per change
+    """
+
+    def __init__(self,
+                 files: Dict[Path, str],
+                 poll_interval: Optional[float] = 2.0,
+                 lines: Optional[int] = 10,
+                 chunk_size: Optional[int] = 1 << 20):
+
+        self.files = {Path(p): label for p, label in files.items()}
+        self.poll_interval = poll_interval
+        self.lines = lines
+        self.chunk_size = chunk_size
+        self._offsets: Dict[Path, int] = {}
+        self._partial: Dict[Path, bytes] = {}
+        self._inotify: Optional[Inotify] = None
+
+        try:
+            inotify = Inotify()
+            for directory in {p.parent for p in self.files}:
+                if directory.is_dir():
+                    inotify.watch(directory)
+            self._inotify = inotify
+        except (OSError, AttributeError) as error:
+            logger.info(f"inotify unavailable, polling output files: {error}")
+
+    def _start_offset(self, path: Path) -> int:
+        """
+        Offset `lines` lines before the end of a file, reading only its tail
+        """
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            return 0
+        if not self.lines:
+            return size
+
+        with open(path, 'rb') as f:
+            start = max(0, size - 8192)
+            f.seek(start)
+            tail = f.read(size - start)
+        newlines = [i for i, b in enumerate(tail) if b == 0x0A]
+        if tail.endswith(b'\n'):
+            newlines = newlines[:-1]
+        if len(newlines) < self.lines:
+            return start if start == 0 else start + (newlines[0] + 1 if newlines else 0)
+        return start + newlines[-self.lines] + 1
+
+    def read(self, path: Path) -> List[Tuple[str, str]]:
+        """
+        Complete lines appended to `path` since the last read
+        """
+        if path not in self._offsets:
+            self._offsets[path] = self._start_offset(path)
+            self._partial[path] = b''
+
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            return []
+
+        offset = self._offsets[path]
+        if size < offset:
+            # truncated or replaced
+            offset, self._partial[path] = 0, b''
+        if size == offset:
+            return []
+
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(min(size - offset, self.chunk_size))
+        self._offsets[path] = offset + len(data)
+
+        data = self._partial[path] + data
+        *complete, self._partial[path] = data.split(b'\n')
+        label = self.files[path]
+        return [(label, line.decode('utf-8', errors='replace')) for line in complete]
+
+    async def follow(self) -> AsyncIterator[List[Tuple[str, str]]]:
+        """
+        Yield batches of (label, line) for the lines appended to the files
+        """
+        loop = asyncio.get_event_loop()
+        changed = asyncio.Event()
+        pending = set()
+
+        if self._inotify is not None:
+            def _on_inotify():
+                for path in self._inotify.read():
+                    if path in self.files:
+                        pending.add(path)
+                        changed.set()
+            loop.add_reader(self._inotify.fd, _on_inotify)
+
+        try:
+            batch = [line for path in self.files for line in self.read(path)]
+            if batch:
+                yield batch
+
+            while True:
+                try:
+                    await asyncio.wait_for(changed.wait(), self.poll_interval)
+                    paths = list(pending)
+                except asyncio.TimeoutError:
+                    paths = list(self.files)
+                changed.clear()
+                pending.clear()
+
+                batch = [line for path in paths for line in self.read(path)]
+                # a large append is read in chunks, come back for the rest
+                if any(self._offsets.get(p, 0) < _size(p) for p in paths):
+                    pending.update(paths)
+                    changed.set()
+                if batch:
+                    yield batch
+        finally:
+            if self._inotify is not None:
+                loop.remove_reader(self._inotify.fd)
+                self._inotify.close()
+
+
+def _size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
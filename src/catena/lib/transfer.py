@@ -0,0 +1,355 @@
+import os
+import stat
+import time
+import queue
+import shlex
+import tarfile
+import posixpath
+import threading
+from typing import Optional, List, Tuple, Callable, NamedTuple, Iterable
+
+from paramiko import SFTPClient, Transport, Channel
+from loguru import logger
+
+
+def _size(nbytes: float) -> str:
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if nbytes < 1024 or unit == 'TiB':
+            return f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+
+
+class TransferResult(NamedTuple):
+    """
+    Outcome of a single file transfer
+
+    Attributes:
+        source: path read from
+        target: path written to
+        nbytes: number of bytes transferred
+        seconds: duration of the transfer
+        error: exception raised by the transfer, None on success
+    """
+    source: str
+    target: str
+    nbytes: int
+    seconds: float
+    error: Optional[Exception] = None
+
+
+class TransferStats:
+    """
+    Aggregate statistics of a batch of transfers
+    """
+
+    def __init__(self, results: List[TransferResult], seconds: float):
+        self.results = results
+        self.seconds = seconds
+
+    @property
+    def files(self) -> int:
+        return len(self.results)
+
+    @property
+    def failed(self) -> List[TransferResult]:
+        return [r for r in self.results if r.error is not None]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(r.nbytes for r in self.results if r.error is None)
+
+    @property
+    def throughput(self) -> float:
+        """
+        Aggregate throughput in bytes per second
+        """
+        return self.nbytes / self.seconds if self.seconds > 0 else 0.0
+
+    def raise_for_errors(self):
+        """
+        Raise IOError naming the failed transfers, chained to the first error
+        """
+        failed = self.failed
+        if failed:
+            names = ', '.join(r.source for r in failed[:5]) + (', ...' if len(failed) > 5 else '')
+            raise IOError(f"{len(failed)}/{self.files} transfers failed: {names}") from failed[0].error
+
+    def __str__(self):
+        return (f"{self.files - len(self.failed)}/{self.files} files, {_size(self.nbytes)} "
+                f"in {self.seconds:.2f}s ({_size(self.throughput)}/s)")
+
+
+class TransferEngine:
+    """
+    Concurrent file transfers over several SFTP channels. Each worker thread
+    owns an SFTP session opened by `sftp_factory`, which may open the sessions
+    as channels of one SSH transport or spread them over several transports.
+    Uploads use pipelined writes (no round trip per write request) and
+    downloads use read prefetch, so each channel streams at close to link
+    speed while the workers overlap the per-file round trips.
+
+    Attributes:
+        sftp_factory: callable returning a new `SFTPClient`
+
+        channels: number of concurrent SFTP sessions, **defaults to 4**
+
+        chunk_size: size of read and write requests in bytes, **defaults to 32768**
+    """
+
+    def __init__(self,
+                 sftp_factory: Callable[[], SFTPClient],
+                 channels: Optional[int] = 4,
+                 chunk_size: Optional[int] = 32768):
+
+        self.sftp_factory = sftp_factory
+        self.channels = channels
+        self.chunk_size = chunk_size
+        self._dirs = set()
+        self._dirs_lock = threading.Lock()
+
+    def _makedirs(self, sftp: SFTPClient, path: str):
+        """
+        Create a remote directory and its parents, remembering created ones
+        """
+        if not path or path in ('/', '.'):
+            return
+        with self._dirs_lock:
+            if path in self._dirs:
+                return
+        try:
+            if not stat.S_ISDIR(sftp.stat(path).st_mode):
+                raise IOError(f"remote path {path} exists and is not a directory")
+        except FileNotFoundError:
+            self._makedirs(sftp, posixpath.dirname(path))
+            try:
+                sftp.mkdir(path)
+            except IOError:
+                # created concurrently by another worker
+                if not stat.S_ISDIR(sftp.stat(path).st_mode):
+                    raise
+        with self._dirs_lock:
+            self._dirs.add(path)
+
+    def _upload(self, sftp: SFTPClient, source: str, target: str) -> int:
+        self._makedirs(sftp, posixpath.dirname(target))
+        nbytes = 0
+        with open(source, 'rb') as local, sftp.open(target, 'wb') as remote:
+            remote.set_pipelined(True)
+            while True:
+                data = local.read(self.chunk_size)
+                if not data:
+                    break
+                remote.write(data)
+                nbytes += len(data)
+        sftp.utime(target, (os.path.getatime(source), os.path.getmtime(source)))
+        return nbytes
+
+    def _download(self, sftp: SFTPClient, source: str, target: str) -> int:
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+        nbytes = 0
+        with sftp.open(source, 'rb') as remote, open(target, 'wb') as local:
+            remote.prefetch()
+            while True:
+                data = remote.read(self.chunk_size)
+                if not data:
+                    break
+                local.write(data)
+                nbytes += len(data)
+        return nbytes
+
+    def _worker(self, tasks: queue.Queue, results: List[TransferResult], lock: threading.Lock):
+        sftp = None
+        try:
+            while True:
+                try:
+                    op, source, target = tasks.get_nowait()
+                except queue.Empty:
+                    return
+
+                start = time.perf_counter()
+                try:
+                    if sftp is None:
+                        sftp = self.sftp_factory()
+                    nbytes = (self._upload if op == 'put' else self._download)(sftp, source, target)
+                    result = TransferResult(source, target, nbytes, time.perf_counter() - start)
+                except Exception as error:
+                    logger.error(f"Transfer of {source} to {target} failed: {error!r}")
+                    result = TransferResult(source, target, 0, time.perf_counter() - start, error)
+                with lock:
+                    results.append(result)
+        finally:
+            if sftp is not None:
+                sftp.close()
+
+    def run(self, transfers: Iterable[Tuple[str, str, str]]) -> TransferStats:
+        """
+        Run transfers concurrently
+
+        Args:
+            transfers: (op, source, target) tuples, where op is 'put' to upload
+                a local file or 'get' to download a remote file
+        """
+        tasks = queue.Queue()
+        for transfer in transfers:
+            tasks.put(transfer)
+
+        results: List[TransferResult] = []
+        lock = threading.Lock()
+        start = time.perf_counter()
+        workers = [threading.Thread(target=self._worker, args=(tasks, results, lock),
+                                    name=f'catena-transfer-{i}', daemon=True)
+                   for i in range(min(self.channels, tasks.qsize()))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        stats = TransferStats(results, time.perf_counter() - start)
+        logger.info(f"Transferred {stats}")
+        return stats
+
+    def upload(self, files: Iterable[Tuple[str, str]]) -> TransferStats:
+        """
+        Upload (local path, remote path) pairs
+        """
+        return self.run(('put', source, target) for source, target in files)
+
+    def download(self, files: Iterable[Tuple[str, str]]) -> TransferStats:
+        """
+        Download (remote path, local path) pairs
+        """
+        return self.run(('get', source, target) for source, target in files)
+
+
+class _ChannelWriter:
+    """
+    Minimal write-only file object over an exec channel, as used by a
+    streaming `tarfile`
+    """
+
+    def __init__(self, channel: Channel):
+        self.channel = channel
+        self.nbytes = 0
+
+    def write(self, data: bytes) -> int:
+        self.channel.sendall(data)
+        self.nbytes += len(data)
+        return len(data)
+
+
+class _ChannelReader:
+
+    def __init__(self, channel: Channel):
+        self.channel = channel
+        self.nbytes = 0
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        remaining = size if size >= 0 else float('inf')
+        while remaining > 0:
+            data = self.channel.recv(int(min(remaining, 1 << 16)))
+            if not data:
+                break
+            chunks.append(data)
+            remaining -= len(data)
+        data = b''.join(chunks)
+        self.nbytes += len(data)
+        return data
+
+
+def _check_exit(channel: Channel, action: str):
+    status = channel.recv_exit_status()
+    errors = b''
+    while channel.recv_stderr_ready():
+        errors += channel.recv_stderr(1 << 16)
+    channel.close()
+    if status != 0:
+        raise IOError(f"{action} failed with exit status {status}: {errors.decode(errors='replace').strip()}")
+
+
+def tar_upload(transport: Transport, source_dir: str, target_dir: str,
+               compress: Optional[bool] = False, recursive: Optional[bool] = True) -> TransferStats:
+    """
+    Stream `source_dir` as a tar archive into `tar -x` running on the remote
+    host over one exec channel, so many small files cost no round trip each.
+    Files are read and sent in tarfile record sized blocks, nothing is
+    written to disk on either side and memory use does not depend on the
+    size of the tree.
+
+    Args:
+        transport: connected SSH transport
+        source_dir: local directory whose content is uploaded
+        target_dir: remote directory the content is extracted into, created if needed
+        compress: gzip the stream
+        recursive: include subdirectories
+    """
+    flags = 'xzf' if compress else 'xf'
+    target = shlex.quote(target_dir)
+    channel = transport.open_session()
+    channel.exec_command(f"mkdir -p {target} && tar -{flags} - -C {target}")
+    writer = _ChannelWriter(channel)
+
+    start = time.perf_counter()
+    files = 0
+    try:
+        with tarfile.open(fileobj=writer, mode='w|gz' if compress else 'w|') as tar:
+            for root, dirs, names in os.walk(source_dir, topdown=True):
+                relative = os.path.relpath(root, source_dir)
+                if relative != '.':
+                    tar.add(root, arcname=relative, recursive=False)
+                for name in names:
+                    tar.add(os.path.join(root, name),
+                            arcname=name if relative == '.' else os.path.join(relative, name),
+                            recursive=False)
+                    files += 1
+                if not recursive:
+                    break
+    except (OSError, EOFError):
+        # the remote tar exited early, report its error rather than the broken channel
+        if channel.exit_status_ready():
+            _check_exit(channel, f"Extracting into {target_dir}")
+        raise
+    channel.shutdown_write()
+    _check_exit(channel, f"Extracting into {target_dir}")
+
+    seconds = time.perf_counter() - start
+    stats = TransferStats([TransferResult(source_dir, target_dir, writer.nbytes, seconds)], seconds)
+    logger.info(f"Streamed {files} files from {source_dir} to {target_dir}: {stats}")
+    return stats
+
+
+def tar_download(transport: Transport, source_dir: str, target_dir: str,
+                 compress: Optional[bool] = False) -> TransferStats:
+    """
+    Stream the remote directory `source_dir` from `tar -c` over one exec
+    channel and extract it into the local `target_dir` as it arrives
+
+    Args:
+        transport: connected SSH transport
+        source_dir: remote directory whose content is downloaded
+        target_dir: local directory the content is extracted into, created if needed
+        compress: gzip the stream
+    """
+    flags = 'czf' if compress else 'cf'
+    channel = transport.open_session()
+    channel.exec_command(f"tar -{flags} - -C {shlex.quote(source_dir)} .")
+    reader = _ChannelReader(channel)
+    os.makedirs(target_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    try:
+        with tarfile.open(fileobj=reader, mode='r|gz' if compress else 'r|') as tar:
+            if hasattr(tarfile, 'data_filter'):
+                # reject absolute paths, links out of target_dir and device files
+                tar.extractall(target_dir, filter='data')
+            else:
+                tar.extractall(target_dir)
+    except tarfile.TarError:
+        _check_exit(channel, f"Archiving {source_dir}")
+        raise
+    _check_exit(channel, f"Archiving {source_dir}")
+
+    seconds = time.perf_counter() - start
+    stats = TransferStats([TransferResult(source_dir, target_dir, reader.nbytes, seconds)], seconds)
+    logger.info(f"Streamed {source_dir} to {target_dir}: {stats}")
+    return stats
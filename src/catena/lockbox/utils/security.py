@@ -1,9 +1,11 @@
+import io
 import os
+import mmap
 import base64
 import string
 import pwd
 from random import randint, choice
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, BinaryIO, Iterator
 from pathlib import Path
 
 from Crypto.Cipher import AES
@@ -134,47 +136,45 @@ class GPGKeyRing:
         return self.gpg.decrypt(str(encrypted_data))
 
 
+    def __check(self, result, action, filepath):
+        if not result.ok:
+            raise IOError(f"Could not {action} {filepath}: {result.status}")
+        return result
+
+
     def encrypt_to_file(self, message, filepath):
         """
         Encrypt string using GPG key ring and write to file
         """
-        encrypted_data = self.encrypt_to_file(message)
-        with open(filepath, 'wb') as f:
-            f.write(encrypted_data)
+        self.__check(self.gpg.encrypt(message, self.fingerprint, output=str(filepath)),
+                     'encrypt to', filepath)
 
 
     def decrypt_file(self, filepath, to_file=False):
         """
         Decrypt file using GPG key and return as string or 
-        write to new decrypted file.
+        write to new decrypted file. The file is streamed through
+        gpg, which writes the decrypted file itself with to_file.
         """
 
         with open(filepath, 'rb') as f:
-            encrypted_data = f.read()
-        
-        decrypted_data = self.decrypt(encrypted_data)
-
-        if to_file:
-            _file = filepath + '.unlocked'
-            with open(_file, 'w') as f:
-                f.write(decrypted_data)
-        else:
-            return decrypted_data
+            if to_file:
+                self.__check(self.gpg.decrypt_file(f, output=str(filepath) + '.unlocked'),
+                             'decrypt', filepath)
+            else:
+                return str(self.__check(self.gpg.decrypt_file(f), 'decrypt', filepath))
     
 
-    def encrypt_file(self, filepath, remove_insecure=True):
+    def encrypt_file(self, filepath, remove_insecure=True, armor=True):
         """
-        Encrypt an existing file using GPG key ring
+        Encrypt an existing file using GPG key ring, streaming it
+        through gpg into `<filepath>.locked` without loading it in memory
         """
 
-        with open(filepath, 'r') as f:
-            data = f.read()
-        
-        encrypted_data = self.encrypt(data)
-
-        _file = filepath + '.locked'
-        with open(_file, 'wb') as f:
-            f.write(encrypted_data)
+        _file = str(filepath) + '.locked'
+        with open(filepath, 'rb') as f:
+            self.__check(self.gpg.encrypt_file(f, [self.fingerprint], armor=armor, output=_file),
+                         'encrypt', filepath)
         
         if remove_insecure:
             Path(filepath).unlink()
@@ -234,61 +234,151 @@ class Encryption:
         else:
             self.salted_key = None
 
-    def encrypt(self, secret):
+    @staticmethod
+    def _read_chunks(f: BinaryIO, chunk_size: int, use_mmap: bool = False) -> Iterator[bytes]:
         """
-            Encrypt a secret
+            Chunks of a file, as slices of a memory map of it with use_mmap
         """
 
-        # generate IV
-        IV = CryptoRandom.new().read(AES.block_size)
+        if use_mmap:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError, AttributeError):
+                # empty files and streams can not be mapped
+                pass
+            else:
+                with mapped, memoryview(mapped) as view:
+                    for offset in range(0, len(view), chunk_size):
+                        with view[offset:offset + chunk_size] as chunk:
+                            yield chunk
+                return
 
-        # Retrieve AES instance
-        aes = self.get_aes(IV)
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
 
-        # calculate needed padding
-        padding = AES.block_size - len(secret) % AES.block_size
+    def encrypt_stream(self, source: BinaryIO, target: BinaryIO,
+                       chunk_size: int = 1 << 20, use_mmap: bool = False) -> int:
+        """
+            Encrypt a stream chunk by chunk into the base 64 format of `encrypt`
+        """
 
-        # Python 2.x: secret += chr(padding) * padding
-        secret += bytes([padding]) * padding
+        IV = CryptoRandom.new().read(AES.block_size)
+        try:
+            aes = self.get_aes(IV)
+        finally:
+            # Reset salted key
+            self.set_salt()
+
+        # whole blocks, the final one is held back for padding
+        chunk_size = max(AES.block_size, chunk_size - chunk_size % AES.block_size)
+        pending = b''
+        # base 64 is written in groups of 3 bytes
+        carry = IV
+        nbytes = 0
+
+        for chunk in self._read_chunks(source, chunk_size, use_mmap):
+            nbytes += len(chunk)
+            data = pending + chunk if pending else chunk
+            cut = (len(data) - 1) // AES.block_size * AES.block_size
+            encrypted = carry + aes.encrypt(data[:cut])
+            pending = bytes(data[cut:])
+            cut = len(encrypted) - len(encrypted) % 3
+            target.write(base64.b64encode(encrypted[:cut]))
+            carry = encrypted[cut:]
+
+        padding = AES.block_size - len(pending) % AES.block_size
+        target.write(base64.b64encode(carry + aes.encrypt(pending + bytes([padding]) * padding)))
+        return nbytes
+
+    def decrypt_stream(self, source: BinaryIO, target: BinaryIO,
+                       chunk_size: int = 1 << 20, use_mmap: bool = False) -> int:
+        """
+            Decrypt a stream in the base 64 format of `encrypt` chunk by chunk
+        """
 
-        # store the IV at the beginning and encrypt
-        data = IV + aes.encrypt(secret)
+        aes = None
+        buffer = b''
+        carry = b''
+        nbytes = 0
+        try:
+            for chunk in self._read_chunks(source, chunk_size, use_mmap):
+                # base 64 is decoded in groups of 4 characters
+                text = carry + b''.join(bytes(chunk).split())
+                cut = len(text) - len(text) % 4
+                buffer += base64.b64decode(text[:cut])
+                carry = text[cut:]
+
+                if aes is None:
+                    if len(buffer) < AES.block_size:
+                        continue
+                    # extract the IV from the beginning
+                    aes = self.get_aes(buffer[:AES.block_size])
+                    buffer = buffer[AES.block_size:]
+
+                # keep the final block to check the padding
+                cut = (len(buffer) - 1) // AES.block_size * AES.block_size
+                if cut > 0:
+                    target.write(aes.decrypt(buffer[:cut]))
+                    nbytes += cut
+                    buffer = buffer[cut:]
+        finally:
+            # Reset salted key
+            self.set_salt()
+
+        if carry or aes is None or len(buffer) != AES.block_size:
+            raise ValueError("Invalid encrypted data...")
+
+        data = aes.decrypt(buffer)
+        padding = data[-1]
+        if not 1 <= padding <= AES.block_size or data[-padding:] != bytes([padding]) * padding:
+            raise ValueError("Invalid padding...")
 
-        # Reset salted key
-        self.set_salt()
+        target.write(data[:-padding])
+        return nbytes + AES.block_size - padding
 
-        # Return base 64 encoded bytes
-        return base64.b64encode(data)
+    def encrypt_file(self, source: str, target: str,
+                     chunk_size: int = 1 << 20, use_mmap: bool = False) -> int:
+        """
+            Encrypt a file of any size into `target` with constant memory,
+            reading it through a memory map with use_mmap
+        """
 
-    def decrypt(self, enc_secret):
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            return self.encrypt_stream(src, dst, chunk_size=chunk_size, use_mmap=use_mmap)
+
+    def decrypt_file(self, source: str, target: str,
+                     chunk_size: int = 1 << 20, use_mmap: bool = False) -> int:
         """
-            Decrypt a secret
+            Decrypt a file written by `encrypt_file` into `target` with constant memory
         """
 
-        # Decode base 64
-        enc_secret = base64.b64decode(enc_secret)
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            return self.decrypt_stream(src, dst, chunk_size=chunk_size, use_mmap=use_mmap)
 
-        # extract the IV from the beginning
-        IV = enc_secret[:AES.block_size]
+    def encrypt(self, secret):
+        """
+            Encrypt a secret
+        """
 
-        # Retrieve AES instance
-        aes = self.get_aes(IV)
+        encrypted = io.BytesIO()
+        self.encrypt_stream(io.BytesIO(secret), encrypted)
 
-        # Decrypt
-        data = aes.decrypt(enc_secret[AES.block_size:])
+        # Return base 64 encoded bytes
+        return encrypted.getvalue()
 
-        # pick the padding value from the end; Python 2.x: ord(data[-1])
-        padding = data[-1]
+    def decrypt(self, enc_secret):
+        """
+            Decrypt a secret
+        """
 
-        # Python 2.x: chr(padding) * padding
-        if data[-padding:] != bytes([padding]) * padding:
-            raise ValueError("Invalid padding...")
+        if isinstance(enc_secret, str):
+            enc_secret = enc_secret.encode()
 
-        # Reset salted key
-        self.set_salt()
+        decrypted = io.BytesIO()
+        self.decrypt_stream(io.BytesIO(enc_secret), decrypted)
 
-        # Remove the padding and return the bytes
-        return data[:-padding]
+        # Return the bytes without padding
+        return decrypted.getvalue()
 
 
 
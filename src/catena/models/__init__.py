@@ -1,4 +1,6 @@
 from .extensions import ExtendedBaseModel
 from .config import CatenaConfig, SlurmCluster
 from .slurm_submit import SlurmSubmit, SlurmModel
+from .retry import RetryPolicy
+from .rightsizing import RightSizing
 from .job_manifest import JobManifest, JobDefinition
\ No newline at end of file
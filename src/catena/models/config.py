@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Extra, validator
+from pydantic import BaseModel, Extra, validator, root_validator
 from typing import List, Optional, Dict
 from rich import print
 from pathlib import Path
@@ -10,14 +10,39 @@ from ..lib.yaml_loader import Loader, safe_loader
 #class BaseCluster(ABC) -> SlurmCluster(BaseCluster, BaseModel)
 
 class SlurmCluster(BaseModel):
-    api_host: str
+    """
+    Attributes:
+        api_host: host running slurmrestd, required unless `ssh_host` is set
+
+        ssh_host: login node of a cluster only reachable over SSH. When set,
+            jobs are submitted with sbatch over SSH (see `RemoteSlurmBackend`)
+            instead of through slurmrestd
+
+        ssh_user: user on `ssh_host`, **defaults to the local user**
+
+        ssh_keydir: directory of the SSH key pair, **defaults to ~/.ssh**
+
+        remote_workdir: directory on `ssh_host` scripts are staged in and jobs
+            are submitted from, **defaults to the remote home directory**
+    """
+    api_host: Optional[str] = None
     api_proto: Optional[str] = 'http'
     api_version: Optional[str] = '0.0.35'
     api_port: Optional[str] = '6820'
+    ssh_host: Optional[str] = None
+    ssh_user: Optional[str] = None
+    ssh_keydir: Optional[str] = None
+    remote_workdir: Optional[str] = None
 
     class Config:
         api_version_compat = ['0.0.35']
 
+    @root_validator(skip_on_failure=True)
+    def api_or_ssh_host(cls, values):
+        if not values.get('api_host') and not values.get('ssh_host'):
+            raise ValueError('cluster needs either api_host (slurmrestd) or ssh_host (sbatch over SSH)')
+        return values
+
 
 class ClusterDefinition(BaseModel):
     backend: Optional[str] = 'slurm'
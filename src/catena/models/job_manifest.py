@@ -5,6 +5,8 @@ from collections import namedtuple
 from pathlib import Path
 
 from .slurm_submit import SlurmSubmit
+from .retry import RetryPolicy
+from .rightsizing import RightSizing
 from . import ExtendedBaseModel
 from rich import print
 
@@ -55,6 +57,20 @@ class JobOptions(SlurmSubmit):
             prepended. For example, command='python -m' would result in the
             `job_script` being called as: `python -m <job_script>`. Generally,
             the default should give the right result.
+
+        pack: hint that the job is short running and may be packed together with
+            other short jobs into a single SLURM allocation (see `Jobs.pack`)
+
+        retry: policy for resubmitting the job when it ends in a transient failure
+            state (see `RetryPolicy`), takes precedence over the manifest policy
+
+        rightsize: policy for rewriting the time limit and memory request from the
+            recorded usage of earlier runs (see `RightSizing`), takes precedence
+            over the manifest policy
+
+        sidecar: wrap the job script to write a completion record to this
+            directory, or to .catena/sidecar when `true`, which the job poller
+            watches instead of polling slurmrestd (requires a shared filesystem)
     """
     name: Optional[str]
     env_modules: Optional[List[str]] = None
@@ -63,6 +79,10 @@ class JobOptions(SlurmSubmit):
     job_script_args: Optional[List[str]] = None
     command: Optional[str]
     dependencies: Optional[Dict[DependencyType, Union[str, List[str]]]]
+    pack: Optional[bool] = None
+    retry: Optional[RetryPolicy] = None
+    rightsize: Optional[RightSizing] = None
+    sidecar: Optional[Union[bool, str]] = None
 
     @validator('job_script')
     def expand_home_shortcut(cls, v):
@@ -114,12 +134,20 @@ class JobManifest(ExtendedBaseModel):
 
         jobs:  list of instances of JobDefinition 
 
+        retry: manifest wide policy for resubmitting jobs that end in a transient
+            failure state (see `RetryPolicy`)
+
+        rightsize: manifest wide policy for rewriting the time limit and memory
+            request of jobs from their recorded usage (see `RightSizing`)
+
     """
     cluster_profile: str
     catena_config: Optional[str] = str(Path().home() / '.catena/conf.yml')
     version: Optional[str] = "1.0"
     job_options: Optional[List[JobOptions]]
     jobs: Optional[List[Job]]
+    retry: Optional[RetryPolicy] = None
+    rightsize: Optional[RightSizing] = None
     
     class Config:
         """
@@ -139,7 +167,11 @@ class JobManifest(ExtendedBaseModel):
                           'env_extra',
                           'job_script_args',
                           'command',
-                          'dependencies']
+                          'dependencies',
+                          'pack',
+                          'retry',
+                          'rightsize',
+                          'sidecar']
 
 
     def __filter_ext_opts(self, jobdef: JobOptions, field: str):
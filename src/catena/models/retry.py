@@ -0,0 +1,133 @@
+import re
+from pydantic import validator
+from typing import List, Optional, Union
+from loguru import logger
+
+from . import ExtendedBaseModel
+
+
+_MEMORY_UNITS = {'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 ** 2}
+
+
+def time_limit_minutes(time_limit: Union[int, str]) -> Optional[int]:
+    """
+    Convert a SLURM time limit to minutes. Accepted formats are those of
+    sbatch: "minutes", "minutes:seconds", "hours:minutes:seconds",
+    "days-hours", "days-hours:minutes" and "days-hours:minutes:seconds"
+    """
+    if time_limit is None:
+        return None
+    if isinstance(time_limit, int):
+        return time_limit
+
+    days = 0
+    value = str(time_limit).strip()
+    if '-' in value:
+        d, value = value.split('-', 1)
+        days = int(d)
+        parts = [int(p) for p in value.split(':')]
+        parts += [0] * (3 - len(parts))
+        hours, minutes, seconds = parts
+    else:
+        parts = [int(p) for p in value.split(':')]
+        if len(parts) == 1:
+            hours, minutes, seconds = 0, parts[0], 0
+        elif len(parts) == 2:
+            hours, minutes, seconds = 0, parts[0], parts[1]
+        else:
+            hours, minutes, seconds = parts[:3]
+
+    return days * 24 * 60 + hours * 60 + minutes + (1 if seconds else 0)
+
+
+def memory_megabytes(memory: Union[int, str]) -> Optional[int]:
+    """
+    Convert a SLURM memory specification (e.g. 2048, '2G', '2GB') to megabytes
+    """
+    if memory is None:
+        return None
+    if isinstance(memory, (int, float)):
+        return int(memory)
+
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', str(memory).upper())
+    if match is None:
+        raise ValueError(f"invalid memory specification: {memory}")
+
+    value, unit = match.groups()
+    return int(float(value) * _MEMORY_UNITS[unit or 'M'])
+
+
+class RetryPolicy(ExtendedBaseModel):
+    """
+    Policy for automatically resubmitting jobs that end in a transient failure
+    state. The policy can be set for a whole manifest under `retry`, or per job
+    as an extra option, in which case the job level policy takes precedence.
+
+    Attributes:
+        max_attempts: maximum number of times a job is submitted, including the
+            first submission, **defaults to 3**
+
+        backoff: seconds to wait before the first resubmission, **defaults to 30**
+
+        backoff_factor: factor the wait is multiplied by for each further
+            resubmission, **defaults to 2**
+
+        max_backoff: upper bound of the wait between resubmissions in seconds,
+            **defaults to 3600**
+
+        retry_states: final job states that trigger a resubmission, **defaults to
+            NODE_FAIL, PREEMPTED, BOOT_FAIL and TIMEOUT**
+
+        time_limit_factor: factor to increase `time_limit` by when resubmitting
+            a job that ended in TIMEOUT, **defaults to None** (no change)
+
+        memory_factor: factor to increase the memory request by when resubmitting a
+            job that ended in OUT_OF_MEMORY, **defaults to None** (no change)
+    """
+    max_attempts: Optional[int] = 3
+    backoff: Optional[float] = 30
+    backoff_factor: Optional[float] = 2
+    max_backoff: Optional[float] = 3600
+    retry_states: Optional[List[str]] = ['NODE_FAIL', 'PREEMPTED', 'BOOT_FAIL', 'TIMEOUT']
+    time_limit_factor: Optional[float] = None
+    memory_factor: Optional[float] = None
+
+    @validator('retry_states', each_item=True)
+    def upper_case_states(cls, v):
+        return v.upper()
+
+    def should_retry(self, state: str, attempt: int) -> bool:
+        """
+        Whether a job in its `attempt`-th submission that ended in `state`
+        should be resubmitted
+        """
+        return state in self.retry_states and attempt < self.max_attempts
+
+    def delay(self, attempt: int) -> float:
+        """
+        Seconds to wait before resubmitting after the `attempt`-th submission
+        """
+        return min(self.max_backoff, self.backoff * self.backoff_factor ** (attempt - 1))
+
+    def bump(self, job_options, state: str):
+        """
+        Increase the resources of `job_options` (a `SlurmSubmit` instance)
+        according to the state the job ended in
+        """
+        if state == 'TIMEOUT' and self.time_limit_factor:
+            minutes = time_limit_minutes(job_options.time_limit)
+            if minutes:
+                job_options.time_limit = int(minutes * self.time_limit_factor + 0.5)
+
+        if state == 'OUT_OF_MEMORY' and self.memory_factor:
+            bumped = False
+            for field in ('memory_per_node', 'memory_per_cpu', 'memory_per_gpu'):
+                mb = memory_megabytes(getattr(job_options, field))
+                if mb:
+                    setattr(job_options, field, f"{int(mb * self.memory_factor + 0.5)}M")
+                    bumped = True
+            if not bumped:
+                logger.warning(f"Job {job_options.name} ran out of memory without a memory request, "
+                               f"resubmitting with the partition default")
+
+        return job_options
@@ -0,0 +1,94 @@
+import math
+from pydantic import validator
+from typing import Optional, Dict
+
+from . import ExtendedBaseModel
+from .retry import time_limit_minutes, memory_megabytes
+
+
+class RightSizing(ExtendedBaseModel):
+    """
+    Policy for rewriting the time limit and memory request of a job from the
+    recorded runtimes and peak memory of earlier runs of the same job
+    fingerprint (see `SlurmJob.fingerprint` and `AccountingHistory`). Smaller,
+    accurate requests are backfilled sooner by the scheduler. The policy can be
+    set for a whole manifest under `rightsize`, or per job as an extra option.
+
+    Attributes:
+        percentile: percentile of the recorded runtimes and peak memory that is
+            requested, **defaults to 95**
+
+        time_margin: fraction added to the runtime percentile, **defaults to 0.2**
+
+        memory_margin: fraction added to the peak memory percentile, **defaults to 0.2**
+
+        min_samples: number of completed runs required before requests are
+            rewritten, **defaults to 5**
+
+        min_time_limit: lower bound of the rewritten time limit in minutes,
+            **defaults to 5**
+
+        min_memory: lower bound of the rewritten memory request in megabytes,
+            **defaults to 256**
+
+        shrink_only: only ever lower requests, never raise them, **defaults to True**
+
+        time_limit: rewrite `time_limit`, **defaults to True**
+
+        memory: rewrite the memory request, **defaults to True**
+    """
+    percentile: Optional[float] = 95
+    time_margin: Optional[float] = 0.2
+    memory_margin: Optional[float] = 0.2
+    min_samples: Optional[int] = 5
+    min_time_limit: Optional[int] = 5
+    min_memory: Optional[int] = 256
+    shrink_only: Optional[bool] = True
+    time_limit: Optional[bool] = True
+    memory: Optional[bool] = True
+
+    @validator('percentile')
+    def percentile_range(cls, v):
+        if not 0 < v <= 100:
+            raise ValueError('percentile must be in (0, 100]')
+        return v
+
+    def apply(self, job_options, usage: Dict[str, float]):
+        """
+        Rewrite the requests of `job_options` (a `SlurmSubmit` instance) from
+        the `usage` percentiles returned by `AccountingHistory.usage`
+
+        Returns:
+            map of {field: (old value, new value)} of the rewritten fields
+        """
+        changes = {}
+        if not usage or usage.get('samples', 0) < self.min_samples:
+            return changes
+
+        if self.time_limit and usage.get('elapsed') is not None:
+            minutes = max(self.min_time_limit,
+                          math.ceil(usage['elapsed'] * (1 + self.time_margin) / 60))
+            current = time_limit_minutes(job_options.time_limit)
+            if current is None or not self.shrink_only or minutes < current:
+                changes['time_limit'] = (job_options.time_limit, minutes)
+                job_options.time_limit = minutes
+
+        if self.memory and usage.get('max_rss') is not None:
+            memory = max(self.min_memory,
+                         math.ceil(usage['max_rss'] * (1 + self.memory_margin)))
+            # unset memory options default to 0, rewrite the one that was requested
+            if memory_megabytes(job_options.memory_per_cpu):
+                fields = {'memory_per_cpu': math.ceil(memory / max(usage.get('cpus') or 1, 1))}
+            elif memory_megabytes(job_options.memory_per_gpu):
+                # per GPU requests exclude per node ones and cannot be derived from the job peak
+                fields = {}
+            else:
+                fields = {'memory_per_node': memory}
+
+            for field, mb in fields.items():
+                current = memory_megabytes(getattr(job_options, field))
+                if not current or not self.shrink_only or mb < current:
+                    changes[field] = (getattr(job_options, field), f"{mb}M")
+                    setattr(job_options, field, f"{mb}M")
+
+        return changes
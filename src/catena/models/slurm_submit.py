@@ -14,6 +14,10 @@ class SlurmSubmit(ExtendedBaseModel):
     Attributes:
         name: SLURM job name
         
+        array: submit a job array, multiple jobs to be executed with identical parameters. The indexes specification 
+            identifies what array index values should be used (e.g. '0-15' or '0-15%4' to limit the number of 
+            simultaneously running tasks to 4), **defaults to None**
+
         delay_boot: do not reboot nodes in order to satisfied this job's feature 
             specification if the job has been eligible to run for less than this time period,
             **defaults to 0** (suggested to leave as default)
@@ -150,6 +154,7 @@ class SlurmSubmit(ExtendedBaseModel):
             **defaults to None**
     """
     name: str
+    array: Optional[str] = None
     delay_boot: Optional[int] = 0   # leave set to 0
     dependency: Optional[str] = None   
     distribution: Optional[str] = 'arbitrary'
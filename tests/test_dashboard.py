@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+
+from catena.lib.dashboard import StateTable
+
+
+def make_jobs():
+    return [SimpleNamespace(name='a', jobid=1, job_state=None),
+            SimpleNamespace(name='b', jobid=2, job_state=None),
+            SimpleNamespace(name='c', jobid=None, job_state=None)]
+
+
+def test_done_ignores_unsubmitted_jobs():
+    table = StateTable(make_jobs())
+    assert not table.done()
+
+    table.apply([{'name': 'a', 'state': 'COMPLETED', 'previous': 'PENDING', 'jobid': 1}])
+    assert not table.done()
+
+    table.apply([{'name': 'b', 'state': 'FAILED', 'previous': 'PENDING', 'jobid': 2}])
+    assert table.done()
+
+
+def test_nothing_submitted_is_not_done():
+    table = StateTable([SimpleNamespace(name='a', jobid=None, job_state=None)])
+    assert not table.done()
+
+
+def test_render_reuses_unchanged_rows():
+    table = StateTable(make_jobs())
+    table.render()
+    rows = dict(table._count_rows)
+
+    table.apply([{'name': 'a', 'state': 'RUNNING', 'previous': 'PENDING', 'jobid': 1}])
+    table.render()
+
+    assert table._count_rows['UNSUBMITTED'] is rows['UNSUBMITTED']
+    assert table._count_rows['PENDING'] is not rows['PENDING']
+    assert table._count_rows['RUNNING'][1] == '1'
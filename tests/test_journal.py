@@ -0,0 +1,114 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from catena.jobs.journal import SubmissionJournal
+
+
+class FakeBackend:
+    """
+    Accounting of a cluster reached over SSH, see `RemoteSlurmBackend.records`
+    """
+
+    def __init__(self, records=None, error=None):
+        self._records = records or {}
+        self.error = error
+        self.since = None
+
+    def records(self, jobids=None, since=None):
+        if self.error is not None:
+            raise self.error
+        self.since = since
+        return self._records
+
+
+def make_job(name, backend):
+    return SimpleNamespace(name=name, user='user', jobid=None, backend=backend)
+
+
+def crash(path, backend, submitted=('a',), intents=('a', 'b', 'c')):
+    """
+    Journal intents and submissions of a run, then lose the process without closing it
+    """
+    journal = SubmissionJournal(path)
+    jobs = {name: make_job(name, backend) for name in intents}
+    for job in jobs.values():
+        journal.intent(job)
+    journal.flush()
+    for jobid, name in enumerate(submitted, start=1):
+        jobs[name].jobid = jobid
+        journal.submitted(jobs[name])
+    journal.flush()
+    return journal.run_id
+
+
+def test_reconcile_after_crash(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    now = time.time()
+    backend = FakeBackend({
+        '7': {'job_id': 7, 'name': 'b', 'user_name': 'user', 'submit_time': now + 1},
+        # an earlier run of the same job
+        '3': {'job_id': 3, 'name': 'c', 'user_name': 'user', 'submit_time': now - 3600},
+    })
+    run_id = crash(path, backend)
+
+    journal = SubmissionJournal(path, resume=True)
+    assert journal.run_id == run_id
+    jobs = [make_job(name, backend) for name in ('a', 'b', 'c', 'd')]
+    resolved = journal.reconcile(jobs)
+    journal.close()
+
+    assert resolved == {'a': 1, 'b': 7}
+    assert [job.jobid for job in jobs] == [1, 7, None, None]
+    assert backend.since <= time.time() - 60
+
+    # the reconciled submission is journaled, no lookup is needed again
+    journal = SubmissionJournal(path, resume=True)
+    assert journal.state()['b']['jobid'] == 7
+
+
+def test_reconcile_refuses_without_accounting(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    crash(path, FakeBackend())
+
+    backend = FakeBackend(error=IOError('sacct: error: Problem talking to the database'))
+    journal = SubmissionJournal(path, resume=True)
+    with pytest.raises(RuntimeError):
+        journal.reconcile([make_job(name, backend) for name in ('a', 'b')])
+
+
+def test_reconcile_new_run(tmp_path):
+    backend = FakeBackend(error=IOError('not queried'))
+    journal = SubmissionJournal(tmp_path / 'journal.jsonl')
+    assert journal.reconcile([make_job('a', backend)]) == {}
+
+
+def test_list_submissions_over_rest(monkeypatch):
+    from catena.lib import accounting
+
+    class Response:
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {'jobs': [{'job_id': 5, 'name': 'a', 'user': 'user', 'time': {'submission': 100}}]}
+
+    calls = []
+
+    def request(method, url, **kwargs):
+        calls.append((url, kwargs['params']))
+        return Response()
+
+    monkeypatch.setattr(accounting, 'request', request)
+    monkeypatch.setattr(accounting, 'list_jobs', lambda job: {
+        '5': {'job_id': 5, 'name': 'a', 'user_name': 'user', 'submit_time': 100},
+        '6': {'job_id': 6, 'name': 'b', 'user_name': 'user', 'submit_time': 200},
+    })
+    job = SimpleNamespace(backend=None, protocol='http', host='db', port='6820', api_version='0.0.36',
+                          user='user', generate_token=lambda: 'token', request_header=lambda: {})
+
+    records = accounting.list_submissions(job, since=50.5)
+
+    assert calls == [('http://db:6820/slurmdb/v0.0.36/jobs', {'users': 'user', 'start_time': 50})]
+    assert sorted(r['job_id'] for r in records) == [5, 6]
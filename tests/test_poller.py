@@ -0,0 +1,130 @@
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+from catena.jobs.poller import JobPoller
+
+
+class FakeJob:
+
+    def __init__(self, jobid, retries=0):
+        self.jobid = jobid
+        self.name = f"job-{jobid}"
+        self.job_state = 'RUNNING'
+        self.host, self.port, self.api_version = 'slurm', 6820, '0.0.38'
+        self._state = {}
+        self.attempt = 0
+        self.retries = retries
+        self.retry = SimpleNamespace(delay=lambda attempt: 0)
+        self.resubmitted = []
+
+    def can_retry(self, state):
+        return state != 'COMPLETED' and self.attempt < self.retries
+
+    def resubmit(self, state):
+        self.resubmitted.append(state)
+        self.attempt += 1
+        self.jobid += 100
+
+
+def watched(poller, job, passive=False):
+    future = Future()
+    poller._watched[str(job.jobid)] = (job, future)
+    if passive:
+        poller._passive.add(str(job.jobid))
+    return future
+
+
+def test_sidecar_resolves_job():
+    poller = JobPoller()
+    job = FakeJob(1)
+    future = watched(poller, job, passive=True)
+    events = []
+    poller.subscribe(events.extend)
+
+    poller._on_sidecar({'jobid': 1, 'exit_code': 0, 'end': 10})
+
+    assert future.result(timeout=0).state == 'COMPLETED'
+    assert job._state[job.name]['state'] == 'COMPLETED'
+    assert '1' not in poller._watched and '1' not in poller._passive
+    assert events == [{'jobid': 1, 'name': 'job-1', 'run': None, 'state': 'COMPLETED',
+                       'previous': 'RUNNING', 'time': 10}]
+
+
+def test_sidecar_leaves_signalled_job_to_poll():
+    poller = JobPoller()
+    job = FakeJob(1)
+    future = watched(poller, job, passive=True)
+
+    poller._on_sidecar({'jobid': 1, 'exit_code': 137})
+
+    assert not future.done()
+    assert '1' in poller._watched and '1' not in poller._passive
+
+
+def test_sidecar_schedules_retry_once():
+    poller = JobPoller()
+    job = FakeJob(1, retries=1)
+    future = watched(poller, job)
+
+    poller._on_sidecar({'jobid': 1, 'exit_code': 1})
+    poller._on_sidecar({'jobid': 1, 'exit_code': 1})
+
+    assert not future.done()
+    assert list(poller._retrying) == ['1']
+    assert poller._retrying['1'][1] == 'FAILED'
+
+
+def test_update_does_not_reschedule_sidecar_retry():
+    poller = JobPoller()
+    job = FakeJob(1, retries=1)
+    watched(poller, job)
+    poller._retrying['1'] = (time.time() + 60, 'FAILED')
+
+    resolved, events = [], []
+    poller._update(job, {'job_state': 'TIMEOUT'}, dict(poller._watched), resolved, events)
+
+    assert poller._retrying['1'][1] == 'FAILED'
+    assert resolved == []
+
+
+def test_resubmit_due_rewatches_new_jobid():
+    poller = JobPoller()
+    job = FakeJob(1, retries=1)
+    future = watched(poller, job, passive=True)
+    poller._retrying['1'] = (time.time() - 1, 'FAILED')
+
+    poller._resubmit_due()
+
+    assert job.resubmitted == ['FAILED']
+    assert poller._watched == {'101': (job, future)}
+    assert poller._passive == {'101'}
+    assert not poller._retrying
+
+
+def test_resubmit_due_skips_jobs_no_longer_watched():
+    poller = JobPoller()
+    job = FakeJob(1, retries=1)
+    poller._retrying['1'] = (time.time() - 1, 'FAILED')
+    poller._retrying['2'] = (time.time() + 60, 'FAILED')
+
+    poller._resubmit_due()
+
+    assert job.resubmitted == []
+    assert list(poller._retrying) == ['2']
+
+
+def test_poll_resolves_and_retries(monkeypatch):
+    poller = JobPoller()
+    done, retried = FakeJob(1), FakeJob(2, retries=1)
+    done_future, retried_future = watched(poller, done), watched(poller, retried)
+    records = {'1': {'job_state': 'COMPLETED', 'exit_code': 0},
+               '2': {'job_state': 'FAILED', 'exit_code': 1}}
+    monkeypatch.setattr('catena.jobs.poller.list_jobs', lambda job, jobids: records)
+
+    poller.poll()
+
+    assert done_future.result(timeout=0).state == 'COMPLETED'
+    assert not retried_future.done()
+    assert list(poller._watched) == ['2']
+    assert list(poller._retrying) == ['2']
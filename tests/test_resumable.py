@@ -0,0 +1,133 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from catena.lib.resumable import (Checkpoint, ResumableTransfer, sha256_file,
+                                  CHECKPOINT_SUFFIX, PART_SUFFIX)
+
+
+class LocalFile:
+    """
+    SFTP file over a local file, failing reads past `fail_at` bytes
+    """
+
+    def __init__(self, path, fail_at=None):
+        self.f = open(path, 'rb')
+        self.fail_at = fail_at
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.f.close()
+
+    def readv(self, blocks):
+        for offset, length in blocks:
+            if self.fail_at is not None and offset + length > self.fail_at:
+                raise EOFError('connection dropped')
+            self.f.seek(offset)
+            yield self.f.read(length)
+
+
+class LocalSFTP:
+
+    def __init__(self, fail_at=None):
+        self.fail_at = fail_at
+        self.opened = []
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def open(self, path, mode):
+        self.opened.append(path)
+        return LocalFile(path, self.fail_at)
+
+    def close(self):
+        pass
+
+
+def test_checkpoint_resumes_done_chunks(tmp_path):
+    path = tmp_path / 'file.catena-checkpoint'
+    checkpoint = Checkpoint(path, 10, 1, 4)
+    assert checkpoint.chunks == 3 and checkpoint.pending() == [0, 1, 2]
+
+    checkpoint.complete(0)
+    checkpoint.complete(2)
+
+    resumed = Checkpoint(path, 10, 1, 4)
+    assert resumed.done == {0, 2}
+    assert resumed.pending() == [1]
+    assert resumed.offset == 4
+    assert resumed.remaining == 4
+
+
+@pytest.mark.parametrize('size, mtime, chunk_size', [(11, 1, 4), (10, 2, 4), (10, 1, 5)])
+def test_checkpoint_discarded_when_source_changed(tmp_path, size, mtime, chunk_size):
+    path = tmp_path / 'file.catena-checkpoint'
+    Checkpoint(path, 10, 1, 4).complete(0)
+
+    assert Checkpoint(path, size, mtime, chunk_size).done == set()
+
+
+def test_corrupt_checkpoint_is_ignored(tmp_path):
+    path = tmp_path / 'file.catena-checkpoint'
+    path.write_text('{"size": 10')
+
+    assert Checkpoint(path, 10, 1, 4).done == set()
+
+
+def test_download_resumes_after_dropped_connection(tmp_path):
+    source = tmp_path / 'remote.bin'
+    data = os.urandom(10 * 1024)
+    source.write_bytes(data)
+    target = str(tmp_path / 'local.bin')
+
+    failing = ResumableTransfer(lambda: LocalSFTP(fail_at=6 * 1024), lambda path: None,
+                                chunk_size=2048, verify=False)
+    with pytest.raises(EOFError):
+        failing.download(str(source), target)
+    done = Checkpoint(Path(target + CHECKPOINT_SUFFIX), len(data),
+                      int(source.stat().st_mtime), 2048).done
+    assert done == {0, 1, 2}
+
+    sessions = []
+
+    def factory():
+        sessions.append(LocalSFTP())
+        return sessions[-1]
+
+    stats = ResumableTransfer(factory, lambda path: None, chunk_size=2048, verify=False) \
+        .download(str(source), target)
+
+    assert Path(target).read_bytes() == data
+    assert stats.results[0].nbytes == 4 * 1024
+    assert not os.path.exists(target + CHECKPOINT_SUFFIX)
+    assert not os.path.exists(target + PART_SUFFIX)
+
+
+def test_verify_mismatch_discards_checkpoint(tmp_path):
+    local = tmp_path / 'local.bin'
+    local.write_bytes(b'catena')
+    checkpoint = Checkpoint(tmp_path / 'local.bin.catena-checkpoint', 6, 1, 4)
+    checkpoint.complete(0)
+    checkpoint.complete(1)
+
+    transfer = ResumableTransfer(LocalSFTP, lambda path: '0' * 64)
+    with pytest.raises(IOError, match='Checksum mismatch'):
+        transfer._verify(checkpoint, str(local), '/remote/local.bin')
+
+    assert not checkpoint.path.exists()
+    assert Checkpoint(checkpoint.path, 6, 1, 4).done == set()
+
+
+def test_verify_matching_digests(tmp_path):
+    local = tmp_path / 'local.bin'
+    local.write_bytes(b'catena')
+    checkpoint = Checkpoint(tmp_path / 'local.bin.catena-checkpoint', 6, 1, 4)
+    checkpoint.complete(0)
+
+    transfer = ResumableTransfer(LocalSFTP, lambda path: sha256_file(str(local)))
+    transfer._verify(checkpoint, str(local), '/remote/local.bin')
+
+    assert checkpoint.path.exists()
@@ -0,0 +1,149 @@
+from collections import defaultdict
+
+import pytest
+
+from catena.jobs.slurm import SlurmJob
+from catena.models import RetryPolicy, SlurmSubmit, SlurmModel
+from catena.models.retry import time_limit_minutes, memory_megabytes
+
+
+@pytest.mark.parametrize('value, minutes', [
+    ('1-02:03:04', 1564),
+    ('90', 90),
+    ('1:30', 2),
+    ('2-0', 2880),
+    ('01:00:00', 60),
+    (45, 45),
+    (None, None),
+])
+def test_time_limit_minutes(value, minutes):
+    assert time_limit_minutes(value) == minutes
+
+
+@pytest.mark.parametrize('value, mb', [
+    ('2G', 2048),
+    ('2GB', 2048),
+    ('512', 512),
+    ('1.5G', 1536),
+    ('1024K', 1),
+    (4096, 4096),
+    (None, None),
+])
+def test_memory_megabytes(value, mb):
+    assert memory_megabytes(value) == mb
+
+
+def test_memory_megabytes_invalid():
+    with pytest.raises(ValueError):
+        memory_megabytes('lots')
+
+
+def test_bump_timeout():
+    options = SlurmSubmit(name='x', time_limit='1:00:00')
+    RetryPolicy(time_limit_factor=1.5).bump(options, 'TIMEOUT')
+    assert time_limit_minutes(options.time_limit) == 90
+
+
+def test_bump_out_of_memory():
+    options = SlurmSubmit(name='x', memory_per_node='4G')
+    RetryPolicy(memory_factor=2).bump(options, 'OUT_OF_MEMORY')
+    assert options.memory_per_node == '8192M'
+    assert options.memory_per_cpu == 0
+
+
+def test_bump_out_of_memory_without_request():
+    options = SlurmSubmit(name='x')
+    RetryPolicy(memory_factor=2).bump(options, 'OUT_OF_MEMORY')
+    assert options.memory_per_node == 0
+    assert options.memory_per_cpu == 0
+
+
+def test_bump_other_state():
+    options = SlurmSubmit(name='x', time_limit=60, memory_per_node='4G')
+    RetryPolicy(time_limit_factor=2, memory_factor=2).bump(options, 'NODE_FAIL')
+    assert time_limit_minutes(options.time_limit) == 60
+    assert options.memory_per_node == '4G'
+
+
+def test_should_retry_and_delay():
+    policy = RetryPolicy(max_attempts=3, backoff=10, backoff_factor=2, max_backoff=15)
+    assert policy.should_retry('TIMEOUT', 1)
+    assert not policy.should_retry('TIMEOUT', 3)
+    assert not policy.should_retry('FAILED', 1)
+    assert policy.delay(1) == 10
+    assert policy.delay(3) == 15
+
+
+class FakeBackend:
+
+    def __init__(self):
+        self.next_jobid = 100
+        self.updated = []
+
+    def submit_level(self, jobs):
+        for job in jobs:
+            job.jobid = self.next_jobid
+            self.next_jobid += 1
+        return {}
+
+    def update_dependency(self, job):
+        self.updated.append((job.jobid, job.depstr))
+
+
+def make_job(name, backend, retry=None, jobid=None):
+    job = SlurmJob.__new__(SlurmJob)
+    job.name = name
+    job.jobid = jobid
+    job.backend = backend
+    job.retry = retry
+    job.rightsize = None
+    job.history = None
+    job.attempts = []
+    job.depmap = defaultdict(list)
+    job.dependents = []
+    job.request = SlurmModel(script='#!/bin/bash', job=SlurmSubmit(name=name, time_limit=60))
+    return job
+
+
+def test_resubmit_rewires_dependents():
+    backend = FakeBackend()
+    upstream = make_job('upstream', backend, retry=RetryPolicy(time_limit_factor=2), jobid=1)
+    downstream = make_job('downstream', backend, jobid=2)
+    downstream.depmap['afterok'].append(upstream)
+    upstream.dependents.append(downstream)
+
+    upstream.resubmit('TIMEOUT')
+
+    assert upstream.jobid == 100
+    assert upstream.attempt == 2
+    assert upstream.attempts[0]['jobid'] == 1
+    assert time_limit_minutes(upstream.request.job.time_limit) == 120
+    assert downstream.request.job.dependency == 'afterok:100'
+    assert backend.updated == [(2, 'afterok:100')]
+
+
+class FakeResponse:
+
+    def __init__(self, state):
+        self.state = state
+
+    def json(self):
+        return {'jobs': [{'job_id': 1, 'job_state': self.state}]}
+
+
+def test_monitor_retries_over_rest(monkeypatch):
+    states = iter(['PENDING', 'RUNNING', 'TIMEOUT', 'RUNNING', 'COMPLETED'])
+    monkeypatch.setattr('catena.jobs.slurm.metrics.request',
+                        lambda method, url, **kwargs: FakeResponse(next(states)))
+    monkeypatch.setattr('catena.jobs.slurm.time.sleep', lambda seconds: None)
+
+    job = make_job('job', FakeBackend(), retry=RetryPolicy(), jobid=1)
+    resubmitted = []
+    monkeypatch.setattr(job, 'resubmit', lambda state: resubmitted.append(state), raising=False)
+    job.backend = None
+    job.protocol, job.host, job.port, job.api_version = 'http', 'api', '6820', '0.0.35'
+    job.user, job.token, job._token_info = 'user', 'token', {}
+    job.monitor_polls = 0
+
+    assert job.monitor(poll_time=0) == ('COMPLETED', 5)
+    assert resubmitted == ['TIMEOUT']
@@ -0,0 +1,40 @@
+from catena.models import SlurmSubmit
+from catena.models.rightsizing import RightSizing
+
+
+USAGE = {'samples': 10, 'elapsed': 300.0, 'max_rss': 1000.0, 'cpus': 4}
+
+
+def test_memory_per_node():
+    options = SlurmSubmit(name='x', memory_per_node='64G', time_limit=600)
+    changes = RightSizing().apply(options, USAGE)
+
+    assert changes['memory_per_node'] == ('64G', '1200M')
+    assert options.memory_per_node == '1200M'
+    assert 'memory_per_cpu' not in changes
+    assert options.memory_per_cpu == 0
+    assert options.time_limit == 6
+
+
+def test_memory_per_cpu():
+    options = SlurmSubmit(name='x', memory_per_cpu='8G', time_limit=600)
+    changes = RightSizing().apply(options, USAGE)
+
+    assert changes['memory_per_cpu'] == ('8G', '300M')
+    assert 'memory_per_node' not in changes
+
+
+def test_memory_unset():
+    options = SlurmSubmit(name='x', time_limit=600)
+    changes = RightSizing().apply(options, USAGE)
+
+    assert options.memory_per_node == '1200M'
+    assert 'memory_per_cpu' not in changes
+
+
+def test_shrink_only():
+    options = SlurmSubmit(name='x', memory_per_node='512M', time_limit=600)
+    changes = RightSizing().apply(options, USAGE)
+
+    assert 'memory_per_node' not in changes
+    assert options.memory_per_node == '512M'
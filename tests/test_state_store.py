@@ -0,0 +1,84 @@
+import shutil
+import sqlite3
+
+from catena.lib.state_store import JobStateStore
+
+
+def test_record_and_flush(tmp_path):
+    store = JobStateStore(tmp_path / 'state.db')
+    store.record(1, 'a', 'PENDING', run_id='run', timestamp=1.0)
+    store.record(1, 'a', 'PENDING', timestamp=2.0)
+    store.record(1, 'a', 'RUNNING', timestamp=3.0)
+    store.record(2, 'b', 'PENDING', run_id='run', timestamp=1.0)
+
+    assert store.latest()['1']['state'] == 'RUNNING'
+    assert store.latest()['1']['run_id'] == 'run'
+    assert store.counts() == {'RUNNING': 1, 'PENDING': 1}
+    # unchanged states are not recorded as transitions
+    assert store.transitions(1) == [('PENDING', 1.0), ('RUNNING', 3.0)]
+    assert [job['jobid'] for job in store.by_state('PENDING', run_id='run')] == ['2']
+    store.close()
+
+
+def test_batch_flush(tmp_path):
+    store = JobStateStore(tmp_path / 'state.db', batch_size=2)
+    store.record(1, 'a', 'PENDING')
+    assert len(store._pending) == 1
+    store.record(2, 'b', 'PENDING')
+    assert store._pending == []
+    store.close()
+
+
+def test_reload_only_active_jobs(tmp_path):
+    path = tmp_path / 'state.db'
+    with JobStateStore(path) as store:
+        store.record(1, 'a', 'COMPLETED', run_id='run')
+        store.record(2, 'b', 'RUNNING', run_id='run')
+        store.record(3, 'c', 'PENDING', run_id='run')
+        store.record(3, 'c', 'FAILED')
+
+    store = JobStateStore(path)
+    assert set(store.latest()) == {'2'}
+    assert store.active()['2']['state'] == 'RUNNING'
+    assert store.counts('run') == {'COMPLETED': 1, 'RUNNING': 1, 'FAILED': 1}
+
+    plan = ' '.join(str(row) for row in store._conn.execute(
+        'EXPLAIN QUERY PLAN SELECT jobid FROM jobs WHERE final = 0'))
+    assert 'jobs_active' in plan
+    store.close()
+
+
+def test_wal_recovery(tmp_path):
+    path = tmp_path / 'state.db'
+    store = JobStateStore(path)
+    store.record(1, 'a', 'RUNNING')
+    store.flush()
+    assert (tmp_path / 'state.db-wal').stat().st_size > 0
+
+    # copy the database and its write-ahead log as left by a killed process
+    crashed = tmp_path / 'crashed'
+    crashed.mkdir()
+    for name in ('state.db', 'state.db-wal'):
+        shutil.copy(tmp_path / name, crashed / name)
+    store.close()
+
+    recovered = JobStateStore(crashed / 'state.db')
+    assert recovered.latest()['1']['state'] == 'RUNNING'
+    assert recovered.transitions(1)[0][0] == 'RUNNING'
+    recovered.close()
+
+
+def test_migrate_store_without_final_flag(tmp_path):
+    path = tmp_path / 'state.db'
+    conn = sqlite3.connect(str(path))
+    conn.executescript("""
+        CREATE TABLE jobs (jobid TEXT PRIMARY KEY, name TEXT NOT NULL, run_id TEXT,
+                           state TEXT, submitted REAL, updated REAL);
+        INSERT INTO jobs VALUES ('1', 'a', NULL, 'COMPLETED', 0, 0);
+        INSERT INTO jobs VALUES ('2', 'b', NULL, 'RUNNING', 0, 0);
+    """)
+    conn.close()
+
+    store = JobStateStore(path)
+    assert set(store.latest()) == {'2'}
+    store.close()